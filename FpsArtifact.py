@@ -0,0 +1,204 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+ARTIFACT_MAGIC = b'FPSARTIF'
+ARTIFACT_VERSION = 1
+# magic, version, reserved, number of sites, number of sets, size of the
+# string table
+_HEADER = struct.Struct('<8sHHIII')
+# The roles of FpsSet.members(), indexed by the role byte of a site
+ROLES = ("primary", "associated", "service", "ccTLD")
+
+
+def _layout(num_sites, num_sets):
+    """Returns the byte offsets of the sections of an artifact: the site
+    string offsets, the set of each site, the primary of each set, the role
+    of each site and the string table"""
+    site_offsets = _HEADER.size + (-_HEADER.size % 4)
+    site_sets = site_offsets + 4 * (num_sites + 1)
+    set_primaries = site_sets + 4 * num_sites
+    site_roles = set_primaries + 4 * num_sets
+    strings = site_roles + num_sites
+    return site_offsets, site_sets, set_primaries, site_roles, strings
+
+
+def write_artifact(check_sets, path):
+    """Compiles sets into a membership artifact at path
+
+    Every member site, ccTLD variants included, is encoded as UTF-8 and the
+    sites are sorted by those bytes. The artifact holds a table of where each
+    site starts in the string table, the set and role of each site and the
+    site index of the primary of each set, as little-endian arrays that a
+    FpsArtifact maps without copying. The file is written to a temporary
+    name and renamed into place, so readers that mapped the previous artifact
+    keep their view of it.
+
+    Args:
+        check_sets: Dict[string, FpsSet]
+        path: the path of the artifact
+    Returns:
+        None
+    """
+    members = {}
+    primaries = []
+    for set_index, fps in enumerate(check_sets.values()):
+        primaries.append(fps.primary.encode('utf-8'))
+        for site, role in fps.members():
+            # A site listed twice in a set keeps its first role
+            members.setdefault(site.encode('utf-8'),
+                               (set_index, ROLES.index(role)))
+    sites = sorted(members)
+    index_of = {site: i for i, site in enumerate(sites)}
+
+    site_offsets = array('I', [0])
+    for site in sites:
+        site_offsets.append(site_offsets[-1] + len(site))
+    site_sets = array('I', (members[site][0] for site in sites))
+    set_primaries = array('I', (index_of[primary] for primary in primaries))
+    site_roles = bytes(members[site][1] for site in sites)
+    strings = b''.join(sites)
+    if sys.byteorder != 'little':
+        for table in (site_offsets, site_sets, set_primaries):
+            table.byteswap()
+
+    header = _HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, 0, len(sites),
+                          len(primaries), len(strings))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.artifact-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + b'\0' * (-len(header) % 4))
+            for section in (site_offsets, site_sets, set_primaries,
+                            site_roles, strings):
+                f.write(section)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FpsArtifact:
+    """Answers set membership queries from a memory-mapped artifact written
+    by write_artifact
+
+    Opening an artifact only maps it and reads its header; lookups binary
+    search the sorted site table in place, so processes mapping the same
+    file share its pages. Use it as a context manager, or call close().
+
+  Attributes:
+    path: the path of the artifact
+    num_sites: the number of member sites
+    num_sets: the number of sets
+  """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.num_sites, self.num_sets, _ = (
+            _HEADER.unpack_from(self._mmap))
+        if magic != ARTIFACT_MAGIC or version != ARTIFACT_VERSION:
+            self._mmap.close()
+            raise ValueError("Not a version " + str(ARTIFACT_VERSION)
+                             + " FPS artifact: " + path)
+        (site_offsets, site_sets, set_primaries, site_roles,
+         strings) = _layout(self.num_sites, self.num_sets)
+        self._strings_start = strings
+        view = self._view = memoryview(self._mmap)
+        self._site_offsets = self._uint32s(view, site_offsets,
+                                           self.num_sites + 1)
+        self._site_sets = self._uint32s(view, site_sets, self.num_sites)
+        self._set_primaries = self._uint32s(view, set_primaries,
+                                            self.num_sets)
+        self._site_roles = view[site_roles:site_roles + self.num_sites]
+
+    @staticmethod
+    def _uint32s(view, offset, count):
+        section = view[offset:offset + 4 * count]
+        if sys.byteorder == 'little':
+            return section.cast('I')
+        # big-endian hosts get a byte-swapped copy instead of a view
+        table = array('I', section.tobytes())
+        table.byteswap()
+        return table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Releases the views and unmaps the artifact"""
+        for view in (self._site_offsets, self._site_sets,
+                     self._set_primaries, self._site_roles, self._view):
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+
+    def site(self, index):
+        """Returns the site at index in the sorted site table"""
+        return self._mmap[self._strings_start + self._site_offsets[index]:
+                          self._strings_start + self._site_offsets[index + 1]
+                          ].decode('utf-8')
+
+    def find(self, site):
+        """Returns the index of site in the sorted site table, or -1
+
+        Args:
+            site: a site string, e.g. "https://example.com"
+        Returns:
+            int
+        """
+        key = site.encode('utf-8')
+        offsets, base = self._site_offsets, self._strings_start
+        mm = self._mmap
+        lo, hi = 0, self.num_sites
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[base + offsets[mid]:base + offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if (lo < self.num_sites
+                and mm[base + offsets[lo]:base + offsets[lo + 1]] == key):
+            return lo
+        return -1
+
+    def lookup(self, site):
+        """Returns the set and role of a site
+
+        Args:
+            site: a site string, e.g. "https://example.com"
+        Returns:
+            Tuple[string, string], the primary of the site's set and its role,
+            or None if the site is in no set
+        """
+        index = self.find(site)
+        if index < 0:
+            return None
+        primary = self._set_primaries[self._site_sets[index]]
+        return self.site(primary), ROLES[self._site_roles[index]]
+
+    def __contains__(self, site):
+        return self.find(site) >= 0
+
+    def __len__(self):
+        return self.num_sites
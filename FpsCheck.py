@@ -11,16 +11,42 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.     
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import json
-import requests
+import os
 from FpsSet import FpsSet
-from jsonschema import validate
-from urllib.request import urlopen
-from urllib.request import Request
+from FpsTransport import LiveTransport
+from Origin import Origin, esld_of, is_etld_plus1, parse_site
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from publicsuffix2 import PublicSuffixList
 
 WELL_KNOWN = "/.well-known/first-party-set.json"
 
+
+def compiled_schema(schema_file):
+    """Returns a validator for the schema in schema_file, compiled once per
+    version of the file
+
+        Args:
+            schema_file: the path of SCHEMA.json
+        Returns:
+            a jsonschema validator
+    """
+    stat = os.stat(schema_file)
+    return _compile_schema(os.path.abspath(schema_file), stat.st_mtime_ns,
+                           stat.st_size)
+
+
+@functools.lru_cache(maxsize=8)
+def _compile_schema(schema_file, mtime_ns, size):
+    with open(schema_file) as f:
+        schema = json.loads(f.read())
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
 class FpsCheck:
 
     """Stores and runs checks on the list of fps sites
@@ -30,6 +56,11 @@ class FpsCheck:
     submitted first party sets
     etlds: A string of effective top level domains read from public suffix list
     icanns: A set of domains associated with country codes
+    icann_cctlds: A frozenset of icanns, for the alias check
+    icann_cctlds_or_com: icann_cctlds with "com" added, the TLDs a variant of
+                         a site on a ccTLD may use
+    transport: Fetches every URL the network checks request. Defaults to a
+               LiveTransport; see FpsTransport for recording and replaying.
     schema: Static. Stores schema for format the canonical_sites should follow
     error_list: Stores all exceptions and issues generated by the checks. This
                 allows the issues to be shared in full when iterated through
@@ -38,7 +69,8 @@ class FpsCheck:
   """
     
 
-    def __init__(self, fps_sites: json, etlds: PublicSuffixList, icanns: set):
+    def __init__(self, fps_sites: json, etlds: PublicSuffixList, icanns: set,
+                 transport=None):
         """Stores the input from canonical_sites, effective_tld_names.dat, and 
         ICANN_domains into the FpsCheck object"""
         self.acceptable_fields = set(
@@ -46,13 +78,24 @@ class FpsCheck:
         self.fps_sites = fps_sites
         self.etlds = etlds
         self.icanns = icanns
+        self.icann_cctlds = frozenset(icanns)
+        self.icann_cctlds_or_com = self.icann_cctlds | {"com"}
+        # Public suffix -> its ICANN ccTLD, or None, filled in as sites are 
+        # checked
+        self.cctld_by_suffix = {}
+        self.transport = transport or LiveTransport()
         self.error_list = []
+        # Primary -> the positions of the sets listed with it, built by
+        # set_positions for the list it was built from
+        self._positions = None
+        self._positions_of = None
 
     def validate_schema(self, schema_file):
         """Validates the canonical sites list
 
-        Calls the validate function from the jsonschema package on the input 
-        from canonical_sites against our predertermined schema
+        Validates the input from canonical_sites against our predertermined 
+        schema, as the validate function from the jsonschema package does, 
+        with the schema compiled once by compiled_schema
 
         Args:
             self
@@ -62,9 +105,10 @@ class FpsCheck:
             jsonschema.exceptions.ValidationError if the schema does not match 
             the format stored in SCHEMA 
         """
-        with open(schema_file) as f:
-            SCHEMA = json.loads(f.read())
-        validate(self.fps_sites, schema = SCHEMA)
+        error = best_match(
+            compiled_schema(schema_file).iter_errors(self.fps_sites))
+        if error is not None:
+            raise error
 
     def load_sets(self):
         """Loads sets from the JSON file into a dictionary of primary->FpsSet
@@ -95,6 +139,27 @@ class FpsCheck:
         self.error_list += load_sets_errors
         return check_sets
 
+    def set_positions(self, primaries):
+        """Returns the positions in fps_sites['sets'] of the sets listed with
+        any of primaries, in list order
+
+        The positions of every primary are indexed once per list, so a check
+        run on one set at a time only looks at the sets it is given.
+
+        Args:
+            primaries: an iterable of primaries, e.g. a Dict[string, FpsSet]
+        Returns:
+            List[int]
+        """
+        sets = self.fps_sites['sets']
+        if self._positions_of != (id(sets), len(sets)):
+            self._positions = {}
+            for i, fpset in enumerate(sets):
+                self._positions.setdefault(fpset.get('primary'), []).append(i)
+            self._positions_of = (id(sets), len(sets))
+        return sorted(i for primary in primaries
+                      for i in self._positions.get(primary, ()))
+
     def has_all_rationales(self, check_sets):
         """Checks for the presence of all rationaleBySite elements in schema
 
@@ -109,9 +174,8 @@ class FpsCheck:
         Returns:
             None
         """
-        for fpset in self.fps_sites['sets']:
-            if fpset['primary'] not in  check_sets:
-                continue
+        for position in self.set_positions(check_sets):
+            fpset = self.fps_sites['sets'][position]
             sites = fpset.get("associatedSites", []) + fpset.get("serviceSites", [])
             rationales = fpset.get('rationaleBySite', None)
             if sites and rationales!=None:
@@ -187,7 +251,20 @@ class FpsCheck:
         Returns:
             boolean with truth value if the domain name begins with https://
         """
-        return site.startswith("https://")
+        return self.origin(site).scheme == "https"
+
+    def origin(self, site):
+        """Returns the parsed Origin of a site
+
+        Origins are interned, so every check gets the same object for the same
+        site instead of parsing it again.
+
+        Args:
+            site: string corresponding to a domain name
+        Returns:
+            Origin, with its suffix fields filled in from etlds
+        """
+        return Origin.parse(site, self.etlds)
 
     def find_non_https_urls(self, check_sets):
         """Checks for https:// in all sites. 
@@ -236,20 +313,18 @@ class FpsCheck:
     def is_eTLD_Plus1(self, site):
         """A helper function for checking if a domain is etld+1 compliant
 
-        calls get_public suffix from the publicsuffix2 package on the provided
-        domain name, returns true if the domain name contains a public suffix,
-        else false
+        parses the site into an Origin, whose public suffix and registrable 
+        domain come from a single lookup in the publicsuffix2 package on its 
+        punycode host, returns true if the host is a lowercase registrable 
+        domain that is not itself a public suffix, else false
 
         Args:
             site: a string corresponding to a domain name
         Returns:
-            boolean with truth value dependent on value of get_public_suffix
+            boolean with truth value dependent on value of lookup
         """
         assert site is not None
-        site = site.removeprefix("https://")
-        is_etldp1_or_etld = self.etlds.get_sld(site, strict=True) == site
-        is_etld = self.etlds.get_tld(site, strict=True) == site
-        return is_etldp1_or_etld and not is_etld
+        return self.origin(site).is_eTLD_Plus1()
     
 
     def find_invalid_eTLD_Plus1(self, check_sets):
@@ -296,18 +371,129 @@ class FpsCheck:
                             "The provided service site is not an eTLD+1: " + 
                             service_site)
 
+    def suffix_matrix(self, sites, psls):
+        """Looks up sites under several public suffix lists at once
+
+        Each distinct site is parsed, and its punycode host split into 
+        labels, once; the labels are then looked up in each list in turn.
+
+        Args:
+            sites: an iterable of strings corresponding to domain names
+            psls: a list of PublicSuffixList
+        Returns:
+            Dict[string, List[Tuple[string, string]]], the (eTLD, eTLD+1) of 
+            each site under each list, in the order of psls, with None for 
+            a host without a valid TLD
+        """
+        matrix = {}
+        for site in sites:
+            if site in matrix:
+                continue
+            labels = parse_site(site)[2].split(".")
+            matrix[site] = [psl.lookup_labels(labels, strict=True)[:2]
+                            for psl in psls]
+        return matrix
+
+    def eTLD_Plus1_verdicts(self, check_sets, psls):
+        """Evaluates is_eTLD_Plus1 for every site under several public suffix
+        lists in one pass
+
+        Args:
+            check_sets: Dict[string, FpsSet]
+            psls: a list of PublicSuffixList
+        Returns:
+            Dict[string, Tuple[bool]], whether each site, ccTLD variants 
+            included, is an eTLD+1 under each list, in the order of psls
+        """
+        sites = [site for fps in check_sets.values()
+                 for site, _role in fps.members()]
+        verdicts = {}
+        for site, lookups in self.suffix_matrix(sites, psls).items():
+            _scheme, host, punycode_host = parse_site(site)
+            verdicts[site] = tuple(
+                is_etld_plus1(host, punycode_host, etld, etld_plus1)
+                for etld, etld_plus1 in lookups)
+        return verdicts
+
+    def alias_verdicts(self, check_sets, psls):
+        """Evaluates the eSLD and country code checks of 
+        find_invalid_alias_eSLDs under several public suffix lists in one 
+        pass
+
+        Args:
+            check_sets: Dict[string, FpsSet]
+            psls: a list of PublicSuffixList
+        Returns:
+            Dict[Tuple[string, string], Tuple[bool]], for each (aliased site,
+            variant) pair, whether the variant passes under each list, in the
+            order of psls
+        """
+        pairs = [(aliased_site, site)
+                 for fps in check_sets.values() if fps.ccTLDs
+                 for aliased_site, variants in fps.ccTLDs.items()
+                 for site in variants]
+        matrix = self.suffix_matrix(
+            [site for pair in pairs for site in pair], psls)
+
+        def eslds(site):
+            labels = parse_site(site)[2].split(".")
+            return [esld_of(labels, etld, etld_plus1)
+                    for etld, etld_plus1 in matrix[site]]
+
+        verdicts = {}
+        for aliased_site, site in pairs:
+            tld = self.origin(site).tld
+            icann_ok = tld in self.allowed_alias_tlds(aliased_site)
+            verdicts[(aliased_site, site)] = tuple(
+                icann_ok and esld == aliased_esld
+                for esld, aliased_esld in zip(eslds(site),
+                                              eslds(aliased_site)))
+        return verdicts
+
+    def fetch_plan(self, check_sets, subtracted_sets=None):
+        """Lists the requests the network checks make for a set of sets
+
+        Lists what find_invalid_well_known, find_invalid_removal, 
+        find_robots_txt, find_ads_txt and check_for_service_redirect fetch, 
+        each request once, so that the responses can be fetched ahead of 
+        the checks and shared by runs that request the same URLs.
+
+        Args:
+            check_sets: Dict[string, FpsSet]
+            subtracted_sets: Dict[string, FpsSet], or None
+        Returns:
+            List[Tuple[string, string]], the transport method ("urlopen" or 
+            "get") and URL of every request
+        """
+        plan = {}
+        for primary, fps in check_sets.items():
+            plan[("urlopen", primary + WELL_KNOWN)] = None
+            for site in (fps.associated_sites or []) + (
+                    fps.service_sites or []):
+                plan[("urlopen", site + WELL_KNOWN)] = None
+            for variants in (fps.ccTLDs or {}).values():
+                for site in variants:
+                    plan[("urlopen", site + WELL_KNOWN)] = None
+        for primary in subtracted_sets or {}:
+            plan[("get", primary + WELL_KNOWN)] = None
+        for fps in check_sets.values():
+            for service_site in fps.service_sites or []:
+                plan[("get", service_site)] = None
+                plan[("get", service_site + "/ads.txt")] = None
+        return list(plan)
+
     def open_and_load_json(self, url):
         """Calls urlopen and returns json from a site
 
-        Calls urlopena and json.load on a domain. Returns the json object.
+        Calls urlopen on the transport and json.loads on the body of the 
+        response. Returns the json object.
         This functionality is separated out here to make testing easier.
         
         Args:
             url: a domain that we want to load the json from
         """
-        req = Request(url=url, headers={'User-Agent': 'Chrome'})
-        with urlopen(req) as json_file:
-            return json.load(json_file)
+        return self.transport.urlopen(
+            url, headers={'User-Agent': 'Chrome'}).json()
 
     def check_list_sites(self, primary, site_list):
         """Checks that sites in a given list have the correct primary on their 
@@ -422,7 +608,7 @@ class FpsCheck:
         for primary in subtracted_sets:
             url = primary + WELL_KNOWN
             try:
-                r = requests.get(url, timeout=10)
+                r = self.transport.get(url, timeout=10)
                 if r.status_code != 404:
                     self.error_list.append("The set associated with " + primary
                             + " was removed from the list, but " + url + 
@@ -439,6 +625,9 @@ class FpsCheck:
         If either of these is not the case, appends an error to the error_list.
         Note: A site may list a variant with "com" as its eTLD IFF the site 
         being aliased has an eTLD on ICANN's list of countrycodes. 
+        eSLDs are taken from the public suffix list, so that e.g. the eSLD 
+        of example.co.uk is example, and the allowed TLDs are looked up in 
+        the sets precomputed in __init__.
         Args:
             check_sets: Dict[string, FpsSet]
         Returns:
@@ -457,26 +646,55 @@ class FpsCheck:
                         "primary, associated site, or service site " +
                         "within the firsty pary set for " + primary)
                 # check the validity of the aliases
-                aliased_eSLD, aliased_tld = (aliased_site.split(".")[0],
-                                                aliased_site.split(".")[-1])
-                if aliased_tld in self.icanns:
-                    icann_check = self.icanns.union({"com"})
-                else:
-                    icann_check = self.icanns
-                variants = [(site, site.split(".")[0], site.split(".")[-1])
-                            for site in curr_set.ccTLDs[aliased_site]]
-                for site, eSLD, tld in variants:
-                    if eSLD != aliased_eSLD:
+                aliased_eSLD = self.origin(aliased_site).esld
+                icann_check = self.allowed_alias_tlds(aliased_site)
+                for site in curr_set.ccTLDs[aliased_site]:
+                    variant = self.origin(site)
+                    if variant.esld != aliased_eSLD:
                         self.error_list.append(
                             "The following top level domain must match: " 
                             + aliased_site + ", but is instead: " 
                             + site)
-                    if tld not in icann_check:
+                    if variant.tld not in icann_check:
                         self.error_list.append(
-                            "The provided country code: " + tld + 
+                            "The provided country code: " + variant.tld + 
                             ", in: " + site + 
                             " is not a ICANN registered country code")
 
+    def icann_cctld(self, site):
+        """Returns the ICANN country code TLD a site is under, or None
+
+        The answer is memoized by the public suffix of the site, e.g. "co.uk",
+        or by its last label when there is no public suffix list.
+
+        Args:
+            site: string corresponding to a domain name
+        Returns:
+            string or None
+        """
+        origin = self.origin(site)
+        suffix = origin.etld or origin.tld
+        try:
+            return self.cctld_by_suffix[suffix]
+        except KeyError:
+            cctld = origin.tld if origin.tld in self.icann_cctlds else None
+            self.cctld_by_suffix[suffix] = cctld
+            return cctld
+
+    def allowed_alias_tlds(self, aliased_site):
+        """Returns the precomputed set of TLDs the variants of aliased_site
+        may use: the ICANN ccTLDs, plus "com" when aliased_site is itself on 
+        a ccTLD
+
+        Args:
+            aliased_site: string corresponding to a domain name
+        Returns:
+            frozenset
+        """
+        if self.icann_cctld(aliased_site) is not None:
+            return self.icann_cctlds_or_com
+        return self.icann_cctlds
+
     def find_robots_txt(self, check_sets):
         """Checks service sites to see if they have a robots.txt subdomain.
 
@@ -500,7 +718,7 @@ class FpsCheck:
                 continue
             for service_site in check_sets[primary].service_sites:
                 try:
-                    r_service = requests.get(service_site, timeout=10)
+                    r_service = self.transport.get(service_site, timeout=10)
                     if 'X-Robots-Tag' not in r_service.headers:
                         self.error_list.append("The service site " + 
                         service_site + " does not have an X-Robots-Tag in its "
@@ -546,7 +764,7 @@ class FpsCheck:
             for service_site in check_sets[primary].service_sites:
                 ads_site = service_site + "/ads.txt"
                 try:
-                    r = requests.get(ads_site, timeout=10)
+                    r = self.transport.get(ads_site, timeout=10)
                     if r.status_code == 200:
                         self.error_list.append("The service site " + 
                         service_site + " has an ads.txt file, this violates "
@@ -580,7 +798,7 @@ class FpsCheck:
                 continue
             for service_site in check_sets[primary].service_sites:
                 try:
-                    r = requests.get(service_site, timeout=10)
+                    r = self.transport.get(service_site, timeout=10)
                     # We want the request status_code to be a 4xx or 5xx, raise
                     # an exception if it's outside that range
                     if r.status_code < 400 or r.status_code >= 600:
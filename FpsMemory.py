@@ -0,0 +1,156 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import json
+import os
+import sys
+import tracemalloc
+
+MIB = 1024 * 1024
+
+
+class MemoryCeilingExceeded(SystemExit):
+    """Raised when a stage's peak traced memory goes over the configured
+    ceiling. It is a SystemExit so that it aborts the run instead of being
+    collected like the errors of a failing check; its message is the
+    diagnosis printed on exit."""
+
+
+class StageMemory:
+    """Stores the memory accounting of one stage of a run
+
+  Attributes:
+    name: the name of the stage
+    peak_bytes: the peak traced memory while the stage ran
+    retained_bytes: the traced memory still allocated when the stage ended
+    delta_bytes: how much the stage grew the traced memory
+    top_modules: a list of (module, size_diff, count_diff) for the modules
+    whose allocations grew the most during the stage
+  """
+    def __init__(self, name, peak_bytes, retained_bytes, delta_bytes,
+                 top_modules):
+        self.name = name
+        self.peak_bytes = peak_bytes
+        self.retained_bytes = retained_bytes
+        self.delta_bytes = delta_bytes
+        self.top_modules = top_modules
+
+    def to_dict(self):
+        return {"name": self.name, "peak_bytes": self.peak_bytes,
+                "retained_bytes": self.retained_bytes,
+                "delta_bytes": self.delta_bytes,
+                "top_modules": [{"module": module, "size_diff": size,
+                                 "count_diff": count}
+                                for module, size, count in self.top_modules]}
+
+
+class MemoryReport:
+    """Attributes the memory of a check_sites run to its stages with
+    tracemalloc
+
+    tracemalloc is started when the report is created, if it is not already
+    tracing. After each stage a snapshot is compared with the one taken
+    after the previous stage, and the growth is grouped by the module that
+    made the allocations.
+
+  Attributes:
+    limit_bytes: the memory ceiling, or None; a stage whose peak goes over
+    it raises MemoryCeilingExceeded
+    top: how many allocating modules to keep per stage
+    stages: the list of StageMemory, in the order the stages ran
+  """
+    def __init__(self, limit_bytes=None, top=5):
+        self.limit_bytes = limit_bytes
+        self.top = top
+        self.stages = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+
+    @contextlib.contextmanager
+    def stage(self, name, sites=0):
+        """Accounts for the memory of the enclosed block as the stage called
+        name"""
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            self.stages.append(StageMemory(
+                name, peak, current, current - before,
+                self._top_modules(snapshot)))
+            self._snapshot = snapshot
+        if self.limit_bytes is not None and peak > self.limit_bytes:
+            raise MemoryCeilingExceeded(self.diagnosis())
+
+    def _top_modules(self, snapshot):
+        sizes = {}
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, __file__)])
+        for stat in snapshot.compare_to(self._snapshot, 'filename'):
+            module = module_name(stat.traceback[0].filename)
+            size, count = sizes.get(module, (0, 0))
+            sizes[module] = (size + stat.size_diff, count + stat.count_diff)
+        ranked = sorted(sizes.items(), key=lambda item: -item[1][0])
+        return [(module, size, count)
+                for module, (size, count) in ranked[:self.top] if size > 0]
+
+    def diagnosis(self):
+        """Describes which stage went over the ceiling and where the retained
+        memory was allocated"""
+        stage = self.stages[-1]
+        lines = ["Memory ceiling of %.1f MiB exceeded during %s: peak was "
+                 "%.1f MiB" % (self.limit_bytes / MIB, stage.name,
+                               stage.peak_bytes / MIB)]
+        lines.append("Retained after each stage:")
+        for past in self.stages:
+            lines.append("  %-28s %8.1f MiB retained (%+.1f MiB), peak "
+                         "%.1f MiB" % (past.name, past.retained_bytes / MIB,
+                                       past.delta_bytes / MIB,
+                                       past.peak_bytes / MIB))
+        lines.append("Largest allocators during " + stage.name + ":")
+        for module, size, count in stage.top_modules:
+            lines.append("  %-40s %+.1f MiB in %d blocks" % (
+                module, size / MIB, count))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        """Writes the per-stage accounting to path"""
+        with open(path, 'w') as f:
+            json.dump({"limit_bytes": self.limit_bytes,
+                       "stages": [stage.to_dict() for stage in self.stages]},
+                      f, indent=2)
+
+
+def module_name(filename):
+    """Returns the dotted module name for a source file on sys.path, or the
+    file's base name when it is not on sys.path"""
+    if filename.startswith("<"):
+        # e.g. <frozen importlib._bootstrap> or <string>
+        return filename
+    filename = os.path.abspath(filename)
+    best = ""
+    for entry in sys.path:
+        entry = os.path.abspath(entry or os.curdir)
+        if filename.startswith(entry + os.sep) and len(entry) > len(best):
+            best = entry
+    relative = filename[len(best) + 1:] if best else os.path.basename(
+        filename)
+    module = os.path.splitext(relative)[0].replace(os.sep, ".")
+    if module.endswith(".__init__"):
+        module = module[:-len(".__init__")]
+    return module
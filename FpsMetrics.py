@@ -0,0 +1,186 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+# Upper bounds, in seconds, of the per-host latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class StageMetrics:
+    """Stores the measurements taken for one stage or check of a run
+
+  Attributes:
+    name: the name of the stage, e.g. "schema" or "find_robots_txt"
+    wall_s: the elapsed wall-clock time of the stage in seconds
+    cpu_s: the CPU time of the process during the stage in seconds
+    sites: the number of sites the stage examined
+    http_requests: the number of requests the stage made
+    bytes_downloaded: the number of response body bytes the stage read
+    errors: the number of errors the stage produced
+  """
+    def __init__(self, name, sites=0):
+        self.name = name
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.sites = sites
+        self.http_requests = 0
+        self.bytes_downloaded = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {"name": self.name, "wall_s": self.wall_s,
+                "cpu_s": self.cpu_s, "sites": self.sites,
+                "http_requests": self.http_requests,
+                "bytes_downloaded": self.bytes_downloaded,
+                "errors": self.errors}
+
+
+class HostHistogram:
+    """A cumulative latency histogram for the requests made to one host"""
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        return {"buckets": dict(zip(map(str, LATENCY_BUCKETS), self.counts)),
+                "count": self.count, "sum": self.sum}
+
+
+class RunMetrics:
+    """Collects timings and counters for each stage of a check_sites run
+
+    Wrap each stage in stage() and pass the RunMetrics as an observer of an
+    ObservedTransport so that every fetch is attributed to the stage that
+    made it.
+
+  Attributes:
+    stages: the list of StageMetrics, in the order the stages ran
+    hosts: a dictionary of host->HostHistogram of request latencies
+    error_count: a callable returning the number of errors produced so far;
+    stage() attributes the difference across a stage to that stage
+  """
+    def __init__(self):
+        self.stages = []
+        self.hosts = {}
+        self.error_count = lambda: 0
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name, sites=0):
+        """Measures the enclosed block as the stage called name"""
+        metrics = StageMetrics(name, sites)
+        previous, self._current = self._current, metrics
+        errors_before = self.error_count()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_s = time.perf_counter() - wall_start
+            metrics.cpu_s = time.process_time() - cpu_start
+            metrics.errors = self.error_count() - errors_before
+            self._current = previous
+            self.stages.append(metrics)
+
+    def on_fetch(self, fetch):
+        """Records a completed Fetch from an ObservedTransport"""
+        if self._current is not None:
+            self._current.http_requests += 1
+            self._current.bytes_downloaded += fetch.nbytes
+        host = urlsplit(fetch.url).hostname or ""
+        self.hosts.setdefault(host, HostHistogram()).observe(fetch.elapsed)
+
+    def to_dict(self):
+        return {"stages": [stage.to_dict() for stage in self.stages],
+                "hosts": {host: hist.to_dict()
+                          for host, hist in sorted(self.hosts.items())}}
+
+    def write_json(self, path):
+        """Writes the JSON summary of the run to path"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """Writes the metrics in the Prometheus textfile exposition format
+
+        The file is written to a temporary name and renamed into place, as
+        the node_exporter textfile collector expects. A stage that ran more
+        than once, like the checks of every submission of a --batch run, is
+        written as one series adding up its runs, since the collector
+        rejects a file that repeats a series.
+        """
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage.name, StageMetrics(stage.name))
+            for attr in ("wall_s", "cpu_s", "sites", "http_requests",
+                         "bytes_downloaded", "errors"):
+                setattr(total, attr, getattr(total, attr)
+                        + getattr(stage, attr))
+        lines = []
+        gauges = [
+            ("wall_seconds", "Wall time spent in the stage", "wall_s"),
+            ("cpu_seconds", "CPU time spent in the stage", "cpu_s"),
+            ("sites", "Sites examined by the stage", "sites"),
+            ("http_requests", "HTTP requests made by the stage",
+             "http_requests"),
+            ("bytes_downloaded", "Response bytes read by the stage",
+             "bytes_downloaded"),
+            ("errors", "Errors produced by the stage", "errors"),
+        ]
+        for suffix, help_text, attr in gauges:
+            metric = "fps_stage_" + suffix
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s gauge" % metric)
+            for stage in totals.values():
+                lines.append('%s{stage="%s"} %s' % (
+                    metric, stage.name, _format(getattr(stage, attr))))
+        metric = "fps_http_request_duration_seconds"
+        lines.append("# HELP %s Latency of requests made by the network "
+                     "checks" % metric)
+        lines.append("# TYPE %s histogram" % metric)
+        for host, hist in sorted(self.hosts.items()):
+            host = _escape(host)
+            for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+                lines.append('%s_bucket{host="%s",le="%s"} %d' % (
+                    metric, host, bound, count))
+            lines.append('%s_bucket{host="%s",le="+Inf"} %d' % (
+                metric, host, hist.count))
+            lines.append('%s_sum{host="%s"} %s' % (
+                metric, host, _format(hist.sum)))
+            lines.append('%s_count{host="%s"} %d' % (metric, host,
+                                                     hist.count))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(label):
+    return label.replace("\\", "\\\\").replace('"', '\\"')
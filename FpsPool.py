@@ -0,0 +1,116 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import multiprocessing
+
+# The checks of FpsCheck that make no requests, and only read the list, the
+# public suffix list and the ICANN domains
+OFFLINE_CHECKS = frozenset([
+    'has_all_rationales',
+    'find_non_https_urls',
+    'find_invalid_eTLD_Plus1',
+    'find_invalid_alias_eSLDs',
+])
+# The number of chunks the sets are split into for each worker, so that a
+# worker that finishes early takes over some of the remaining work
+CHUNKS_PER_JOB = 4
+
+
+class WorkerError(Exception):
+    """Raised in the parent with the message of an exception a check raised
+    in a worker, so it is reported as if the check had run in the parent"""
+
+
+# The FpsCheck, check_sets and list of primaries of a worker process
+_WORKER = None
+
+
+def _set_worker(fps_checker, check_sets):
+    global _WORKER
+    if fps_checker is None:
+        # forked: the parent set the worker state before starting the pool
+        return
+    _WORKER = (fps_checker, check_sets, list(check_sets))
+
+
+def _run_chunk(task):
+    name, start, stop = task
+    fps_checker, check_sets, primaries = _WORKER
+    fps_checker.error_list = []
+    try:
+        getattr(fps_checker, name)(
+            {primary: check_sets[primary] for primary in primaries[start:stop]})
+    except Exception as inst:
+        return fps_checker.error_list, str(inst)
+    return fps_checker.error_list, None
+
+
+class CheckPool:
+    """Runs the offline checks of an FpsCheck on a pool of processes
+
+    The workers are forked once the list, the public suffix list and the
+    ICANN domains are loaded into the FpsCheck, so they share them with the
+    parent copy-on-write instead of loading or receiving their own. Each
+    check is run on contiguous chunks of the sets, and the errors of the
+    chunks are appended to the error_list of the FpsCheck in the order of the
+    sets, as if the check had run on all of them in the parent. Where fork is
+    not available, each worker is sent its own copy of the FpsCheck instead.
+    Use it as a context manager, or call close().
+
+  Attributes:
+    fps_checker: the FpsCheck the checks run on
+    jobs: the number of worker processes
+  """
+    def __init__(self, fps_checker, check_sets, jobs,
+                 chunks_per_job=CHUNKS_PER_JOB):
+        self.fps_checker = fps_checker
+        self.jobs = jobs
+        num_sets = len(check_sets)
+        num_chunks = max(1, min(num_sets, jobs * chunks_per_job))
+        bounds = [num_sets * i // num_chunks for i in range(num_chunks + 1)]
+        self._chunks = list(zip(bounds, bounds[1:]))
+        try:
+            context = multiprocessing.get_context('fork')
+            init_args = (None, None)
+            _set_worker(fps_checker, check_sets)
+        except ValueError:
+            context = multiprocessing.get_context()
+            init_args = (fps_checker, check_sets)
+        self._pool = context.Pool(jobs, _set_worker, init_args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stops the workers"""
+        global _WORKER
+        self._pool.terminate()
+        self._pool.join()
+        _WORKER = None
+
+    def run(self, name):
+        """Runs the check called name on every set
+
+        Raises:
+            WorkerError if the check raised an exception, after the errors
+            of the sets before it were appended, as when the check stops at
+            that set in the parent
+        """
+        tasks = [(name, start, stop) for start, stop in self._chunks]
+        for errors, error in self._pool.imap(_run_chunk, tasks):
+            self.fps_checker.error_list.extend(errors)
+            if error is not None:
+                raise WorkerError(error)
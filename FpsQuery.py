@@ -0,0 +1,139 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from array import array
+
+
+class SetIndex:
+    """Answers same-set queries about the sites of a list in constant time
+
+    Every member site, ccTLD variants included, is joined with the primary
+    of its set in a union-find forest, and each resulting component is given
+    a dense set ID from 0 in the order the sets were listed. A list that
+    failed check_exclusivity may share a site between sets; those sets are
+    merged into one component, as a browser reading the list would have to.
+
+  Attributes:
+    set_ids: a dictionary of site->set ID
+    roles: a dictionary of site->role, the first role the site was listed
+    with, as in FpsSet.members()
+    primaries: a list of the primary of each set ID; when sets were merged,
+    the primary of the first of them
+  """
+    def __init__(self, check_sets):
+        parent = {}
+
+        def find(site):
+            root = site
+            while parent[root] != root:
+                root = parent[root]
+            # Compress the path so later finds are a single step
+            while parent[site] != root:
+                parent[site], site = root, parent[site]
+            return root
+
+        # the position of the set each root was listed as the primary of
+        positions = {}
+        self.roles = {}
+        for position, fps in enumerate(check_sets.values()):
+            if fps.primary not in parent:
+                parent[fps.primary] = fps.primary
+                positions[fps.primary] = position
+            for site, role in fps.members():
+                self.roles.setdefault(site, role)
+                if site not in parent:
+                    parent[site] = fps.primary
+                else:
+                    site_root, primary_root = find(site), find(fps.primary)
+                    if site_root != primary_root:
+                        # keep the earliest listed set as the root, whatever
+                        # order the sets are joined in
+                        if positions[site_root] > positions[primary_root]:
+                            site_root, primary_root = primary_root, site_root
+                        parent[primary_root] = site_root
+
+        self.set_ids = {}
+        self.primaries = []
+        root_ids = {}
+        for site in parent:
+            root = find(site)
+            if root not in root_ids:
+                root_ids[root] = len(self.primaries)
+                self.primaries.append(root)
+            self.set_ids[site] = root_ids[root]
+
+    def __len__(self):
+        return len(self.primaries)
+
+    def set_id(self, site):
+        """Returns the set ID of a site, or -1 if it is in no set"""
+        return self.set_ids.get(site, -1)
+
+    def set_of(self, site):
+        """Returns the primary of the set a site belongs to, or None"""
+        set_id = self.set_ids.get(site, -1)
+        return self.primaries[set_id] if set_id >= 0 else None
+
+    def role_of(self, site):
+        """Returns the role of a site, or None if it is in no set"""
+        return self.roles.get(site)
+
+    def lookup(self, site):
+        """Returns (primary, role) for a site, or None if it is in no set, like
+        FpsArtifact.lookup"""
+        set_id = self.set_ids.get(site, -1)
+        if set_id < 0:
+            return None
+        return self.primaries[set_id], self.roles[site]
+
+    def same_set(self, site_a, site_b):
+        """Returns whether two sites are members of the same set
+
+        Args:
+            site_a: a site string, e.g. "https://example.com"
+            site_b: a site string
+        Returns:
+            boolean, False when either site is in no set
+        """
+        set_id = self.set_ids.get(site_a, -1)
+        return set_id >= 0 and set_id == self.set_ids.get(site_b, -2)
+
+    def set_ids_of(self, sites):
+        """Returns the set IDs of many sites, -1 for those in no set
+
+        Args:
+            sites: an iterable of site strings
+        Returns:
+            array of signed ints
+        """
+        get = self.set_ids.get
+        return array('i', [get(site, -1) for site in sites])
+
+    def same_set_many(self, sites_a, sites_b):
+        """Answers same_set for every pair of sites_a[i] and sites_b[i]
+
+        Args:
+            sites_a: a sequence of site strings
+            sites_b: a sequence of site strings of the same length
+        Returns:
+            List[bool]
+        Raises:
+            ValueError if the sequences are not the same length
+        """
+        if len(sites_a) != len(sites_b):
+            raise ValueError("Expected as many sites in both sequences, got "
+                             + str(len(sites_a)) + " and "
+                             + str(len(sites_b)))
+        ids_a = self.set_ids_of(sites_a)
+        ids_b = self.set_ids_of(sites_b)
+        return [id_a >= 0 and id_a == id_b for id_a, id_b in zip(ids_a, ids_b)]
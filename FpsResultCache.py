@@ -0,0 +1,166 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import sqlite3
+import time
+
+# The version of each check's results. Bump a check's version whenever it
+# changes what it reports, so that results cached by the old code are not
+# reused.
+CHECK_VERSIONS = {
+    'has_all_rationales': 1,
+    'find_non_https_urls': 1,
+    'find_invalid_eTLD_Plus1': 1,
+    'find_invalid_well_known': 1,
+    'find_invalid_alias_eSLDs': 1,
+    'find_robots_txt': 1,
+    'find_ads_txt': 1,
+    'check_for_service_redirect': 1,
+}
+# The checks whose results depend on what the sites serve, and so expire
+NETWORK_CHECKS = frozenset([
+    'find_invalid_well_known',
+    'find_robots_txt',
+    'find_ads_txt',
+    'check_for_service_redirect',
+])
+# How long the results of network checks are reused for, in seconds
+MAX_AGE = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    set_hash TEXT NOT NULL,
+    check_name TEXT NOT NULL,
+    check_version INTEGER NOT NULL,
+    psl_hash TEXT NOT NULL,
+    icann_hash TEXT NOT NULL,
+    schema_hash TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    errors TEXT NOT NULL,
+    PRIMARY KEY (set_hash, check_name, check_version, psl_hash, icann_hash,
+                 schema_hash)
+)
+"""
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def set_fingerprint(fpset):
+    """Returns a SHA-256 hex digest of a set as listed in
+    first_party_sets.JSON, which is the same however its keys are ordered
+
+        Args:
+            fpset: the dictionary of the set
+        Returns:
+            string
+    """
+    content = json.dumps(fpset, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Stores the errors each check found for each set in a sqlite database
+
+    Results are keyed by the fingerprint of the set, the name and version of
+    the check and the hashes of the public suffix list, ICANN domains and
+    schema they were found with, so a result is only reused when nothing it
+    depends on has changed. The results of NETWORK_CHECKS are reused for
+    max_age seconds. Use it as a context manager, or call close(), to save
+    the results.
+
+  Attributes:
+    path: the path of the database
+    max_age: how many seconds the results of network checks are reused for
+    hits: the number of results that were reused
+    misses: the number of results that were not cached or had expired
+  """
+    def __init__(self, path, psl_file, icann_file, schema_file,
+                 max_age=MAX_AGE, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._inputs = (file_hash(psl_file), file_hash(icann_file),
+                        file_hash(schema_file))
+        self._clock = clock
+        self._db = sqlite3.connect(path)
+        self._db.execute(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Saves the stored results and closes the database"""
+        self._db.commit()
+        self._db.close()
+
+    def get(self, set_hash, check_name):
+        """Returns the cached errors of a check for a set
+
+        Args:
+            set_hash: the set_fingerprint of the set
+            check_name: the name of the check, a key of CHECK_VERSIONS
+        Returns:
+            List[string], or None if there is no result to reuse
+        """
+        row = self._db.execute(
+            "SELECT checked_at, errors FROM results WHERE set_hash = ? AND "
+            "check_name = ? AND check_version = ? AND psl_hash = ? AND "
+            "icann_hash = ? AND schema_hash = ?",
+            (set_hash, check_name, CHECK_VERSIONS[check_name])
+            + self._inputs).fetchone()
+        if row is None or (check_name in NETWORK_CHECKS
+                           and self._clock() - row[0] > self.max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, set_hash, check_name, errors):
+        """Stores the errors a check found for a set"""
+        self._db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (set_hash, check_name, CHECK_VERSIONS[check_name])
+            + self._inputs + (self._clock(), json.dumps(errors)))
+
+    def prune(self):
+        """Deletes the results found with other reference files or check
+        versions, and the expired results of network checks
+
+        Returns:
+            int, the number of results deleted
+        """
+        deleted = self._db.execute(
+            "DELETE FROM results WHERE psl_hash != ? OR icann_hash != ? OR "
+            "schema_hash != ?", self._inputs).rowcount
+        for check_name, version in CHECK_VERSIONS.items():
+            deleted += self._db.execute(
+                "DELETE FROM results WHERE check_name = ? AND "
+                "check_version != ?", (check_name, version)).rowcount
+        deleted += self._db.execute(
+            "DELETE FROM results WHERE check_name IN (%s) AND checked_at < ?"
+            % ",".join("?" * len(NETWORK_CHECKS)),
+            sorted(NETWORK_CHECKS) + [self._clock() - self.max_age]).rowcount
+        return deleted
@@ -0,0 +1,117 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from FpsFiles import write_atomically
+import json
+import math
+import os
+import time
+
+STATE_VERSION = 1
+# Every set is checked again at least once in this many days
+PERIOD_DAYS = 7
+DAY = 24 * 60 * 60
+
+
+class RollingScheduler:
+    """Chooses the slice of the list each run of a rolling revalidation
+    checks, so every set is checked once per period with a flat daily load
+
+    Meant to be run once a day. By default a run checks
+    ceil(number of sets / period_days) sets, so the whole list is covered
+    within the period however it grows. Sets are taken in order of priority:
+    sets never checked or changed since they were, then sets not checked for
+    a whole period, then sets that failed when last checked, then the rest;
+    the least recently checked first within each group. The time, outcome
+    and fingerprint of each set's last check are kept in state_file between
+    runs.
+
+  Attributes:
+    state_file: the path of the JSON state
+    period_days: the number of days within which every set is checked
+    budget: the number of sets a run checks, or None for the default
+    state: a dictionary of primary->{"fingerprint", "checked_at",
+    "failures"}, where failures counts the consecutive failed checks
+  """
+    def __init__(self, state_file, period_days=PERIOD_DAYS, budget=None,
+                 clock=time.time):
+        self.state_file = state_file
+        self.period_days = period_days
+        self.budget = budget
+        self.state = {}
+        self._clock = clock
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                saved = json.load(f)
+            if saved.get("version") == STATE_VERSION:
+                self.state = saved["sets"]
+
+    def run_budget(self, num_sets):
+        """Returns the number of sets a run over num_sets sets checks"""
+        if self.budget is not None:
+            return self.budget
+        return math.ceil(num_sets / self.period_days)
+
+    def priority(self, primary, fingerprint, now):
+        """Returns the sort key of a set, lowest first"""
+        entry = self.state.get(primary)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return (0, 0.0)
+        if now - entry["checked_at"] >= self.period_days * DAY:
+            group = 1
+        elif entry["failures"]:
+            group = 2
+        else:
+            group = 3
+        return (group, entry["checked_at"])
+
+    def select(self, fingerprints):
+        """Chooses the sets this run checks
+
+        Args:
+            fingerprints: an ordered dictionary of primary->set_fingerprint of
+            every set that may be checked
+        Returns:
+            List[string], the primaries of the chosen sets, in list order
+        """
+        now = self._clock()
+        ranked = sorted(fingerprints, key=lambda primary: self.priority(
+            primary, fingerprints[primary], now))
+        chosen = set(ranked[:self.run_budget(len(fingerprints))])
+        return [primary for primary in fingerprints if primary in chosen]
+
+    def record(self, fingerprints, errors_by_set):
+        """Records the outcome of the checks of this run, and forgets the
+        sets that are no longer listed
+
+        Args:
+            fingerprints: the dictionary of primary->set_fingerprint of every
+            set of the list
+            errors_by_set: a dictionary of primary->list of errors for the
+            sets this run checked
+        """
+        now = self._clock()
+        self.state = {primary: entry for primary, entry in self.state.items()
+                      if primary in fingerprints}
+        for primary, errors in errors_by_set.items():
+            entry = self.state.get(primary, {"failures": 0})
+            self.state[primary] = {
+                "fingerprint": fingerprints[primary],
+                "checked_at": now,
+                "failures": entry["failures"] + 1 if errors else 0}
+
+    def save(self):
+        """Writes the state to state_file"""
+        write_atomically(self.state_file, json.dumps(
+            {"version": STATE_VERSION, "sets": self.state},
+            indent=1, sort_keys=True).encode("utf-8"))
@@ -50,4 +50,18 @@ class FpsSet:
            return True
        if with_ccTLDs:
            return domain in (variant for variant_list in self.ccTLDs.values() for variant in variant_list)
-       return False
\ No newline at end of file
+       return False
+
+    def members(self):
+       """Yields (site, role) for every site in the set, in the order of the 
+       primary, associated sites, service sites and then ccTLD variants. The 
+       role is one of "primary", "associated", "service" or "ccTLD".
+       """
+       yield self.primary, "primary"
+       for site in self.associated_sites or []:
+           yield site, "associated"
+       for site in self.service_sites or []:
+           yield site, "service"
+       for variant_list in (self.ccTLDs or {}).values():
+           for variant in variant_list:
+               yield variant, "ccTLD"
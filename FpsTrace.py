@@ -0,0 +1,160 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class StageProfiler:
+    """Runs each stage of a check_sites run under cProfile
+
+    The stats of every stage are written to their own pstats file in
+    output_dir, named after the position and name of the stage, e.g.
+    03_schema.pstats, for loading with pstats or snakeviz.
+
+  Attributes:
+    output_dir: the directory the pstats files are written to
+    files: the list of pstats files written so far
+  """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.files = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def stage(self, name, sites=0):
+        """Profiles the enclosed block as the stage called name"""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            path = os.path.join(self.output_dir, "%02d_%s.pstats" % (
+                len(self.files), name))
+            profile.dump_stats(path)
+            self.files.append(path)
+
+
+class TraceRecorder:
+    """Records spans of a check_sites run as Chrome trace events
+
+    Stages and checks, the sets each check visits and every HTTP fetch are
+    written as complete ("X") events, which chrome://tracing and Perfetto
+    nest by time on each thread. Fetch spans are split into queue wait,
+    connect, TLS and time-to-first-byte children when the transport has its
+    phase timers installed.
+
+  Attributes:
+    trace_file: the path the trace is written to by save()
+    events: the list of recorded trace events
+  """
+    def __init__(self, trace_file):
+        self.trace_file = trace_file
+        self.events = []
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _micros(self, timestamp):
+        return (timestamp - self._origin) * 1e6
+
+    def add_span(self, name, category, start, duration, args=None):
+        """Adds a complete event starting at the time.perf_counter() value
+        start and lasting duration seconds"""
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": self._micros(start), "dur": duration * 1e6,
+                 "pid": self._pid, "tid": threading.get_ident()}
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        """Records the enclosed block as a span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.perf_counter() - start,
+                          args)
+
+    def stage(self, name, sites=0):
+        """Records the enclosed block as the stage called name"""
+        return self.span(name, "stage", {"sites": sites})
+
+    def traced_sets(self, check_sets):
+        """Returns check_sets wrapped so that every set a check visits, by
+        iterating over the primaries or the items, is recorded as a span
+
+        Args:
+            check_sets: Dict[string, FpsSet]
+        Returns:
+            Dict[string, FpsSet]
+        """
+        return _TracedSets(self, check_sets)
+
+    def on_fetch(self, fetch):
+        """Records a completed Fetch from an ObservedTransport"""
+        parts = urlsplit(fetch.url)
+        args = {"url": fetch.url, "status": fetch.status,
+                "bytes": fetch.nbytes}
+        if fetch.error:
+            args["error"] = fetch.error
+        self.add_span((parts.hostname or "") + parts.path, "http",
+                      fetch.start - fetch.queue_s,
+                      fetch.queue_s + fetch.elapsed, args)
+        cursor = fetch.start - fetch.queue_s
+        phases = [("queue", fetch.queue_s), ("connect", fetch.connect_s),
+                  ("tls", fetch.tls_s)]
+        if fetch.first_byte_s is not None:
+            phases.append(("first_byte", fetch.first_byte_s
+                           - fetch.connect_s - fetch.tls_s))
+        for phase, duration in phases:
+            if duration > 0:
+                self.add_span(phase, "http_phase", cursor, duration)
+                cursor += duration
+
+    def save(self):
+        """Writes the recorded events to trace_file"""
+        with open(self.trace_file, 'w') as f:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, f)
+
+
+class _TracedSets(dict):
+    """A dictionary of primary->FpsSet whose iteration records a "set" span
+    around the work done for each primary"""
+
+    def __init__(self, tracer, check_sets):
+        super().__init__(check_sets)
+        self._tracer = tracer
+
+    def _spans(self, entries):
+        for key, entry in entries:
+            with self._tracer.span(key, "set"):
+                yield entry
+
+    def __iter__(self):
+        keys = super().keys()
+        return self._spans((key, key) for key in keys)
+
+    def items(self):
+        items = super().items()
+        return self._spans((key, (key, fps)) for key, fps in items)
@@ -0,0 +1,401 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import collections
+import http.client
+import json
+import requests
+import socket
+import ssl
+import threading
+import time
+from requests import structures
+from urllib.request import urlopen
+from urllib.request import Request
+
+CASSETTE_VERSION = 1
+
+
+class Response:
+    """A recorded HTTP response, shaped like the parts of requests.Response
+    that the checks in FpsCheck read
+
+  Attributes:
+    url: the final URL of the response, after any redirects
+    status_code: the integer status code of the response
+    headers: a case-insensitive dictionary of the response headers
+    content: the body of the response as bytes
+  """
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = structures.CaseInsensitiveDict(headers or {})
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ReplayedError(Exception):
+    """An exception recorded in a cassette and raised again on replay. Its
+    message is that of the original exception, so checks that inspect the
+    text of an error behave as they did when the cassette was recorded."""
+
+
+class CassetteMissError(Exception):
+    """Raised when a replayed run requests a URL the cassette never saw"""
+
+
+class LiveTransport:
+    """Fetches URLs from the network
+
+    get() goes through requests and urlopen() through urllib, matching how
+    the checks have always fetched each kind of resource, so the error
+    messages they produce are unchanged.
+    """
+    def get(self, url, **kwargs):
+        """Calls requests.get and returns its requests.Response"""
+        return requests.get(url, **kwargs)
+
+    def urlopen(self, url, headers=None):
+        """Calls urlopen on url and returns a Response
+
+        Raises:
+            urllib.error.URLError (or HTTPError for error statuses) as urlopen
+            does
+        """
+        req = Request(url=url, headers=headers or {})
+        with urlopen(req) as res:
+            return Response(res.geturl(), res.status, dict(res.headers),
+                            res.read())
+
+
+class PooledTransport(LiveTransport):
+    """Fetches URLs from the network like a LiveTransport, but get() goes
+    through a requests.Session per thread, so connections to a host are kept
+    alive and reused across requests and runs
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, url, **kwargs):
+        """Calls get on this thread's requests.Session"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session.get(url, **kwargs)
+
+
+class _CacheEntry:
+    def __init__(self):
+        self.done = threading.Event()
+        self.fetched_at = None
+        self.response = None
+        self.error = None
+
+
+class CachingTransport:
+    """Fetches through another transport and reuses each response, or
+    exception, for max_age seconds
+
+    Requests are keyed on method and URL. Concurrent requests for a URL that
+    is being fetched wait for that fetch instead of making their own, so
+    runs sharing the transport fetch each URL once.
+
+  Attributes:
+    inner: the transport that actually fetches
+    max_age: how many seconds a response is reused for
+    max_entries: how many responses are kept, the oldest evicted first
+    hits: the number of requests answered from the cache
+    misses: the number of requests that were fetched
+  """
+    def __init__(self, inner=None, max_age=300.0, max_entries=10000):
+        self.inner = inner or LiveTransport()
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fetch(self, method, url, fetch):
+        key = (method, url)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and (
+                entry.fetched_at is None
+                or now - entry.fetched_at <= self.max_age)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = self._entries[key] = _CacheEntry()
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if fresh:
+            entry.done.wait()
+        else:
+            try:
+                entry.response = fetch()
+            except Exception as inst:
+                entry.error = inst
+            entry.fetched_at = time.monotonic()
+            entry.done.set()
+        if entry.error is not None:
+            raise entry.error
+        return entry.response
+
+    def clear(self):
+        """Forgets every cached response"""
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, url, **kwargs):
+        return self._fetch("get", url, lambda: self.inner.get(url, **kwargs))
+
+    def urlopen(self, url, headers=None):
+        return self._fetch(
+            "urlopen", url, lambda: self.inner.urlopen(url, headers))
+
+
+class RecordingTransport:
+    """Fetches through another transport and records every interaction
+
+    Each response (status, headers, final URL and body) or exception is
+    appended to a cassette, which save() writes to cassette_file for a
+    ReplayTransport to serve later.
+
+  Attributes:
+    inner: the transport that actually fetches, usually a LiveTransport
+    cassette_file: the path the cassette is written to
+    interactions: the list of recorded interactions, in request order
+  """
+    def __init__(self, cassette_file, inner=None):
+        self.cassette_file = cassette_file
+        self.inner = inner or LiveTransport()
+        self.interactions = []
+
+    def _record(self, method, url, fetch):
+        entry = {"method": method, "url": url}
+        try:
+            response = fetch()
+        except Exception as inst:
+            entry["error"] = {"type": type(inst).__name__,
+                              "message": str(inst)}
+            self.interactions.append(entry)
+            raise
+        entry.update({
+            "status": response.status_code,
+            "final_url": response.url,
+            "headers": dict(response.headers),
+            "body": base64.b64encode(response.content).decode('ascii'),
+        })
+        self.interactions.append(entry)
+        return response
+
+    def get(self, url, **kwargs):
+        return self._record(
+            "get", url, lambda: self.inner.get(url, **kwargs))
+
+    def urlopen(self, url, headers=None):
+        return self._record(
+            "urlopen", url, lambda: self.inner.urlopen(url, headers))
+
+    def save(self):
+        """Writes the recorded interactions to cassette_file"""
+        with open(self.cassette_file, 'w') as f:
+            json.dump({"version": CASSETTE_VERSION,
+                       "interactions": self.interactions}, f, indent=1)
+
+
+class Fetch:
+    """Describes a single completed request made through an
+    ObservedTransport
+
+  Attributes:
+    method: "get" or "urlopen", the transport method that was called
+    url: the requested URL
+    start: the time.perf_counter() value when the request started
+    elapsed: the duration of the request in seconds
+    status: the status code of the response, or None if it raised
+    nbytes: the length of the response body
+    error: the message of the exception the request raised, or None
+    queue_s: how long the request waited between being queued with
+    ObservedTransport.mark_queued() and starting
+    connect_s: time spent opening TCP connections, when phase timers are
+    installed
+    tls_s: time spent in TLS handshakes, when phase timers are installed
+    first_byte_s: time from the start of the request until the first
+    response headers were read, when phase timers are installed
+  """
+    def __init__(self, method, url, start):
+        self.method = method
+        self.url = url
+        self.start = start
+        self.elapsed = 0.0
+        self.status = None
+        self.nbytes = 0
+        self.error = None
+        self.queue_s = 0.0
+        self.connect_s = 0.0
+        self.tls_s = 0.0
+        self.first_byte_s = None
+
+
+# The Fetch in progress on each thread, which the phase timers report into
+_phase_local = threading.local()
+_phase_timers_installed = False
+
+
+def _timed_phase(fn, attr):
+    def wrapper(self, *args, **kwargs):
+        fetch = getattr(_phase_local, 'fetch', None)
+        start = time.perf_counter()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            if fetch is not None:
+                now = time.perf_counter()
+                if attr == 'first_byte_s':
+                    if fetch.first_byte_s is None:
+                        fetch.first_byte_s = now - fetch.start
+                else:
+                    setattr(fetch, attr, getattr(fetch, attr) + now - start)
+    return wrapper
+
+
+def install_phase_timers():
+    """Times the connect, TLS and first-byte phases of every request
+
+    Wraps socket connects, TLS handshakes and the reading of response
+    headers, which both requests and urllib go through, so that the Fetch
+    reported by an ObservedTransport on the same thread has its connect_s,
+    tls_s and first_byte_s filled in. Installing is process-wide and only
+    happens once.
+    """
+    global _phase_timers_installed
+    if _phase_timers_installed:
+        return
+    socket.socket.connect = _timed_phase(socket.socket.connect, 'connect_s')
+    ssl.SSLSocket.do_handshake = _timed_phase(
+        ssl.SSLSocket.do_handshake, 'tls_s')
+    http.client.HTTPResponse.begin = _timed_phase(
+        http.client.HTTPResponse.begin, 'first_byte_s')
+    _phase_timers_installed = True
+
+
+class ObservedTransport:
+    """Fetches through another transport and reports every request
+
+    After each request, successful or not, on_fetch(fetch) is called on each
+    of the observers with a Fetch describing it.
+
+  Attributes:
+    inner: the transport that actually fetches
+    observers: a list of objects with an on_fetch(fetch) method
+  """
+    def __init__(self, inner=None, observers=None):
+        self.inner = inner or LiveTransport()
+        self.observers = observers or []
+        self._queued = {}
+
+    def mark_queued(self, url):
+        """Notes that a request for url has been queued, so that its Fetch
+        reports the time it waited before starting"""
+        self._queued.setdefault(url, time.perf_counter())
+
+    def _observe(self, method, url, fetch):
+        record = Fetch(method, url, time.perf_counter())
+        queued = self._queued.pop(url, None)
+        if queued is not None:
+            record.queue_s = record.start - queued
+        _phase_local.fetch = record
+        try:
+            response = fetch()
+            record.status = response.status_code
+            record.nbytes = len(getattr(response, "content", None) or b"")
+            return response
+        except Exception as inst:
+            record.error = str(inst)
+            raise
+        finally:
+            record.elapsed = time.perf_counter() - record.start
+            _phase_local.fetch = None
+            for observer in self.observers:
+                observer.on_fetch(record)
+
+    def get(self, url, **kwargs):
+        return self._observe(
+            "get", url, lambda: self.inner.get(url, **kwargs))
+
+    def urlopen(self, url, headers=None):
+        return self._observe(
+            "urlopen", url, lambda: self.inner.urlopen(url, headers))
+
+
+def mark_queued(transport, url):
+    """Notes that a request for url has been queued on every
+    ObservedTransport in a chain of transports linked by their inner
+    attribute, so that the Fetch they report includes the time it waited"""
+    while transport is not None:
+        if isinstance(transport, ObservedTransport):
+            transport.mark_queued(url)
+        transport = getattr(transport, 'inner', None)
+
+
+class ReplayTransport:
+    """Serves responses from a cassette written by a RecordingTransport
+
+    Interactions are matched on method and URL. When a URL was fetched
+    several times they are served in the recorded order, and the last one is
+    repeated once they run out.
+
+  Attributes:
+    cassette_file: the path the cassette was read from
+  """
+    def __init__(self, cassette_file):
+        self.cassette_file = cassette_file
+        with open(cassette_file) as f:
+            cassette = json.load(f)
+        if cassette.get("version") != CASSETTE_VERSION:
+            raise ValueError("Unsupported cassette version in "
+                             + cassette_file)
+        self._interactions = {}
+        for entry in cassette["interactions"]:
+            self._interactions.setdefault(
+                (entry["method"], entry["url"]), []).append(entry)
+
+    def _replay(self, method, url):
+        entries = self._interactions.get((method, url))
+        if not entries:
+            raise CassetteMissError(
+                "No recorded response for " + method + " " + url + " in "
+                + self.cassette_file)
+        entry = entries.pop(0) if len(entries) > 1 else entries[0]
+        if "error" in entry:
+            raise ReplayedError(entry["error"]["message"])
+        return Response(entry["final_url"], entry["status"], entry["headers"],
+                        base64.b64decode(entry["body"]))
+
+    def get(self, url, **kwargs):
+        return self._replay("get", url)
+
+    def urlopen(self, url, headers=None):
+        return self._replay("urlopen", url)
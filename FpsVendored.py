@@ -0,0 +1,25 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Importing this module puts the libraries vendored in third_party ahead of any
+# installed copies on sys.path. The checks rely on their extensions, such as
+# PublicSuffixList.cached(), lookup_labels() and classify_many(), so each
+# entry point imports it before anything else.
+import os
+import sys
+
+THIRD_PARTY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "third_party")
+
+if THIRD_PARTY not in sys.path:
+    sys.path.insert(0, THIRD_PARTY)
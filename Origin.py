@@ -0,0 +1,126 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import functools
+
+# How many distinct parsed sites, and (site, list) pairs, are kept
+CACHE_SIZE = 65536
+
+
+class Origin(collections.namedtuple(
+        "Origin", ["site", "scheme", "host", "punycode_host", "etld",
+                   "etld_plus1", "esld", "tld"])):
+    """An immutable, parsed site from the First-Party Sets list
+
+    Origins are created with Origin.parse(), which returns the same object
+    for the same site string and public suffix list while it stays in the
+    cache, so the checks share one parse of each site.
+
+  Attributes:
+    site: the site string exactly as it was listed
+    scheme: the scheme before "://", or "" if the site has none
+    host: the rest of the site after the scheme, as listed
+    punycode_host: the host lowercased and IDNA (punycode) encoded, or just
+    lowercased if it cannot be encoded
+    etld: the public suffix of the host, or None if it has no valid TLD or no
+    public suffix list was given
+    etld_plus1: the registrable domain of the host, or None likewise
+    esld: the label of the registrable domain left of its public suffix, or
+    the first label of the host when there is no registrable domain
+    tld: the last label of punycode_host
+  """
+    __slots__ = ()
+
+    @staticmethod
+    def parse(site, etlds=None):
+        """Returns the Origin of site
+
+        Args:
+            site: a site string such as "https://example.com"
+            etlds: the PublicSuffixList to find the suffixes with, or None to
+            fill in only the fields that do not need one
+        Returns:
+            Origin
+        """
+        return _parse_origin(site, etlds)
+
+    def is_eTLD_Plus1(self):
+        """Returns whether the host is a registrable domain that is not itself
+        a public suffix, and is listed in lowercase so that the exclusivity
+        checks, which compare sites as listed, see a single spelling of it"""
+        return is_etld_plus1(self.host, self.punycode_host, self.etld,
+                             self.etld_plus1)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_site(site):
+    """Splits site into (scheme, host, punycode_host), independently of any
+    public suffix list
+
+    Args:
+        site: a site string such as "https://example.com"
+    Returns:
+        Tuple[string, string, string]
+    """
+    scheme, separator, host = site.partition("://")
+    if not separator:
+        scheme, host = "", site
+    try:
+        punycode_host = host.encode("idna").decode("ascii").lower()
+    except UnicodeError:
+        punycode_host = host.lower()
+    return scheme, host, punycode_host
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _parse_origin(site, etlds):
+    scheme, host, punycode_host = parse_site(site)
+    labels = punycode_host.split(".")
+    etld = etld_plus1 = None
+    if etlds is not None:
+        etld, etld_plus1, _ = etlds.lookup_labels(labels, strict=True)
+    return Origin(site, scheme, host, punycode_host, etld, etld_plus1,
+                  esld_of(labels, etld, etld_plus1), labels[-1])
+
+
+def is_etld_plus1(host, punycode_host, etld, etld_plus1):
+    """Returns whether a host with the given suffixes passes
+    Origin.is_eTLD_Plus1, for callers holding the suffixes of several lists
+
+    Args:
+        host: the host as listed
+        punycode_host: the host lowercased and punycode encoded
+        etld: the public suffix of the host, or None
+        etld_plus1: the registrable domain of the host, or None
+    Returns:
+        boolean
+    """
+    return (host == host.lower() and etld_plus1 == punycode_host
+            and etld != punycode_host)
+
+
+def esld_of(labels, etld, etld_plus1):
+    """Returns the eSLD of a host: the label of its registrable domain left of
+    the public suffix, or its first label when it has no registrable domain
+
+    Args:
+        labels: the labels of the punycode host
+        etld: the public suffix of the host, or None
+        etld_plus1: the registrable domain of the host, or None
+    Returns:
+        string
+    """
+    if etld_plus1 is not None and etld_plus1 != etld:
+        return etld_plus1.split(".", 1)[0]
+    return labels[0]
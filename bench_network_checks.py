@@ -0,0 +1,178 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsCheck import FpsCheck
+from unittest import mock
+from web_farm import WebFarm, synthetic_sets
+import getopt
+import os
+import requests
+import ssl
+import sys
+import time
+
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of a list of samples
+
+    Args:
+        samples: a list of numbers
+        fraction: the percentile as a fraction, e.g. 0.99
+    Returns:
+        the sample at that rank, or 0 if there are no samples
+    """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def timed(fn, latencies):
+    """Wraps fn so that the duration of every call is appended to latencies"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_benchmark(fps_checker, farm, check_sets):
+    """Runs each network check of fps_checker against a running WebFarm
+
+    Args:
+        fps_checker: an FpsCheck holding the synthetic list
+        farm: the started WebFarm serving the synthetic hosts
+        check_sets: Dict[string, FpsSet]
+    Returns:
+        a list of dictionaries, one per check, holding the number of requests,
+        the number of errors produced, the wall time, the throughput in
+        requests per second and the p50/p90/p99/max request latency
+    """
+    checks = [
+        fps_checker.find_invalid_well_known,
+        fps_checker.find_robots_txt,
+        fps_checker.find_ads_txt,
+        fps_checker.check_for_service_redirect,
+    ]
+    results = []
+    with farm.resolver_override():
+        for check in checks:
+            latencies = []
+            errors_before = len(fps_checker.error_list)
+            with mock.patch.object(requests, 'get',
+                                   timed(requests.get, latencies)), \
+                 mock.patch.object(fps_checker, 'open_and_load_json',
+                                   timed(fps_checker.open_and_load_json,
+                                         latencies)):
+                start = time.perf_counter()
+                check(check_sets)
+                wall = time.perf_counter() - start
+            results.append({
+                "check": check.__name__,
+                "requests": len(latencies),
+                "errors": len(fps_checker.error_list) - errors_before,
+                "wall_s": wall,
+                "requests_per_s": len(latencies) / wall if wall else 0,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p90_ms": percentile(latencies, 0.90) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "max_ms": max(latencies, default=0) * 1000,
+            })
+    return results
+
+
+def parse_latency(spec):
+    """Parses a latency option such as fixed:5, uniform:1:20 or lognormal:20:0.5
+    """
+    kind, *params = spec.split(":")
+    return tuple([kind] + [float(p) for p in params])
+
+
+def main():
+    args = sys.argv[1:]
+    num_sets = 100
+    associated_per_set = 2
+    service_per_set = 1
+    latency = ("lognormal", 5, 0.5)
+    failure = "error"
+    failure_rate = 0.0
+    misconfig_rate = 0.0
+    hang_seconds = 2.0
+    certfile = keyfile = cafile = None
+    opts, _ = getopt.getopt(args, "", [
+        "sets=", "associated=", "service=", "latency=", "failure=",
+        "failure_rate=", "misconfig_rate=", "hang_seconds=", "certfile=",
+        "keyfile=", "cafile="])
+    for opt, arg in opts:
+        if opt == '--sets':
+            num_sets = int(arg)
+        if opt == '--associated':
+            associated_per_set = int(arg)
+        if opt == '--service':
+            service_per_set = int(arg)
+        if opt == '--latency':
+            latency = parse_latency(arg)
+        if opt == '--failure':
+            failure = arg
+        if opt == '--failure_rate':
+            failure_rate = float(arg)
+        if opt == '--misconfig_rate':
+            misconfig_rate = float(arg)
+        if opt == '--hang_seconds':
+            hang_seconds = float(arg)
+        if opt == '--certfile':
+            certfile = arg
+        if opt == '--keyfile':
+            keyfile = arg
+        if opt == '--cafile':
+            cafile = arg
+
+    # Without a certificate for the synthetic domain the farm serves plain
+    # HTTP, and the synthetic list uses http:// sites to match.
+    ssl_context = None
+    if certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certfile, keyfile)
+    if cafile:
+        # Trust the farm's CA for both requests and urllib
+        os.environ['REQUESTS_CA_BUNDLE'] = cafile
+        os.environ['SSL_CERT_FILE'] = cafile
+
+    fps_sites, profiles = synthetic_sets(
+        num_sets, associated_per_set, service_per_set,
+        scheme="https" if ssl_context else "http", latency=latency,
+        failure=failure, failure_rate=failure_rate,
+        misconfig_rate=misconfig_rate)
+    fps_checker = FpsCheck(fps_sites, None, set())
+    check_sets = fps_checker.load_sets()
+    with WebFarm(profiles, ssl_context=ssl_context,
+                 hang_seconds=hang_seconds) as farm:
+        results = run_benchmark(fps_checker, farm, check_sets)
+
+    print("%d sets, %d hosts" % (num_sets, len(profiles)))
+    print("%-28s %8s %7s %9s %9s %8s %8s %8s %8s" % (
+        "check", "requests", "errors", "wall_s", "req/s",
+        "p50_ms", "p90_ms", "p99_ms", "max_ms"))
+    for r in results:
+        print("%-28s %8d %7d %9.3f %9.1f %8.2f %8.2f %8.2f %8.2f" % (
+            r["check"], r["requests"], r["errors"], r["wall_s"],
+            r["requests_per_s"], r["p50_ms"], r["p90_ms"], r["p99_ms"],
+            r["max_ms"]))
+
+
+if __name__ == '__main__':
+    main()
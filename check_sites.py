@@ -11,13 +11,34 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsArtifact import write_artifact
 from FpsCheck import FpsCheck
+from FpsMemory import MIB, MemoryReport
+from FpsMetrics import RunMetrics
+from FpsPool import OFFLINE_CHECKS, CheckPool
+from FpsQuery import SetIndex
+from FpsResultCache import MAX_AGE, ResultCache, file_hash, set_fingerprint
+from FpsScheduler import PERIOD_DAYS, RollingScheduler
+from FpsTrace import StageProfiler, TraceRecorder
+from FpsTransport import (CachingTransport, ObservedTransport,
+                          PooledTransport, RecordingTransport,
+                          ReplayTransport, install_phase_timers,
+                          mark_queued)
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
 import json
 import getopt
 import sys
 import os
 from publicsuffix2 import PublicSuffixList
 
+# The number of requests of a batch's fetch plan made at once
+FETCH_WORKERS = 16
+# The version of the JSON reports of --report
+REPORT_VERSION = 1
+
 def find_diff_sets(old_sets, new_sets):
     """Finds changes made between two dictionaries of First-Party Sets
 
@@ -44,107 +65,937 @@ def find_diff_sets(old_sets, new_sets):
     return diff_sets, subtracted_sets
 
 
-def main():
-    args = sys.argv[1:]
-    input_file = 'first_party_sets.JSON'
-    input_prefix = ''
-    with_diff = False
-    opts, _ = getopt.getopt(args, "i:", ["data_directory=", "with_diff"])
-    for opt, arg in opts:
-        if opt == '-i':
-            input_file = arg
-        if opt == '--data_directory':
-            input_prefix = arg
-        if opt == '--with_diff':
-            with_diff = True
+def count_sites(check_sets):
+    """Counts the member sites, ccTLD variants included, of a set of FpsSets
 
-    # Open and load the json of the new list
-    with open(input_file) as f:
+        Args:
+            check_sets: Dict[string, FpsSet]
+        Returns:
+            int
+    """
+    return sum(1 for fps in check_sets.values() for _ in fps.members())
+
+
+def run_stage(instruments, name, sites=0):
+    """Enters the stage() context of every instrument for a pipeline stage
+
+        Args:
+            instruments: a list of objects with a stage(name, sites) context 
+            manager, e.g. RunMetrics
+            name: the name of the stage or check
+            sites: the number of sites the stage examines
+        Returns:
+            contextlib.ExitStack
+    """
+    stack = contextlib.ExitStack()
+    for instrument in instruments:
+        stack.enter_context(instrument.stage(name, sites))
+    return stack
+
+
+def shard_of(primary, count):
+    """Returns the shard, from 0 to count - 1, that the set of primary 
+    belongs to, the same on every machine and in every run"""
+    digest = hashlib.sha256(primary.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def parse_shard(arg):
+    """Parses a shard given as "index/count", e.g. "0/4"
+
+        Raises:
+            ValueError if it is not a valid shard
+    """
+    index, _, count = arg.partition('/')
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard " + arg + ", expected i/N with "
+                         + "0 <= i < N")
+    return index, count
+
+
+def shard_report(shard, list_hash, results):
+    """Returns the JSON report of a sharded run, from the results 
+    check_list filled in, for merge_reports"""
+    return {"version": REPORT_VERSION, "list_hash": list_hash,
+            "shard": shard[0], "shards": shard[1],
+            "global_errors": results["global_errors"],
+            "global_texts": results["global_texts"],
+            "checks": results["checks"],
+            "exceptions": results["exceptions"],
+            "order": results["order"]}
+
+
+def merge_reports(reports):
+    """Merges the reports of every shard of a run into the report of a run
+    over the whole list
+
+        The errors are put back in the order a single run reports them: 
+        those of the checks across sets, then each check's errors set by 
+        set, then the exceptions raised. A check that raises stops at that
+        set in a single run, so only the first exception of each check is
+        kept, and the errors it found in the sets after that one are 
+        dropped.
+
+        Args:
+            reports: a list of the shard reports, in any order
+        Returns:
+            the merged report, with "list_hash", "success" and "errors"
+        Raises:
+            ValueError if the reports are not those of every shard of one run
+    """
+    if not reports:
+        raise ValueError("No reports to merge")
+    count = reports[0].get("shards")
+    by_shard = {}
+    for report in reports:
+        if (report.get("version") != REPORT_VERSION
+                or report.get("shards") != count
+                or report["list_hash"] != reports[0]["list_hash"]):
+            raise ValueError("The reports are not from the same run")
+        by_shard[report["shard"]] = report
+    if sorted(by_shard) != list(range(count)) or len(reports) != count:
+        raise ValueError("Expected one report for each of " + str(count)
+                         + " shards, got shards " + str(sorted(by_shard)))
+    # The position and message of the first set each check raised on
+    first_raised = {}
+    for report in reports:
+        order = report["order"]
+        for name, primary, text in report["exceptions"]:
+            check = CHECKS.index(name)
+            if (check not in first_raised
+                    or order[primary] < first_raised[check][0]):
+                first_raised[check] = (order[primary], text)
+    entries = []
+    for report in reports:
+        order = report["order"]
+        for name, errors_by_set in report["checks"].items():
+            check = CHECKS.index(name)
+            stop = first_raised.get(check, (None,))[0]
+            for primary, errors in errors_by_set.items():
+                if stop is None or order[primary] <= stop:
+                    entries.append((check, order[primary], errors))
+    errors = list(by_shard[0]["global_errors"])
+    for _, _, set_errors in sorted(entries, key=lambda e: e[:2]):
+        errors += set_errors
+    errors += by_shard[0]["global_texts"]
+    errors += [text for _, (_, text) in sorted(first_raised.items())]
+    return {"version": REPORT_VERSION, "list_hash": reports[0]["list_hash"],
+            "success": not errors, "errors": errors}
+
+
+# The checks run on every set to check, in order
+CHECKS = (
+    'has_all_rationales',
+    'find_non_https_urls',
+    'find_invalid_eTLD_Plus1',
+    'find_invalid_well_known',
+    'find_invalid_alias_eSLDs',
+    'find_robots_txt',
+    'find_ads_txt',
+    'check_for_service_redirect',
+)
+
+
+def check_list(fps_checker, stage, old_sites=None, error_texts=None,
+               tracer=None, result_cache=None, scheduler=None, shard=None,
+               results=None, jobs=1):
+    """Runs every check that follows schema validation on the list of 
+    fps_checker
+
+        Errors are appended to fps_checker.error_list, and exceptions raised
+        by a check to error_texts, so that the remaining checks still run.
+
+        Args:
+            fps_checker: the FpsCheck holding a list whose schema is valid
+            stage: a function of (name, sites) returning a context manager 
+            for each stage, e.g. one calling run_stage
+            old_sites: the previous version of the list, to only check the 
+            sets that differ from it, or None to check every set
+            error_texts: the list to append exceptions to, or None
+            tracer: the TraceRecorder among the instruments, or None
+            result_cache: a ResultCache to reuse the results of unchanged 
+            sets from, see run_checks_by_set, or None to check every set
+            scheduler: a RollingScheduler choosing which of the sets to 
+            check, and recording their outcome, or None to check them all
+            shard: (index, count) to only check the sets whose primary 
+            shard_of assigns to shard index of count, or None for all of 
+            them; the checks across sets only run in shard 0
+            results: a dictionary to fill, when the checks run one set at a
+            time, with "global_errors" and "global_texts", the errors of the
+            checks across sets, "checks", the result of run_checks_by_set, 
+            "exceptions" and "order", the position of each checked primary 
+            among every set to check
+            jobs: the number of processes to run the offline checks on, see
+            CheckPool, when the checks run on all the sets at once
+        Returns:
+            Dict[string, FpsSet], every set of the list
+    """
+    if error_texts is None:
+        error_texts = []
+    with stage('load_sets', 0):
+        all_sets = fps_checker.load_sets()
+    # Check for exclusivity among all sets in the updated version
+    # This pass over every site is cheap, so a sharded run only does it once
+    if shard is None or shard[0] == 0:
         try:
-            fps_sites = json.load(f)
+            with stage('check_exclusivity', count_sites(all_sets)):
+                fps_checker.check_exclusivity(all_sets)
         except Exception as inst:
-        # If the file cannot be loaded, we will not run any other checks
-            print("There was an error when loading "+ input_file + 
-                  "\nerror was: " + inst)
-            return  
-     
+                error_texts.append(inst)
+
+    check_sets = {}
+    subtracted_sets = {}
+    if old_sites is not None:
+        with stage('diff', 0):
+            old_checker = FpsCheck(old_sites, fps_checker.etlds,
+                                   fps_checker.icanns)
+            check_sets, subtracted_sets = find_diff_sets(
+                old_checker.load_sets(), fps_checker.load_sets())
+        # TODO: add variable and check for subtracted_sets in case of user 
+        # removing old set from the list
+    else:
+        with stage('load_check_sets', 0):
+            check_sets = fps_checker.load_sets()
+    if scheduler is not None:
+        with stage('schedule', len(check_sets)):
+            fingerprints = set_fingerprints(fps_checker.fps_sites)
+            check_sets = {primary: check_sets[primary]
+                          for primary in scheduler.select(
+                              {primary: fingerprints[primary]
+                               for primary in check_sets})}
+    order = {primary: i for i, primary in enumerate(check_sets)}
+    if shard is not None:
+        index, count = shard
+        check_sets = {primary: fps for primary, fps in check_sets.items()
+                      if shard_of(primary, count) == index}
+        if index != 0:
+            subtracted_sets = {}
+
+    # Run check on subtracted sets
+    with stage('find_invalid_removal', len(subtracted_sets)):
+        fps_checker.find_invalid_removal(subtracted_sets)
 
+    # Run rest of checks
+    num_sites = count_sites(check_sets)
+    if tracer:
+        check_sets = tracer.traced_sets(check_sets)
+    if result_cache is not None or scheduler is not None or shard is not None:
+        global_errors = [str(error) for error in fps_checker.error_list]
+        global_texts = [str(error) for error in error_texts]
+        exceptions = []
+        errors_by_check = run_checks_by_set(fps_checker, check_sets,
+                                            result_cache, stage, error_texts,
+                                            exceptions)
+        if scheduler is not None:
+            errors_by_set = {primary: [] for primary in check_sets}
+            for errors_of_check in errors_by_check.values():
+                for primary, errors in errors_of_check.items():
+                    errors_by_set[primary] += errors
+            for _, primary, text in exceptions:
+                errors_by_set[primary].append(text)
+            scheduler.record(fingerprints, errors_by_set)
+        if results is not None:
+            results.update(global_errors=global_errors,
+                           global_texts=global_texts, checks=errors_by_check,
+                           exceptions=exceptions,
+                           order={primary: order[primary]
+                                  for primary in check_sets})
+        return all_sets
+    with contextlib.ExitStack() as stack:
+        pool = None
+        # Traced sets are only recorded in this process, so a traced run 
+        # keeps every check here
+        if jobs > 1 and not tracer and len(check_sets) > 1:
+            with stage('fork_workers', num_sites):
+                pool = stack.enter_context(
+                    CheckPool(fps_checker, check_sets, jobs))
+        for name in CHECKS:
+            try:
+                with stage(name, num_sites):
+                    if pool is not None and name in OFFLINE_CHECKS:
+                        pool.run(name)
+                    else:
+                        getattr(fps_checker, name)(check_sets)
+            except Exception as inst:
+                error_texts.append(inst)
+    return all_sets
+
+
+def set_fingerprints(fps_sites):
+    """Returns a dictionary of primary->set_fingerprint for the sets of a 
+    list, in list order, keeping the first of the sets listed with a primary
+    as load_sets does"""
+    fingerprints = {}
+    for fpset in fps_sites['sets']:
+        if fpset.get('primary') not in fingerprints:
+            fingerprints[fpset.get('primary')] = set_fingerprint(fpset)
+    return fingerprints
+
+
+def run_checks_by_set(fps_checker, check_sets, result_cache, stage,
+                      error_texts, exceptions=None):
+    """Runs every check on one set at a time, reusing the results a 
+    ResultCache holds for a set and storing the others
+
+        The errors end up in fps_checker.error_list in the same order as
+        when each check runs on all of check_sets at once. An exception 
+        raised by a check is appended to error_texts, and the result of that
+        check for that set is not cached.
+
+        Args:
+            fps_checker: the FpsCheck holding a list whose schema is valid
+            check_sets: Dict[string, FpsSet], the sets to check
+            result_cache: the ResultCache, or None to run every check
+            stage: a function of (name, sites) returning a context manager 
+            for each stage
+            error_texts: the list to append exceptions to
+            exceptions: a list to append (check name, primary, message) to
+            for every exception, or None
+        Returns:
+            Dict[string, Dict[string, List[string]]], the errors each check
+            found for each set
+    """
+    fingerprints = set_fingerprints(fps_checker.fps_sites)
+    errors_by_check = {}
+    num_sites = count_sites(check_sets)
+    for name in CHECKS:
+        check = getattr(fps_checker, name)
+        errors_by_set = errors_by_check[name] = {}
+        with stage(name, num_sites):
+            for primary, fps in check_sets.items():
+                set_hash = fingerprints[primary]
+                errors = None
+                if result_cache is not None:
+                    errors = result_cache.get(set_hash, name)
+                if errors is not None:
+                    fps_checker.error_list.extend(errors)
+                    errors_by_set[primary] = errors
+                    continue
+                errors_before = len(fps_checker.error_list)
+                try:
+                    check({primary: fps})
+                except Exception as inst:
+                    error_texts.append(inst)
+                    if exceptions is not None:
+                        exceptions.append((name, primary, str(inst)))
+                    errors_by_set[primary] = [
+                        str(error) for error in
+                        fps_checker.error_list[errors_before:]]
+                    continue
+                errors = [str(error) for error in
+                          fps_checker.error_list[errors_before:]]
+                errors_by_set[primary] = errors
+                if result_cache is not None:
+                    result_cache.put(set_hash, name, errors)
+    return errors_by_check
+
+
+def check_errors(fps_checker, error_texts):
+    """Returns the errors of a run of check_list as strings, in the order
+    check_sites prints them"""
+    return ([str(error) for error in fps_checker.error_list]
+            + [str(error) for error in error_texts])
+
+
+def load_references(input_prefix, stage, psl_cache=None, backend='trie'):
+    """Loads the public suffix list and the ICANN domains in input_prefix
+
+        Args:
+            input_prefix: the directory holding the reference files
+            stage: a function of (name, sites) returning a context manager 
+            for each stage
+            psl_cache: the path of the compiled PSL snapshot, or None for 
+            the backend's default next to effective_tld_names.dat
+            backend: the PublicSuffixList backend, 'trie' or 'compact'
+        Returns:
+            Tuple[PublicSuffixList, Set[string]]
+    """
     # Load the etlds from the public suffix list
-    etlds = PublicSuffixList(psl_file = os.path.join(input_prefix,'effective_tld_names.dat'))
+    # The compiled trie is cached in a snapshot next to the list, and is only
+    # rebuilt when the content of the list changes
+    with stage('psl_load', 0):
+        etlds = PublicSuffixList.cached(
+            psl_file = os.path.join(input_prefix,'effective_tld_names.dat'),
+            cache_file = psl_cache, backend = backend)
     # Get all the ICANN domains
     icanns = set()
-    with open(os.path.join(input_prefix,'ICANN_domains')) as f:
+    with stage('icann_load', 0), open(os.path.join(input_prefix,'ICANN_domains')) as f:
         for line in f:
             l = line.strip()
             icanns.add(l)
 
-    fps_checker = FpsCheck(fps_sites, etlds, icanns)
+    return etlds, icanns
+
+
+def prefetch(transport, plan, workers=FETCH_WORKERS):
+    """Makes every request of a fetch plan through transport, workers at a 
+    time, the way the network checks make them
+
+        Meant for a CachingTransport, which then answers the checks from the
+        responses, or raises the errors, it got here.
+
+        Args:
+            transport: the transport to fetch through
+            plan: an iterable of (method, url), as from FpsCheck.fetch_plan
+            workers: the number of requests made at once
+        Returns:
+            None
+    """
+    def fetch(request):
+        method, url = request
+        try:
+            if method == "get":
+                transport.get(url, timeout=10)
+            else:
+                transport.urlopen(url, headers={'User-Agent': 'Chrome'})
+        except Exception:
+            # The check that makes this request reports the error
+            pass
+
+    plan = list(plan)
+    # Every request is queued at once, so traces show how long each waited
+    # for a worker
+    for _, url in plan:
+        mark_queued(transport, url)
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in pool.map(fetch, plan):
+            pass
+
+
+def batch_submission(entry, current_sites):
+    """Returns the list a line of a batch file asks to validate
+
+        A line holds either a version of the whole list, {"sets": [...]}, or
+        a candidate set, {"set": {...}} or the set object itself, which 
+        replaces the set with the same primary in the current list or is 
+        added to it. Either may have an "id" to label its result with.
+
+        Args:
+            entry: the parsed line
+            current_sites: the current list
+        Returns:
+            the list, in the format of first_party_sets.JSON
+        Raises:
+            ValueError if the line is neither
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("Expected a JSON object")
+    entry = {key: value for key, value in entry.items() if key != 'id'}
+    if 'sets' in entry:
+        return entry
+    candidate = entry.get('set', entry)
+    if not isinstance(candidate, dict) or 'primary' not in candidate:
+        raise ValueError("Expected a list with \"sets\" or a set with a "
+                         "\"primary\"")
+    sets = [fpset for fpset in current_sites.get('sets', [])
+            if fpset.get('primary') != candidate['primary']]
+    return dict(current_sites, sets=sets + [candidate])
+
+
+def read_batch(batch_file, current_sites):
+    """Reads the submissions of a JSONL batch file
+
+        Args:
+            batch_file: the path of the file, see batch_submission
+            current_sites: the current list
+        Returns:
+            an iterator of (record, list) for every line that is not blank, 
+            where record holds the line number and the "id" of the line if it
+            has one, and list is the list to validate, or the exception 
+            raised reading the line
+    """
+    with open(batch_file) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = {"line": line_number}
+            try:
+                entry = json.loads(line)
+                if isinstance(entry, dict) and 'id' in entry:
+                    record["id"] = entry['id']
+                yield record, batch_submission(entry, current_sites)
+            except ValueError as inst:
+                yield record, inst
+
+
+def find_submission_conflicts(old_sets, submissions):
+    """Finds the sites that pending submissions claim for different sets
+
+        Each submission is validated alone against the current list, so two
+        submissions adding the same site to different sets both pass 
+        check_exclusivity. Here the sites of every set a submission adds or
+        changes are indexed together with the current list, in one pass over
+        all of them, and a conflict is reported for every site held by two 
+        different sets of different submissions, or by a submission and a 
+        set of the current list that submission leaves unchanged, and for 
+        every set that several submissions change or remove.
+
+        Args:
+            old_sets: Dict[string, FpsSet], the current list
+            submissions: a list of (name, Dict[string, FpsSet]), the whole 
+            list each submission would produce
+        Returns:
+            List[string], a message for each conflict
+    """
+    base = SetIndex(old_sets)
+    # site -> {(submission, primary): role}
+    claims = {}
+    # primary -> the submissions that change or remove its set
+    changed_by = {}
+    for name, new_sets in submissions:
+        diff_sets, subtracted_sets = find_diff_sets(old_sets, new_sets)
+        for primary in list(diff_sets) + list(subtracted_sets):
+            changed_by.setdefault(primary, []).append(name)
+        for primary, fps in diff_sets.items():
+            for site, role in fps.members():
+                claims.setdefault(site, {}).setdefault((name, primary), role)
+
+    def describe(name, primary, role):
+        where = ("the current list" if name is None
+                 else "submission " + str(name))
+        return primary + " (" + role + ") in " + where
+
+    conflicts = []
+    for primary, names in changed_by.items():
+        if len(names) > 1:
+            conflicts.append("The set of " + primary + " is changed by "
+                             + "submissions " + ", ".join(map(str, names)))
+    for site, site_claims in claims.items():
+        holders = list(site_claims.items())
+        current = base.lookup(site)
+        if current is not None:
+            holders.append(((None, current[0]), current[1]))
+        for i, ((name_a, primary_a), role_a) in enumerate(holders):
+            for (name_b, primary_b), role_b in holders[i + 1:]:
+                if name_a == name_b or primary_a == primary_b:
+                    continue
+                if name_b is None and name_a in changed_by.get(primary_b, ()):
+                    continue
+                conflicts.append(
+                    site + " is claimed by " + describe(name_a, primary_a,
+                                                        role_a)
+                    + " and by " + describe(name_b, primary_b, role_b))
+    return conflicts
+
+
+def run_conflicts(batch_file, input_prefix, output):
+    """Reports the conflicts between the submissions of a JSONL batch file,
+    see find_submission_conflicts
+
+        Args:
+            batch_file: the path of the JSONL file, see batch_submission
+            input_prefix: the directory holding the current 
+            first_party_sets.JSON
+            output: the file to write the conflicts to, one per line
+        Returns:
+            int, the number of conflicts
+    """
+    with open(os.path.join(input_prefix,'first_party_sets.JSON')) as f:
+        current_sites = json.load(f)
+    old_sets = FpsCheck(current_sites, None, set()).load_sets()
+    submissions = []
+    for record, fps_sites in read_batch(batch_file, current_sites):
+        name = record.get("id", "on line " + str(record["line"]))
+        if isinstance(fps_sites, Exception):
+            output.write("Skipped submission " + str(name) + ": "
+                         + str(fps_sites) + "\n")
+            continue
+        submissions.append(
+            (name, FpsCheck(fps_sites, None, set()).load_sets()))
+    conflicts = find_submission_conflicts(old_sets, submissions)
+    for conflict in conflicts:
+        output.write(conflict + "\n")
+    output.flush()
+    return len(conflicts)
+
+
+def run_batch(batch_file, input_prefix, transport, instruments, output,
+              psl_cache=None, fetch_workers=FETCH_WORKERS):
+    """Validates every submission in a JSONL batch file against the current 
+    list in one pass, writing one JSON result per line of the file
+
+        The reference files and the current list are loaded once. The sets
+        of each submission that differ from the current list are checked,
+        as with --with_diff; the requests the network checks will make for
+        all submissions are merged into one plan without duplicates and 
+        fetched up front, so a URL shared by several submissions is fetched 
+        once.
+
+        Args:
+            batch_file: the path of the JSONL file, see batch_submission
+            input_prefix: the directory holding the reference files and the
+            current first_party_sets.JSON
+            transport: the transport to fetch through, or None
+            instruments: a list of instruments passed to run_stage
+            output: the file to write the results to
+            psl_cache: the path of the compiled PSL snapshot, or None
+            fetch_workers: the number of requests fetched at once
+        Returns:
+            int, the number of submissions that failed
+    """
+    def stage(name, sites=0):
+        return run_stage(instruments, name, sites)
+
+    etlds, icanns = load_references(input_prefix, stage, psl_cache)
+    with stage('diff_load'):
+        with open(os.path.join(input_prefix,'first_party_sets.JSON')) as f:
+            current_sites = json.load(f)
+        old_sets = FpsCheck(current_sites, etlds, icanns).load_sets()
+    schema_file = os.path.join(input_prefix,'SCHEMA.json')
+    cached = CachingTransport(transport or PooledTransport(),
+                              max_age=float('inf'))
+
+    submissions = []
+    plan = {}
+    with stage('batch_load'):
+        for record, fps_sites in read_batch(batch_file, current_sites):
+            try:
+                if isinstance(fps_sites, Exception):
+                    raise fps_sites
+                fps_checker = FpsCheck(fps_sites, etlds, icanns, cached)
+                fps_checker.validate_schema(schema_file)
+            except Exception as inst:
+                # Nothing else is checked for this line
+                submissions.append((record, None, [str(inst)]))
+                continue
+            check_sets, subtracted_sets = find_diff_sets(
+                old_sets, fps_checker.load_sets())
+            plan.update(dict.fromkeys(
+                fps_checker.fetch_plan(check_sets, subtracted_sets)))
+            submissions.append((record, fps_checker, None))
+
+    with stage('prefetch', len(plan)):
+        prefetch(cached, plan, fetch_workers)
+
+    failed = 0
+    for record, fps_checker, errors in submissions:
+        if fps_checker is not None:
+            error_texts = []
+            check_list(fps_checker, stage, current_sites, error_texts)
+            errors = check_errors(fps_checker, error_texts)
+        record["success"] = not errors
+        record["errors"] = errors
+        failed += bool(errors)
+        output.write(json.dumps(record) + "\n")
+    output.flush()
+    return failed
+
+
+def run_checks(input_file, input_prefix, with_diff, transport, instruments,
+               metrics=None, tracer=None, psl_cache=None, artifact_file=None,
+               result_cache_file=None, max_age=MAX_AGE, scheduler=None,
+               shard=None, report_file=None, jobs=1):
+    """Loads the list at input_file, runs every check on it and prints the 
+    errors, or "success" if there are none
+
+        Args:
+            input_file: the path of the list to check
+            input_prefix: the directory holding the reference files
+            with_diff: whether to only check the sets that differ from the 
+            first_party_sets.JSON in input_prefix
+            transport: the transport for FpsCheck, or None
+            instruments: a list of instruments passed to run_stage
+            metrics: the RunMetrics among the instruments, or None
+            tracer: the TraceRecorder among the instruments, or None
+            psl_cache: the path of the compiled PSL snapshot, or None for 
+            the backend's default next to effective_tld_names.dat
+            artifact_file: the path to write the compiled membership artifact
+            of the whole list to if every check passes, or None
+            result_cache_file: the path of the sqlite database to reuse the
+            results of unchanged sets from and store new results in, or None
+            max_age: how many seconds cached results of network checks are
+            reused for
+            scheduler: a RollingScheduler to only check the sets it chooses,
+            or None; its state is saved after the checks
+            shard: (index, count) to only run shard index of count, see 
+            check_list, or None
+            report_file: the path to write a JSON report of the errors to, 
+            or of the shard's results for merge_reports, or None
+            jobs: the number of processes to run the offline checks on
+        Returns:
+            None
+    """
+    def stage(name, sites=0):
+        return run_stage(instruments, name, sites)
+
+    # Open and load the json of the new list
+    with stage('load'), open(input_file) as f:
+        try:
+            fps_sites = json.load(f)
+        except Exception as inst:
+        # If the file cannot be loaded, we will not run any other checks
+            print("There was an error when loading "+ input_file + 
+                  "\nerror was: " + inst)
+            return  
+     
+
+    # Forked workers share the compact backend copy-on-write, where the
+    # reference counts of the trie's many objects would be copied into each
+    etlds, icanns = load_references(input_prefix, stage, psl_cache,
+                                    'compact' if jobs > 1 else 'trie')
+    fps_checker = FpsCheck(fps_sites, etlds, icanns, transport)
     error_texts = []
+    if metrics:
+        metrics.error_count = lambda: (
+            len(fps_checker.error_list) + len(error_texts))
 
     try:
-        fps_checker.validate_schema(os.path.join(input_prefix,'SCHEMA.json'))
+        with stage('schema', len(fps_sites.get('sets', []))):
+            fps_checker.validate_schema(os.path.join(input_prefix,'SCHEMA.json'))
     except Exception as inst:
         # If the schema is invalid, we will not run any other checks
         print(inst)
         return
     
-    # Check for exclusivity among all sets in the updated version
-    try:
-        fps_checker.check_exclusivity(fps_checker.load_sets())
-    except Exception as inst:
-            error_texts.append(inst)
-
-
-    check_sets = {}
-    subtracted_sets = {}
+    old_sites = None
     # If called with with_diff, we must determine the sets that are different 
     # to properly construct our check_sets
     if with_diff:   
-        with open(os.path.join(input_prefix,'first_party_sets.JSON')) as f:
-            try:
-                old_sites = json.load(f)
-            except Exception as inst:
-            # If the file cannot be loaded, we will not run any other checks
-                print("There was an error when loading " +
-                    os.path.join(input_prefix,'first_party_sets.JSON') + 
-                    "\nerror was: " + inst)
-                return
-        old_checker = FpsCheck(old_sites, etlds, icanns)
-        check_sets, subtracted_sets = find_diff_sets(old_checker.load_sets(), fps_checker.load_sets())
-        # TODO: add variable and check for subtracted_sets in case of user 
-        # removing old set from the list
-    else:
-        check_sets = fps_checker.load_sets()
-
-    # Run check on subtracted sets
-    fps_checker.find_invalid_removal(subtracted_sets)
+        with stage('diff_load'):
+            with open(os.path.join(input_prefix,'first_party_sets.JSON')) as f:
+                try:
+                    old_sites = json.load(f)
+                except Exception as inst:
+                # If the file cannot be loaded, we will not run any other checks
+                    print("There was an error when loading " +
+                        os.path.join(input_prefix,'first_party_sets.JSON') + 
+                        "\nerror was: " + inst)
+                    return
 
-    # Run rest of checks
-    check_list = [
-        fps_checker.has_all_rationales,
-        fps_checker.find_non_https_urls, 
-        fps_checker.find_invalid_eTLD_Plus1,
-        fps_checker.find_invalid_well_known, 
-        fps_checker.find_invalid_alias_eSLDs, 
-        fps_checker.find_robots_txt, 
-        fps_checker.find_ads_txt, 
-        fps_checker.check_for_service_redirect
-        ]
-
-    for check in check_list:
-        try:
-            check(check_sets)
-        except Exception as inst:
-            error_texts.append(inst)
+    with contextlib.ExitStack() as stack:
+        result_cache = None
+        if result_cache_file:
+            result_cache = stack.enter_context(ResultCache(
+                result_cache_file,
+                os.path.join(input_prefix,'effective_tld_names.dat'),
+                os.path.join(input_prefix,'ICANN_domains'),
+                os.path.join(input_prefix,'SCHEMA.json'), max_age))
+            result_cache.prune()
+        results = {}
+        all_sets = check_list(fps_checker, stage, old_sites, error_texts,
+                              tracer, result_cache, scheduler, shard,
+                              results, jobs)
+    if scheduler is not None:
+        scheduler.save()
+    if report_file:
+        list_hash = file_hash(input_file)
+        if shard is not None:
+            report = shard_report(shard, list_hash, results)
+        else:
+            errors = check_errors(fps_checker, error_texts)
+            report = {"version": REPORT_VERSION, "list_hash": list_hash,
+                      "success": not errors, "errors": errors}
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
     # This message allows us to check the succes of our action
     if fps_checker.error_list or error_texts:
-        for checker_error in fps_checker.error_list:
-            print(checker_error)
-        for error_text in error_texts:
-            print(error_text)
+        for error in check_errors(fps_checker, error_texts):
+            print(error)
+    else:
+        # A shard only checked part of the list
+        if artifact_file and shard is None:
+            with stage('emit_artifact', count_sites(all_sets)):
+                write_artifact(all_sets, artifact_file)
+        print("success", end='')
+
+
+def merge_main(args):
+    """Merges the shard reports given as arguments, writes the merged 
+    report to the file given with -o if any, and prints its errors, or 
+    "success" if there are none"""
+    output_file = None
+    opts, report_files = getopt.getopt(args, "o:")
+    for opt, arg in opts:
+        if opt == '-o':
+            output_file = arg
+    reports = []
+    for report_file in report_files:
+        with open(report_file) as f:
+            reports.append(json.load(f))
+    try:
+        merged = merge_reports(reports)
+    except ValueError as inst:
+        print(inst)
+        sys.exit(2)
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(merged, f, indent=1)
+    if merged["errors"]:
+        for error in merged["errors"]:
+            print(error)
     else:
         print("success", end='')
 
 
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == 'merge':
+        merge_main(args[1:])
+        return
+    input_file = 'first_party_sets.JSON'
+    input_prefix = ''
+    with_diff = False
+    record_file = None
+    replay_file = None
+    metrics_json = None
+    metrics_prom = None
+    profile_dir = None
+    trace_file = None
+    memory_file = None
+    memory_limit = None
+    psl_cache = None
+    artifact_file = None
+    batch_file = None
+    batch_output = None
+    conflicts = False
+    result_cache_file = None
+    max_age = MAX_AGE
+    schedule_file = None
+    period_days = PERIOD_DAYS
+    budget = None
+    shard = None
+    report_file = None
+    jobs = 1
+    fetch_workers = FETCH_WORKERS
+    opts, _ = getopt.getopt(args, "i:", ["data_directory=", "with_diff",
+                                         "record=", "replay=",
+                                         "metrics_json=", "metrics_prom=",
+                                         "profile=", "trace=",
+                                         "memory_report=", "memory_limit=",
+                                         "psl_cache=", "emit_artifact=",
+                                         "batch=", "batch_output=",
+                                         "fetch_workers=", "conflicts",
+                                         "result_cache=", "max_age=",
+                                         "schedule=", "period_days=",
+                                         "budget=", "shard=", "report=",
+                                         "jobs="])
+    for opt, arg in opts:
+        if opt == '-i':
+            input_file = arg
+        if opt == '--data_directory':
+            input_prefix = arg
+        if opt == '--with_diff':
+            with_diff = True
+        if opt == '--record':
+            record_file = arg
+        if opt == '--replay':
+            replay_file = arg
+        if opt == '--metrics_json':
+            metrics_json = arg
+        if opt == '--metrics_prom':
+            metrics_prom = arg
+        if opt == '--profile':
+            profile_dir = arg
+        if opt == '--trace':
+            trace_file = arg
+        if opt == '--memory_report':
+            memory_file = arg
+        if opt == '--memory_limit':
+            # The ceiling is given in MiB
+            memory_limit = int(float(arg) * MIB)
+        if opt == '--psl_cache':
+            psl_cache = arg
+        if opt == '--emit_artifact':
+            artifact_file = arg
+        if opt == '--batch':
+            batch_file = arg
+        if opt == '--batch_output':
+            batch_output = arg
+        if opt == '--fetch_workers':
+            fetch_workers = int(arg)
+        if opt == '--conflicts':
+            conflicts = True
+        if opt == '--result_cache':
+            result_cache_file = arg
+        if opt == '--max_age':
+            # The max-age of network check results is given in seconds
+            max_age = float(arg)
+        if opt == '--schedule':
+            schedule_file = arg
+        if opt == '--period_days':
+            period_days = float(arg)
+        if opt == '--budget':
+            budget = int(arg)
+        if opt == '--shard':
+            shard = parse_shard(arg)
+        if opt == '--report':
+            report_file = arg
+        if opt == '--jobs':
+            jobs = int(arg)
+    # Only a run of each check over all the sets at once uses the pool
+    if jobs > 1 and (batch_file or shard or schedule_file
+                     or result_cache_file):
+        print("--jobs cannot be combined with --batch, --shard, --schedule"
+              + " or --result_cache")
+        sys.exit(2)
+
+    # Record every network response to a cassette, or serve them from one
+    transport = None
+    if record_file:
+        transport = RecordingTransport(record_file)
+    elif replay_file:
+        transport = ReplayTransport(replay_file)
+    recorder = transport if record_file else None
+
+    instruments = []
+    metrics = None
+    tracer = None
+    memory = None
+    if memory_file or memory_limit:
+        # Account for memory outermost, so the other instruments' own 
+        # allocations are part of each stage like in an uninstrumented run
+        memory = MemoryReport(memory_limit)
+        instruments.append(memory)
+    if metrics_json or metrics_prom:
+        metrics = RunMetrics()
+        instruments.append(metrics)
+    if trace_file:
+        tracer = TraceRecorder(trace_file)
+        instruments.append(tracer)
+        install_phase_timers()
+    if profile_dir:
+        # Profile innermost so the other instruments stay out of the stats
+        instruments.append(StageProfiler(profile_dir))
+    observers = [o for o in (metrics, tracer) if o]
+    if observers:
+        transport = ObservedTransport(transport, observers)
+
+    try:
+        if batch_file:
+            # One result per submission in the batch, instead of one run
+            with contextlib.ExitStack() as stack:
+                output = sys.stdout
+                if batch_output:
+                    output = stack.enter_context(open(batch_output, 'w'))
+                if conflicts:
+                    run_conflicts(batch_file, input_prefix, output)
+                else:
+                    run_batch(batch_file, input_prefix, transport,
+                              instruments, output, psl_cache, fetch_workers)
+        else:
+            # A rolling revalidation checks the slice of the list the 
+            # scheduler chooses for this run
+            scheduler = None
+            if schedule_file:
+                scheduler = RollingScheduler(schedule_file, period_days,
+                                             budget)
+            run_checks(input_file, input_prefix, with_diff, transport,
+                       instruments, metrics, tracer, psl_cache,
+                       artifact_file, result_cache_file, max_age, scheduler,
+                       shard, report_file, jobs)
+    finally:
+        if recorder:
+            recorder.save()
+        if metrics_json:
+            metrics.write_json(metrics_json)
+        if metrics_prom:
+            metrics.write_prometheus(metrics_prom)
+        if tracer:
+            tracer.save()
+        if memory_file:
+            memory.write_json(memory_file)
+
+
 if __name__ == '__main__':
     main()
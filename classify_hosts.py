@@ -0,0 +1,264 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsArtifact import FpsArtifact
+from FpsCheck import FpsCheck
+from FpsQuery import SetIndex
+import collections
+import functools
+import getopt
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from urllib.parse import urlsplit
+from publicsuffix2 import PublicSuffixList
+
+# The number of distinct hosts whose classification is remembered
+CACHE_SIZE = 65536
+# The number of lines sent to a worker at a time
+BATCH_SIZE = 10000
+
+
+def host_of(line):
+    """Extracts the lowercased, IDNA-encoded hostname from a log line holding
+    a URL or a bare hostname, or returns None if there is none
+
+        Args:
+            line: string, e.g. "https://www.example.com/path" or
+            "www.example.com:443"
+        Returns:
+            string or None
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        host = urlsplit(line if "://" in line else "//" + line).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    try:
+        return host.encode("idna").decode("ascii")
+    except UnicodeError:
+        return host
+
+
+class HostClassifier:
+    """Maps hostnames to their eTLD+1 and the set and role of that site
+
+    Classifications are memoized in an LRU cache, since log lines repeat a
+    small number of hosts, and the cache keeps memory bounded however many
+    distinct hosts go by.
+
+  Attributes:
+    etlds: the PublicSuffixList to find registrable domains with
+    sets: a SetIndex or FpsArtifact to look the sites up in
+  """
+    def __init__(self, etlds, sets, cache_size=CACHE_SIZE):
+        self.etlds = etlds
+        self.sets = sets
+        self.classify_host = functools.lru_cache(maxsize=cache_size)(
+            self._classify_host)
+
+    def _classify_host(self, host):
+        _etld, etld_plus1, is_suffix = self.etlds.lookup(host, strict=True)
+        # A public suffix such as co.uk is its own eTLD+1 in the lookup, but
+        # is not a registrable domain
+        if etld_plus1 is None or is_suffix:
+            return None, None, None
+        membership = self.sets.lookup("https://" + etld_plus1)
+        if membership is None:
+            return etld_plus1, None, None
+        return (etld_plus1,) + membership
+
+    def classify(self, line):
+        """Returns (host, eTLD+1, primary, role) for a log line, with None for
+        the parts that do not apply"""
+        host = host_of(line)
+        if host is None:
+            return None, None, None, None
+        return (host,) + self.classify_host(host)
+
+
+def format_record(line, record, output_format):
+    """Formats the classification of a line as a JSON object or a tab
+    separated row, without the trailing newline"""
+    host, etld_plus1, primary, role = record
+    line = line.rstrip("\r\n")
+    if output_format == "tsv":
+        return "\t".join([line.replace("\t", " ")] + [
+            field or "" for field in (host, etld_plus1, primary, role)])
+    return json.dumps({"input": line, "host": host, "etld_plus1": etld_plus1,
+                       "primary": primary, "role": role})
+
+
+def classify_stream(lines, classifier, output_format):
+    """Yields the formatted classification of every line, in order"""
+    for line in lines:
+        yield format_record(line, classifier.classify(line), output_format)
+
+
+# The classifier and output format of a worker process
+_WORKER = None
+
+
+def _init_worker(options):
+    global _WORKER
+    if options is None:
+        # forked: the parent set the worker state before starting the pool
+        return
+    _WORKER = (load_classifier(**options), options["output_format"])
+
+
+def _classify_batch(lines):
+    classifier, output_format = _WORKER
+    return "".join(
+        record + "\n"
+        for record in classify_stream(lines, classifier, output_format))
+
+
+def classify_sharded(lines, jobs, classifier, options, batch_size=BATCH_SIZE):
+    """Yields the formatted classifications of lines, worked out by a pool of
+    jobs processes, in input order
+
+    The workers are forked once the classifier is loaded, so they share it
+    with the parent copy-on-write, and the pool only starts if loading
+    succeeded. Where fork is not available, each worker loads its own
+    classifier with options instead. Lines are sent to the workers in
+    batches, and at most two batches per worker are in flight at once, so
+    memory stays bounded on inputs of any length while every worker is kept
+    busy.
+
+        Args:
+            lines: an iterable of log lines
+            jobs: the number of worker processes
+            classifier: the HostClassifier, as returned by load_classifier
+            options: the keyword arguments of load_classifier the classifier
+            was loaded with, plus output_format
+            batch_size: the number of lines per batch
+        Returns:
+            an iterator of newline-terminated blocks of output
+    """
+    global _WORKER
+    pending = collections.deque()
+    lines = iter(lines)
+    batches = iter(lambda: list(itertools.islice(lines, batch_size)), [])
+    try:
+        context = multiprocessing.get_context('fork')
+        init_args = (None,)
+        _WORKER = (classifier, options["output_format"])
+    except ValueError:
+        context = multiprocessing.get_context()
+        init_args = (options,)
+    try:
+        with context.Pool(jobs, _init_worker, init_args) as pool:
+            for batch in batches:
+                pending.append(pool.apply_async(_classify_batch, (batch,)))
+                if len(pending) >= 2 * jobs:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+    finally:
+        _WORKER = None
+
+
+def load_classifier(input_prefix='', list_file='first_party_sets.JSON',
+                    artifact_file=None, psl_cache=None, cache_size=CACHE_SIZE,
+                    backend='trie', **_):
+    """Loads the public suffix list, with the given PublicSuffixList backend,
+    and the sets, from a compiled artifact if one is given or else from the
+    JSON list, and returns a HostClassifier"""
+    etlds = PublicSuffixList.cached(
+        psl_file=os.path.join(input_prefix, 'effective_tld_names.dat'),
+        cache_file=psl_cache, backend=backend)
+    if artifact_file:
+        sets = FpsArtifact(artifact_file)
+    else:
+        with open(list_file) as f:
+            sets = SetIndex(FpsCheck(json.load(f), etlds, set()).load_sets())
+    return HostClassifier(etlds, sets, cache_size)
+
+
+def read_lines(paths):
+    """Yields the lines of each file in paths, or of stdin if there are
+    none"""
+    if not paths:
+        yield from sys.stdin
+        return
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            yield from f
+
+
+def main():
+    args = sys.argv[1:]
+    options = {'input_prefix': '', 'list_file': 'first_party_sets.JSON',
+               'artifact_file': None, 'psl_cache': None,
+               'cache_size': CACHE_SIZE, 'output_format': 'jsonl'}
+    jobs = 1
+    batch_size = BATCH_SIZE
+    opts, paths = getopt.getopt(args, "i:", ["data_directory=", "artifact=",
+                                             "psl_cache=", "format=", "jobs=",
+                                             "batch_size=", "cache_size="])
+    for opt, arg in opts:
+        if opt == '-i':
+            options['list_file'] = arg
+        if opt == '--data_directory':
+            options['input_prefix'] = arg
+        if opt == '--artifact':
+            options['artifact_file'] = arg
+        if opt == '--psl_cache':
+            options['psl_cache'] = arg
+        if opt == '--format':
+            if arg not in ('jsonl', 'tsv'):
+                print("--format must be jsonl or tsv")
+                sys.exit(2)
+            options['output_format'] = arg
+        if opt == '--jobs':
+            jobs = int(arg)
+        if opt == '--batch_size':
+            batch_size = int(arg)
+        if opt == '--cache_size':
+            options['cache_size'] = int(arg)
+
+    if jobs > 1:
+        # Forked workers share the compact backend copy-on-write, where the
+        # reference counts of the trie's many objects would be copied into
+        # each
+        options['backend'] = 'compact'
+    try:
+        classifier = load_classifier(**options)
+    except (OSError, ValueError, KeyError, TypeError) as inst:
+        print("There was an error when loading the sets or the public suffix"
+              + " list\nerror was: " + str(inst), file=sys.stderr)
+        sys.exit(1)
+
+    lines = read_lines(paths)
+    out = sys.stdout
+    if jobs > 1:
+        for block in classify_sharded(lines, jobs, classifier, options,
+                                      batch_size):
+            out.write(block)
+    else:
+        for record in classify_stream(lines, classifier,
+                                      options['output_format']):
+            out.write(record + "\n")
+    out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsCheck import FpsCheck
+from FpsQuery import SetIndex
+from Origin import Origin
+from classify_hosts import HostClassifier
+from psl_refresh import PslHandle
+import getopt
+import http.server
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+# The most queries accepted in one batch request
+MAX_BATCH = 10000
+
+
+class LookupIndex:
+    """An immutable snapshot of the list and public suffix list that queries
+    are answered from
+
+  Attributes:
+    etlds: the PublicSuffixList
+    sets: the SetIndex of the list
+    classifier: a HostClassifier over both
+    generation: how many indexes were loaded before this one
+    loaded_at: the time.time() the index was loaded
+  """
+    def __init__(self, etlds, sets, generation=0):
+        self.etlds = etlds
+        self.sets = sets
+        self.classifier = HostClassifier(etlds, sets)
+        self.generation = generation
+        self.loaded_at = time.time()
+
+    @classmethod
+    def load(cls, list_file, etlds, generation=0):
+        """Reads the list into a new index over the PublicSuffixList etlds
+
+        Raises:
+            OSError, ValueError, KeyError or TypeError if the list cannot be
+            read or parsed
+        """
+        with open(list_file) as f:
+            fps_sites = json.load(f)
+        sets = SetIndex(FpsCheck(fps_sites, etlds, set()).load_sets())
+        return cls(etlds, sets, generation)
+
+    def answer(self, query):
+        """Answers one query, a dictionary with an "op" and its arguments
+
+        The ops are "lookup" (site) for the set and role of a listed site,
+        "same_set" (a, b) for whether two sites share a set, and
+        "etld_plus1" (host) for the registrable domain of a host, and the set
+        and role of that site.
+
+        Returns:
+            dictionary, with an "error" member if the query was not valid
+        """
+        op = query.get("op")
+        try:
+            if op == "lookup":
+                membership = self.sets.lookup(query["site"])
+                primary, role = membership or (None, None)
+                return {"site": query["site"], "primary": primary,
+                        "role": role}
+            if op == "same_set":
+                return {"a": query["a"], "b": query["b"],
+                        "same_set": self.sets.same_set(query["a"],
+                                                       query["b"])}
+            if op == "etld_plus1":
+                host, etld_plus1, primary, role = self.classifier.classify(
+                    query["host"])
+                # etld_plus1 is None for a public suffix such as co.uk
+                return {"host": host, "etld_plus1": etld_plus1,
+                        "is_etld_plus1": host is not None and Origin.parse(
+                            "https://" + host, self.etlds).is_eTLD_Plus1(),
+                        "primary": primary, "role": role}
+        except KeyError as inst:
+            return {"error": "Missing argument " + str(inst) + " for " + op}
+        except (TypeError, AttributeError):
+            return {"error": "Invalid arguments for " + str(op)}
+        return {"error": "Unknown op: " + str(op)}
+
+
+class IndexHolder:
+    """Holds the LookupIndex in use and swaps in a new one when the list or
+    the public suffix list change
+
+    A background thread checks the modification time of the list, and asks
+    the PslHandle for its current public suffix list, every poll_interval
+    seconds, or at once after request_reload() (e.g. on SIGHUP, which also
+    makes the PslHandle reload). The new index is built on that thread while
+    queries keep being answered from the old one, then replaces it in a
+    single assignment. If the new files fail to load, the old index stays in
+    use.
+
+  Attributes:
+    list_file: the path of first_party_sets.JSON
+    psl: the PslHandle holding the public suffix list
+    poll_interval: seconds between checks of the files
+    current: the LookupIndex queries are answered from
+  """
+    def __init__(self, list_file, psl, poll_interval=1.0):
+        self.list_file = list_file
+        self.psl = psl
+        self.poll_interval = poll_interval
+        self._stamp = self._list_stamp()
+        self.current = LookupIndex.load(list_file, psl.current()[0])
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _list_stamp(self):
+        try:
+            stat = os.stat(self.list_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def check(self, force=False):
+        """Reloads if the list or the public suffix list changed since the
+        last load, or if force
+
+        Returns:
+            boolean, True if a new index was swapped in
+        """
+        stamp = self._list_stamp()
+        try:
+            if force:
+                self.psl.request_reload()
+            etlds, _ = self.psl.current()
+            if (not force and stamp == self._stamp
+                    and etlds is self.current.etlds):
+                return False
+            self._stamp = stamp
+            index = LookupIndex.load(self.list_file, etlds,
+                                     self.current.generation + 1)
+        except (OSError, ValueError, KeyError, TypeError) as inst:
+            print("Keeping the current index, reloading failed: " + str(inst),
+                  file=sys.stderr)
+            return False
+        self.current = index
+        return True
+
+    def request_reload(self, *args):
+        """Makes the watcher reload now; usable as a signal handler"""
+        self._wake.set()
+
+    def start(self):
+        """Starts the background watcher thread"""
+        def watch():
+            while not self._stopped.is_set():
+                forced = self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                if not self._stopped.is_set():
+                    self.check(forced)
+
+        self._thread = threading.Thread(target=watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the watcher thread"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+
+class LookupHandler(http.server.BaseHTTPRequestHandler):
+    """Answers queries over HTTP/1.1, keeping connections alive
+
+    GET /lookup?site=..., /same_set?a=...&b=... and /etld_plus1?host=...
+    answer a single query, POST /batch answers a JSON list of queries (or an
+    object with a "queries" list) in order, and GET /health describes the
+    index in use. Every response is JSON.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        index = self.server.holder.current
+        if parts.path == "/health":
+            self._send(200, {"generation": index.generation,
+                             "loaded_at": index.loaded_at,
+                             "sets": len(index.sets),
+                             "sites": len(index.sets.set_ids)})
+            return
+        query = dict(parse_qsl(parts.query))
+        query["op"] = parts.path.strip("/")
+        result = index.answer(query)
+        self._send(400 if "error" in result else 200, result)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/batch":
+            self._send(404, {"error": "Unknown path: " + self.path})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            queries = json.loads(self.rfile.read(length))
+            if isinstance(queries, dict):
+                queries = queries["queries"]
+            if not isinstance(queries, list):
+                raise ValueError("Expected a list of queries")
+        except (ValueError, KeyError) as inst:
+            self._send(400, {"error": "Invalid batch: " + str(inst)})
+            return
+        if len(queries) > MAX_BATCH:
+            self._send(413, {"error": "At most " + str(MAX_BATCH)
+                             + " queries per batch"})
+            return
+        # Answer the whole batch from one index even if a reload lands
+        index = self.server.holder.current
+        self._send(200, {"results": [
+            index.answer(query) if isinstance(query, dict)
+            else {"error": "Invalid query"} for query in queries]})
+
+    def _send(self, status, result):
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LookupServer(http.server.ThreadingHTTPServer):
+    """Serves LookupHandler on a TCP address"""
+    daemon_threads = True
+
+    def __init__(self, address, holder):
+        super().__init__(address, LookupHandler)
+        self.holder = holder
+
+
+class UnixLookupServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """Serves LookupHandler on a Unix socket at path"""
+    daemon_threads = True
+
+    def __init__(self, path, holder):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, LookupHandler)
+        self.holder = holder
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def main():
+    args = sys.argv[1:]
+    input_file = 'first_party_sets.JSON'
+    input_prefix = ''
+    psl_cache = None
+    host = '127.0.0.1'
+    port = 8053
+    unix_socket = None
+    poll_interval = 1.0
+    opts, _ = getopt.getopt(args, "i:", ["data_directory=", "psl_cache=",
+                                         "host=", "port=", "unix_socket=",
+                                         "poll_interval="])
+    for opt, arg in opts:
+        if opt == '-i':
+            input_file = arg
+        if opt == '--data_directory':
+            input_prefix = arg
+        if opt == '--psl_cache':
+            psl_cache = arg
+        if opt == '--host':
+            host = arg
+        if opt == '--port':
+            port = int(arg)
+        if opt == '--unix_socket':
+            unix_socket = arg
+        if opt == '--poll_interval':
+            poll_interval = float(arg)
+
+    psl = PslHandle(input_prefix, psl_cache, 'compact', poll_interval)
+    holder = IndexHolder(input_file, psl, poll_interval)
+    # psl_refresh --notify_pid sends SIGHUP after writing a new list, which
+    # reloads it as well as first_party_sets.JSON
+    signal.signal(signal.SIGHUP, holder.request_reload)
+    holder.start()
+    if unix_socket:
+        server = UnixLookupServer(unix_socket, holder)
+        print("Serving on " + unix_socket)
+    else:
+        server = LookupServer((host, port), holder)
+        print("Serving on http://%s:%d" % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        holder.stop()
+
+
+if __name__ == '__main__':
+    main()
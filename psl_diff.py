@@ -0,0 +1,213 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsCheck import FpsCheck
+from Origin import Origin
+import getopt
+import json
+import os
+import sys
+from publicsuffix2 import PublicSuffixList
+
+
+def rule_set(psl):
+    """Returns the rules of a public suffix list, without their comments
+
+        Args:
+            psl: PublicSuffixList
+        Returns:
+            Set[string]
+    """
+    return {line.split()[0].lstrip('.') for line in psl.tlds}
+
+
+def changed_suffixes(old_psl, new_psl):
+    """Finds the suffixes whose rules differ between two public suffix lists
+
+        A rule that was added, removed or had its exception marker changed
+        only alters the trie along its own path, including parent nodes it
+        creates or removes, so only hosts under the suffix it names or under
+        one of its parents can be classified differently. The "!" of
+        exception rules and the "*." of wildcard rules are stripped to get
+        that suffix.
+
+        Args:
+            old_psl: PublicSuffixList
+            new_psl: PublicSuffixList
+        Returns:
+            Set[string]
+    """
+    suffixes = set()
+    for rule in rule_set(old_psl) ^ rule_set(new_psl):
+        rule = rule.lstrip('!')
+        while rule.startswith('*.'):
+            rule = rule[2:]
+        suffixes.add(rule)
+    return suffixes
+
+
+class SuffixIndex:
+    """Indexes the sites of a list by every suffix of their host
+
+  Attributes:
+    under: a dictionary of suffix->set of the sites whose host is that
+    suffix or ends with it, e.g. "co.uk" and "uk" for https://example.co.uk
+  """
+    def __init__(self, check_sets):
+        self.under = {}
+        for fps in check_sets.values():
+            for site, _role in fps.members():
+                host = Origin.parse(site).punycode_host
+                labels = host.split('.')
+                for i in range(len(labels)):
+                    self.under.setdefault('.'.join(labels[i:]), set()).add(
+                        site)
+
+    def affected_by(self, suffix):
+        """Returns the sites whose classification may depend on the rules for
+        suffix: those under it or under one of its parents, since a rule for
+        a.b.com also adds or removes the node for b.com that every host under
+        b.com is matched through"""
+        sites = set()
+        labels = suffix.split('.')
+        for i in range(len(labels)):
+            sites |= self.under.get('.'.join(labels[i:]), set())
+        return sites
+
+
+def diff_verdicts(fps_sites, old_psl, new_psl):
+    """Finds the sites whose eTLD+1 verdict flips between two public suffix
+    lists
+
+        Only the sites indexed under a suffix whose rules changed are
+        re-evaluated, once with each list.
+
+        Args:
+            fps_sites: the list of sets, in the format of
+            first_party_sets.JSON
+            old_psl: PublicSuffixList
+            new_psl: PublicSuffixList
+        Returns:
+            Tuple[List[string], List[string]], the sites that are newly valid
+            and newly invalid eTLD+1s, sorted
+    """
+    old_checker = FpsCheck(fps_sites, old_psl, set())
+    new_checker = FpsCheck(fps_sites, new_psl, set())
+    index = SuffixIndex(new_checker.load_sets())
+    affected = set()
+    for suffix in changed_suffixes(old_psl, new_psl):
+        affected |= index.affected_by(suffix)
+    newly_valid = []
+    newly_invalid = []
+    for site in sorted(affected):
+        was_valid = old_checker.is_eTLD_Plus1(site)
+        is_valid = new_checker.is_eTLD_Plus1(site)
+        if is_valid and not was_valid:
+            newly_valid.append(site)
+        elif was_valid and not is_valid:
+            newly_invalid.append(site)
+    return newly_valid, newly_invalid
+
+
+def verdict_matrix(fps_sites, icanns, psls):
+    """Evaluates the list under several public suffix lists in one pass
+
+        Args:
+            fps_sites: the list of sets, in the format of
+            first_party_sets.JSON
+            icanns: the set of ICANN country code TLDs
+            psls: a list of PublicSuffixList
+        Returns:
+            Tuple[Dict, Dict], the eTLD+1 verdicts of every site and the alias
+            verdicts of every (aliased site, variant) pair, as returned by
+            FpsCheck.eTLD_Plus1_verdicts and FpsCheck.alias_verdicts
+    """
+    checker = FpsCheck(fps_sites, None, icanns)
+    check_sets = checker.load_sets()
+    return (checker.eTLD_Plus1_verdicts(check_sets, psls),
+            checker.alias_verdicts(check_sets, psls))
+
+
+def print_matrix(names, site_verdicts, alias_verdicts, show_all=False):
+    """Prints the verdict matrix as tab separated rows, by default only those
+    whose verdict is not the same under every list"""
+    print("\t".join(["check", "site"] + names))
+
+    def row(check, site, verdicts):
+        if show_all or len(set(verdicts)) > 1:
+            print("\t".join([check, site] + [
+                "valid" if verdict else "invalid" for verdict in verdicts]))
+
+    for site, verdicts in sorted(site_verdicts.items()):
+        row("eTLD+1", site, verdicts)
+    for (aliased_site, site), verdicts in sorted(alias_verdicts.items()):
+        row("alias", site + " of " + aliased_site, verdicts)
+
+
+def main():
+    args = sys.argv[1:]
+    input_file = 'first_party_sets.JSON'
+    input_prefix = ''
+    old_file = None
+    new_file = 'effective_tld_names.dat'
+    candidate_files = []
+    matrix = False
+    show_all = False
+    opts, _ = getopt.getopt(args, "i:", ["old=", "new=", "candidate=",
+                                         "matrix", "all", "data_directory="])
+    for opt, arg in opts:
+        if opt == '-i':
+            input_file = arg
+        if opt == '--old':
+            old_file = arg
+        if opt == '--new':
+            new_file = arg
+        if opt == '--candidate':
+            candidate_files.append(arg)
+        if opt == '--matrix':
+            matrix = True
+        if opt == '--all':
+            show_all = True
+        if opt == '--data_directory':
+            input_prefix = arg
+    if not old_file:
+        print("Usage: psl_diff.py --old=<old .dat> [--new=<new .dat>] "
+              "[-i <list>] [--matrix [--candidate=<.dat>]... [--all]]")
+        sys.exit(2)
+
+    with open(input_file) as f:
+        fps_sites = json.load(f)
+    if matrix:
+        # One column per list, each site parsed once for all of them
+        files = [old_file, new_file] + candidate_files
+        icanns = set()
+        with open(os.path.join(input_prefix, 'ICANN_domains')) as f:
+            for line in f:
+                icanns.add(line.strip())
+        site_verdicts, alias_verdicts = verdict_matrix(
+            fps_sites, icanns, [PublicSuffixList(name) for name in files])
+        print_matrix(files, site_verdicts, alias_verdicts, show_all)
+        return
+    newly_valid, newly_invalid = diff_verdicts(
+        fps_sites, PublicSuffixList(old_file), PublicSuffixList(new_file))
+    for site in newly_valid:
+        print("Newly valid eTLD+1: " + site)
+    for site in newly_invalid:
+        print("Newly invalid eTLD+1: " + site)
+    if not newly_valid and not newly_invalid:
+        print("No eTLD+1 verdicts changed", end='')
+
+
+if __name__ == '__main__':
+    main()
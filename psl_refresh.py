@@ -0,0 +1,360 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from FpsFiles import write_atomically
+import getopt
+import hashlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request
+from urllib.request import urlopen
+from publicsuffix2 import (BACKENDS, PSL_URL, PublicSuffixList,
+                          snapshot_header, snapshot_path)
+
+ICANN_BEGIN = "// ===BEGIN ICANN DOMAINS==="
+ICANN_END = "// ===END ICANN DOMAINS==="
+# A list with fewer rules than this is taken to be truncated or an error page
+MIN_RULES = 1000
+
+
+class InvalidListError(Exception):
+    """Raised when a fetched list does not look like a public suffix list"""
+
+
+def icann_cctlds(lines):
+    """Derives the country code TLDs from the ICANN section of a public suffix
+    list: the two letter ASCII last labels of its rules
+
+        Args:
+            lines: the lines of the list
+        Returns:
+            Set[string]
+    """
+    cctlds = set()
+    in_icann = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith(ICANN_BEGIN):
+            in_icann = True
+        elif line.startswith(ICANN_END):
+            break
+        elif in_icann and line and not line.startswith("//"):
+            tld = line.split()[0].lstrip("!").rsplit(".", 1)[-1].lower()
+            if len(tld) == 2 and tld.isascii() and tld.isalpha():
+                cctlds.add(tld)
+    return cctlds
+
+
+def validate_list(lines, min_rules=MIN_RULES):
+    """Checks that lines are a complete public suffix list and compiles it
+
+        Args:
+            lines: the lines of the list
+            min_rules: the smallest number of rules to accept
+        Returns:
+            PublicSuffixList
+        Raises:
+            InvalidListError if the ICANN section is missing, there are too
+            few rules or "com" is not a public suffix
+    """
+    if not any(line.startswith(ICANN_BEGIN) for line in lines):
+        raise InvalidListError("The list has no ICANN section")
+    psl = PublicSuffixList(lines)
+    if len(psl.tlds) < min_rules:
+        raise InvalidListError(
+            "The list has only " + str(len(psl.tlds)) + " rules, expected at"
+            + " least " + str(min_rules))
+    if psl.get_tld("example.com", strict=True) != "com":
+        raise InvalidListError("The list does not make com a public suffix")
+    return psl
+
+
+class PslRefresher:
+    """Refreshes effective_tld_names.dat, its compiled snapshots and
+    ICANN_domains from a public suffix list URL
+
+    The ETag, Last-Modified and SHA-256 of the last list written are kept in
+    a sidecar JSON file next to the list, so that the next refresh can ask
+    the server for the list only if it changed. file:// URLs work too, for
+    local mirrors; since they carry no ETag, an unchanged mirror is detected
+    by its hash.
+
+    ICANN_domains is curated by hand and changes the verdicts of the alias
+    check, so the ccTLDs derived from the list only replace it when it does
+    not exist yet or update_icann is set. Otherwise the differences are left
+    in icann_changes for review.
+
+  Attributes:
+    url: the URL of the list
+    psl_file: the path effective_tld_names.dat is written to
+    icann_file: the path the derived ccTLDs are written to
+    cache_files: a dictionary of backend->path of the compiled snapshots,
+    one per PublicSuffixList backend; cache_file replaces the path of the
+    trie snapshot
+    state_file: the path of the sidecar JSON
+    min_rules: the smallest number of rules a valid list has
+    update_icann: whether to replace an existing icann_file with the derived
+    ccTLDs
+    icann_changes: the (added, removed) sorted lists of ccTLDs by which the
+    derived ccTLDs differ from icann_file, as of the last refresh that
+    fetched a changed list
+  """
+    def __init__(self, url=PSL_URL, data_directory="", cache_file=None,
+                 min_rules=MIN_RULES, update_icann=False):
+        self.url = url
+        self.psl_file = os.path.join(data_directory, "effective_tld_names.dat")
+        self.icann_file = os.path.join(data_directory, "ICANN_domains")
+        self.cache_files = {backend: snapshot_path(self.psl_file, backend)
+                            for backend in BACKENDS}
+        if cache_file:
+            self.cache_files["trie"] = cache_file
+        self.state_file = self.psl_file + ".refresh.json"
+        self.min_rules = min_rules
+        self.update_icann = update_icann
+        self.icann_changes = ([], [])
+
+    def load_icann(self):
+        """Returns the set of ccTLDs in icann_file, or None if it does not
+        exist"""
+        try:
+            with open(self.icann_file) as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return None
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def fetch(self, state):
+        """Fetches the list, conditionally on the validators in state
+
+        Returns:
+            Tuple[bytes, Dict], the body and the response headers, or
+            (None, None) if the server answered 304 Not Modified
+        """
+        headers = {"User-Agent": "python-publicsuffix2"}
+        if state.get("url") == self.url:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+        try:
+            with urlopen(Request(self.url, headers=headers), timeout=30) as res:
+                return res.read(), res.headers
+        except HTTPError as inst:
+            if inst.code == 304:
+                return None, None
+            raise
+
+    def refresh(self, force=False):
+        """Fetches the list and, if it changed, validates it and writes the
+        list and the snapshots, and the ccTLDs if icann_file does not exist or
+        update_icann is set
+
+        Args:
+            force: fetch unconditionally and rewrite the files even if the
+            list did not change
+        Returns:
+            boolean, True if the files were rewritten
+        Raises:
+            InvalidListError if the fetched list is not valid; nothing is
+            written in that case
+        """
+        state = {} if force else self.load_state()
+        body, headers = self.fetch(state)
+        if body is None:
+            return False
+        digest = hashlib.sha256(body).hexdigest()
+        if (not force and digest == state.get("sha256")
+                and os.path.exists(self.psl_file)):
+            return False
+        lines = body.decode("utf8").splitlines()
+        psl = validate_list(lines, self.min_rules)
+        cctlds = icann_cctlds(lines)
+        current = self.load_icann()
+        if current is None:
+            self.icann_changes = ([], [])
+        else:
+            self.icann_changes = (sorted(cctlds - current),
+                                  sorted(current - cctlds))
+
+        # Write the list first: the snapshots are keyed by the hash of the
+        # list, so a reader between the writes rebuilds them rather than
+        # loading a stale one
+        write_atomically(self.psl_file, body)
+        for backend, cache_file in self.cache_files.items():
+            compiled = (psl if backend == "trie"
+                        else PublicSuffixList(lines, backend=backend))
+            compiled.write_snapshot(cache_file,
+                                    snapshot_header(body, backend=backend))
+        if current is None or self.update_icann:
+            write_atomically(self.icann_file,
+                             "\n".join(sorted(cctlds)).encode("ascii"))
+        write_atomically(self.state_file, json.dumps({
+            "url": self.url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "sha256": digest,
+            "rules": len(psl.tlds),
+            "cctlds": len(cctlds),
+            "refreshed": time.time(),
+        }, indent=2).encode("utf8"))
+        return True
+
+
+class PslHandle:
+    """Holds the public suffix list and ccTLDs of a long-running process and
+    swaps in new ones when psl_refresh rewrites them
+
+    The files are reloaded when the modification time of the list changes,
+    checked at most every poll_interval seconds, or on the next call after a
+    SIGHUP once install_signal_handler() has been called. A reload builds
+    the new objects fully before replacing the pair in one assignment, so
+    callers never see a list from one version with ccTLDs from another.
+
+  Attributes:
+    psl_file: the path of effective_tld_names.dat
+    icann_file: the path of ICANN_domains
+    cache_file: the path of the compiled snapshot, or None for the default
+    path of the backend
+    backend: the PublicSuffixList backend, 'trie' or 'compact'
+    poll_interval: the smallest number of seconds between checks of the
+    list's modification time
+    reloads: the number of times the files were loaded
+  """
+    def __init__(self, data_directory="", cache_file=None, backend="trie",
+                 poll_interval=1.0):
+        self.psl_file = os.path.join(data_directory, "effective_tld_names.dat")
+        self.icann_file = os.path.join(data_directory, "ICANN_domains")
+        self.cache_file = cache_file
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._reload_requested = False
+        self._checked = 0.0
+        self._mtime = None
+        self._current = None
+        self.reload()
+
+    def reload(self):
+        """Loads the list and ccTLDs from disk and swaps them in"""
+        with self._lock:
+            mtime = os.stat(self.psl_file).st_mtime_ns
+            etlds = PublicSuffixList.cached(self.psl_file,
+                                            cache_file=self.cache_file,
+                                            backend=self.backend)
+            with open(self.icann_file) as f:
+                icanns = {line.strip() for line in f if line.strip()}
+            self._current = (etlds, icanns)
+            self._mtime = mtime
+            self._checked = time.monotonic()
+            self._reload_requested = False
+            self.reloads += 1
+
+    def request_reload(self, *args):
+        """Makes the next call to current() reload; usable as a signal
+        handler"""
+        self._reload_requested = True
+
+    def install_signal_handler(self):
+        """Reloads on SIGHUP. Must be called from the main thread."""
+        signal.signal(signal.SIGHUP, self.request_reload)
+
+    def current(self):
+        """Returns the (PublicSuffixList, set of ccTLDs) pair in use, reloading
+        it first if the files changed"""
+        now = time.monotonic()
+        if self._reload_requested:
+            self.reload()
+        elif now - self._checked >= self.poll_interval:
+            self._checked = now
+            try:
+                changed = os.stat(self.psl_file).st_mtime_ns != self._mtime
+            except OSError:
+                changed = False
+            if changed:
+                self.reload()
+        return self._current
+
+
+def main():
+    args = sys.argv[1:]
+    url = PSL_URL
+    input_prefix = ''
+    psl_cache = None
+    min_rules = MIN_RULES
+    notify_pids = []
+    force = False
+    update_icann = False
+    opts, _ = getopt.getopt(args, "", ["url=", "data_directory=",
+                                       "psl_cache=", "min_rules=",
+                                       "notify_pid=", "force",
+                                       "update_icann"])
+    for opt, arg in opts:
+        if opt == '--url':
+            url = arg
+        if opt == '--data_directory':
+            input_prefix = arg
+        if opt == '--psl_cache':
+            psl_cache = arg
+        if opt == '--min_rules':
+            min_rules = int(arg)
+        if opt == '--notify_pid':
+            notify_pids += [int(pid) for pid in arg.split(",") if pid]
+        if opt == '--force':
+            force = True
+        if opt == '--update_icann':
+            update_icann = True
+
+    refresher = PslRefresher(url, input_prefix, psl_cache, min_rules,
+                             update_icann)
+    try:
+        updated = refresher.refresh(force)
+    except InvalidListError as inst:
+        print("The fetched list was rejected: " + str(inst))
+        sys.exit(1)
+    if not updated:
+        print("The public suffix list is up to date", end='')
+        return
+    state = refresher.load_state()
+    print("Updated the public suffix list: " + str(state["rules"])
+          + " rules, " + str(state["cctlds"]) + " ccTLDs")
+    added, removed = refresher.icann_changes
+    if added or removed:
+        print(("Replaced" if update_icann else "Kept") + " ICANN_domains,"
+              + " which differs from the ccTLDs of the list")
+        print("  added: " + (", ".join(added) or "none"))
+        print("  removed: " + (", ".join(removed) or "none"))
+        if not update_icann:
+            print("Rerun with --force --update_icann to replace it")
+    # Long-running processes holding a PslHandle reload on SIGHUP
+    for pid in notify_pids:
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as inst:
+            print("Could not notify " + str(pid) + ": " + str(inst))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,18 @@
 import unittest
+import contextlib
+import json
+import http.client
+import http.server
+import io
+import os
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import FpsVendored  # noqa: F401 (must come before the vendored libraries)
 from jsonschema import ValidationError
 from publicsuffix2 import PublicSuffixList
 from unittest import mock
@@ -8,7 +21,32 @@ from requests import structures
 sys.path.append('../first-party-sets')
 from FpsSet import FpsSet
 from FpsCheck import FpsCheck
-from check_sites import find_diff_sets
+import check_sites
+from check_sites import (batch_submission, check_errors, check_list,
+                         find_diff_sets, find_submission_conflicts,
+                         merge_reports, parse_shard, prefetch, run_batch,
+                         run_checks, shard_of)
+import classify_hosts
+from classify_hosts import (HostClassifier, classify_sharded,
+                            classify_stream, host_of, load_classifier)
+from psl_diff import SuffixIndex, changed_suffixes, diff_verdicts
+from psl_refresh import (InvalidListError, PslHandle, PslRefresher,
+                         icann_cctlds)
+from FpsArtifact import FpsArtifact, write_artifact
+from fps_server import IndexHolder, LookupServer, UnixLookupServer
+from FpsMemory import MemoryCeilingExceeded, MemoryReport
+from FpsMetrics import RunMetrics
+from FpsPool import OFFLINE_CHECKS, CheckPool, WorkerError
+from FpsQuery import SetIndex
+from FpsResultCache import ResultCache, set_fingerprint
+from FpsScheduler import DAY, RollingScheduler
+from Origin import Origin
+from FpsTrace import TraceRecorder
+from FpsTransport import (CachingTransport, CassetteMissError,
+                          ObservedTransport, RecordingTransport,
+                          ReplayTransport, Response, install_phase_timers)
+from validation_server import JobQueue, ValidationServer, Validator
+from web_farm import HostProfile, WebFarm, synthetic_sets
 
 class TestValidateSchema(unittest.TestCase):
     """A test suite for the validate_schema function of FpsCheck"""
@@ -254,6 +292,42 @@ class TestHasRationales(unittest.TestCase):
         ["There is no provided rationale for https://associated1.com", 
         "There is no provided rationale for https://service1.com"])
     
+    def test_one_set_at_a_time(self):
+        json_dict = {
+            "sets":
+            [
+                {
+                    "primary": "https://primary.com",
+                    "associatedSites": ["https://associated1.com"],
+                    "rationaleBySite": {}
+                },
+                {
+                    "primary": "https://other.com",
+                    "associatedSites": ["https://associated2.com"]
+                },
+                {
+                    "primary": "https://primary.com",
+                    "serviceSites": ["https://service1.com"],
+                    "rationaleBySite": {}
+                }
+            ]
+        }
+        fp = FpsCheck(fps_sites=json_dict,
+                      etlds=None,
+                       icanns=set())
+        loaded_sets = fp.load_sets()
+        fp.error_list = []
+        fp.has_all_rationales({"https://primary.com":
+                               loaded_sets["https://primary.com"]})
+        self.assertEqual(fp.error_list, 
+        ["There is no provided rationale for https://associated1.com", 
+        "There is no provided rationale for https://service1.com"])
+        fp.error_list = []
+        fp.has_all_rationales(loaded_sets)
+        self.assertEqual(fp.error_list[1],
+        "A rationaleBySite field is required for this set, but none is "
+        + "provided. ")
+
     def test_expected_rationales_case(self):
         json_dict = {
             "sets":
@@ -477,6 +551,27 @@ class TestFindInvalidETLD(unittest.TestCase):
         self.assertEqual(fp.error_list, 
          ["The provided aliased site is not an eTLD+1: https://primary.c2om"])
                 
+    def test_invalid_etld_mixed_case(self):
+        json_dict = {
+            "sets":
+            [
+                {
+                    "primary": "https://primary.com",
+                    "associatedSites": ["https://Associated1.com"],
+                    "rationaleBySite": {}
+                }
+            ]
+        }
+        fp = FpsCheck(fps_sites=json_dict,
+                     etlds=PublicSuffixList(
+                        psl_file = 'effective_tld_names.dat'),
+                     icanns=set())
+        loaded_sets = fp.load_sets()
+        fp.find_invalid_eTLD_Plus1(loaded_sets)
+        self.assertEqual(fp.error_list, 
+         ["The provided associated site is not an eTLD+1: " +
+          "https://Associated1.com"])
+                
     def test_multi_invalid_etlds(self):
         json_dict = {
             "sets":
@@ -1274,5 +1369,1494 @@ class MockTestsClass(unittest.TestCase):
         fp.find_invalid_well_known(loaded_sets)
         self.assertEqual(fp.error_list, [])
 
+class TestWebFarm(unittest.TestCase):
+    """Runs the network checks against a local WebFarm"""
+
+    def test_clean_synthetic_list(self):
+        fps_sites, profiles = synthetic_sets(3, scheme="http")
+        fp = FpsCheck(fps_sites=fps_sites,
+                     etlds=None,
+                     icanns=set())
+        loaded_sets = fp.load_sets()
+        with WebFarm(profiles) as farm, farm.resolver_override():
+            fp.find_invalid_well_known(loaded_sets)
+            fp.find_robots_txt(loaded_sets)
+            fp.find_ads_txt(loaded_sets)
+            fp.check_for_service_redirect(loaded_sets)
+        self.assertEqual(fp.error_list, [])
+        self.assertEqual(farm.request_count, 27)
+
+    def test_misconfigured_service(self):
+        json_dict = {
+            "sets":
+            [
+                {
+                    "primary": "http://primary.test",
+                    "serviceSites": ["http://service.test"]
+                }
+            ]
+        }
+        profiles = {"service.test": HostProfile(ads_txt=True)}
+        fp = FpsCheck(fps_sites=json_dict,
+                     etlds=None,
+                     icanns=set())
+        loaded_sets = fp.load_sets()
+        with WebFarm(profiles) as farm, farm.resolver_override():
+            fp.find_ads_txt(loaded_sets)
+            fp.check_for_service_redirect(loaded_sets)
+        self.assertEqual(fp.error_list, ["The service site " +
+        "http://service.test has an ads.txt file, this violates the " +
+        "policies for service sites",
+        "The service site must not be an endpoint: http://service.test"])
+
+class TestRecordReplay(unittest.TestCase):
+    """Records the network checks against a WebFarm and replays them"""
+
+    def run_checks(self, fps_sites, transport):
+        fp = FpsCheck(fps_sites=fps_sites,
+                     etlds=None,
+                     icanns=set(),
+                     transport=transport)
+        loaded_sets = fp.load_sets()
+        fp.find_invalid_well_known(loaded_sets)
+        fp.find_robots_txt(loaded_sets)
+        fp.find_ads_txt(loaded_sets)
+        fp.check_for_service_redirect(loaded_sets)
+        return fp.error_list
+
+    def test_replay_matches_recording(self):
+        fps_sites, profiles = synthetic_sets(
+            4, scheme="http", misconfig_rate=0.5, seed=3)
+        profiles["s1-0.fps-bench.test"].failure = "reset"
+        with tempfile.TemporaryDirectory() as tmp:
+            cassette = os.path.join(tmp, "cassette.json")
+            recorder = RecordingTransport(cassette)
+            with WebFarm(profiles) as farm, farm.resolver_override():
+                recorded_errors = self.run_checks(fps_sites, recorder)
+            recorder.save()
+            replayed_errors = self.run_checks(
+                fps_sites, ReplayTransport(cassette))
+        self.assertNotEqual(recorded_errors, [])
+        self.assertEqual(replayed_errors, recorded_errors)
+
+    def test_cassette_miss(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cassette = os.path.join(tmp, "cassette.json")
+            RecordingTransport(cassette).save()
+            with self.assertRaises(CassetteMissError):
+                ReplayTransport(cassette).get("https://service1.com")
+
+class TestRunMetrics(unittest.TestCase):
+    """Checks the per-stage counters collected by RunMetrics"""
+
+    @mock.patch('requests.get', side_effect=mock_get)
+    def test_stage_counters(self, mock_get):
+        json_dict = {
+            "sets":
+            [
+                {
+                    "primary": "https://primary.com",
+                    "serviceSites": ["https://service1.com"]
+                }
+            ]
+        }
+        metrics = RunMetrics()
+        fp = FpsCheck(fps_sites=json_dict,
+                     etlds=None,
+                     icanns=set(),
+                     transport=ObservedTransport(observers=[metrics]))
+        metrics.error_count = lambda: len(fp.error_list)
+        loaded_sets = fp.load_sets()
+        with metrics.stage("find_ads_txt", 2):
+            fp.find_ads_txt(loaded_sets)
+        stage = metrics.stages[0]
+        self.assertEqual((stage.name, stage.sites, stage.http_requests,
+                          stage.errors), ("find_ads_txt", 2, 1, 1))
+        self.assertEqual(metrics.hosts["service1.com"].count, 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            prom_file = os.path.join(tmp, "fps.prom")
+            metrics.write_prometheus(prom_file)
+            with open(prom_file) as f:
+                prom = f.read()
+        self.assertIn('fps_stage_errors{stage="find_ads_txt"} 1', prom)
+        self.assertIn('fps_http_request_duration_seconds_count'
+                      + '{host="service1.com"} 1', prom)
+
+class TestTraceRecorder(unittest.TestCase):
+    """Checks the spans recorded for a traced check against a WebFarm"""
+
+    def test_check_set_and_fetch_spans(self):
+        fps_sites, profiles = synthetic_sets(2, scheme="http")
+        with tempfile.TemporaryDirectory() as tmp:
+            tracer = TraceRecorder(os.path.join(tmp, "trace.json"))
+            install_phase_timers()
+            fp = FpsCheck(fps_sites=fps_sites,
+                         etlds=None,
+                         icanns=set(),
+                         transport=ObservedTransport(observers=[tracer]))
+            loaded_sets = tracer.traced_sets(fp.load_sets())
+            with WebFarm(profiles) as farm, farm.resolver_override():
+                with tracer.stage("find_ads_txt"):
+                    fp.find_ads_txt(loaded_sets)
+            tracer.save()
+        spans = [(e["cat"], e["name"]) for e in tracer.events]
+        self.assertIn(("stage", "find_ads_txt"), spans)
+        self.assertIn(("set", "http://p1.fps-bench.test"), spans)
+        self.assertIn(("http", "s0-0.fps-bench.test/ads.txt"), spans)
+        self.assertIn(("http_phase", "connect"), spans)
+
+    def test_prefetch_reports_queue_wait(self):
+        fetches = []
+        observer = mock.Mock(on_fetch=fetches.append)
+        slow = mock.Mock(spec=["get"],
+                         get=lambda url, **kwargs: time.sleep(0.05)
+                         or Response(url, 200, {}, b""))
+        transport = CachingTransport(ObservedTransport(slow, [observer]))
+        prefetch(transport, [("get", "https://a.test/"),
+                             ("get", "https://b.test/")], workers=1)
+        self.assertEqual(fetches[0].url, "https://a.test/")
+        # The second request waited for the only worker to finish the first
+        self.assertGreater(fetches[1].queue_s, 0.04)
+
+    def test_fetch_without_hostname_keeps_its_error(self):
+        tracer = TraceRecorder("trace.json")
+        failing = mock.Mock(spec=["get"],
+                            get=mock.Mock(side_effect=ValueError("no scheme")))
+        transport = ObservedTransport(failing, [tracer])
+        with self.assertRaisesRegex(ValueError, "no scheme"):
+            transport.get("primary.com/ads.txt")
+        self.assertEqual(tracer.events[0]["name"], "primary.com/ads.txt")
+        self.assertEqual(tracer.events[0]["args"]["error"], "no scheme")
+
+class TestMemoryReport(unittest.TestCase):
+    """Checks that MemoryReport attributes allocations to stages"""
+
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def test_stage_accounting(self):
+        report = MemoryReport()
+        with report.stage("psl_load"):
+            etlds = PublicSuffixList(psl_file='effective_tld_names.dat')
+        with report.stage("noop"):
+            pass
+        psl_stage, noop_stage = report.stages
+        self.assertGreater(psl_stage.retained_bytes, 1024 * 1024)
+        self.assertEqual(psl_stage.top_modules[0][0], "publicsuffix2")
+        self.assertLess(abs(noop_stage.delta_bytes), 64 * 1024)
+        self.assertIsNotNone(etlds)
+
+    def test_ceiling(self):
+        report = MemoryReport(limit_bytes=1024 * 1024)
+        with self.assertRaises(MemoryCeilingExceeded) as raised:
+            with report.stage("load_sets"):
+                blocks = [bytes(1024) for _ in range(2048)]
+        self.assertIn("exceeded during load_sets", str(raised.exception))
+        self.assertEqual(len(blocks), 2048)
+
+class TestPslLookup(unittest.TestCase):
+    """Checks the single-pass lookup of PublicSuffixList"""
+
+    def setUp(self):
+        self.psl = PublicSuffixList(psl_file='effective_tld_names.dat')
+
+    def test_lookup_matches_get_tld_and_get_sld(self):
+        for domain in ["www.google.co.uk", "7.bg", "com", "primary.c2om",
+                       "a.city.kawasaki.jp", "foo.bar.kawasaki.jp",
+                       "x.s3.amazonaws.com", "Example.COM."]:
+            for strict in (True, False):
+                for wildcard in (True, False):
+                    self.assertEqual(
+                        self.psl.lookup(domain, wildcard, strict)[:2],
+                        (self.psl.get_tld(domain, wildcard, strict),
+                         self.psl.get_sld(domain, wildcard, strict)))
+
+    def test_lookup_values(self):
+        self.assertEqual(self.psl.lookup("www.google.co.uk"),
+                         ("co.uk", "google.co.uk", False))
+        self.assertEqual(self.psl.lookup("co.uk"), ("co.uk", "co.uk", True))
+        self.assertEqual(self.psl.lookup("city.kawasaki.jp"),
+                         ("kawasaki.jp", "city.kawasaki.jp", False))
+        self.assertEqual(self.psl.lookup("primary.c2om", strict=True),
+                         (None, None, False))
+
+class TestVendored(unittest.TestCase):
+    """Checks that the entry points find the libraries in third_party"""
+
+    def test_entry_point_without_pythonpath(self):
+        root = os.path.dirname(FpsVendored.THIRD_PARTY)
+        env = {k: v for k, v in os.environ.items() if k != "PYTHONPATH"}
+        # the directory of a script run with python3 comes first on sys.path
+        code = ("import sys; sys.path.insert(0, %r); import check_sites, "
+                "publicsuffix2; print(publicsuffix2.__file__)" % root)
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run([sys.executable, "-c", code], cwd=tmp,
+                                    env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout.startswith(FpsVendored.THIRD_PARTY))
+
+class TestPslSnapshot(unittest.TestCase):
+    """Checks the compiled snapshot cache of PublicSuffixList"""
+
+    def test_snapshot_roundtrip_and_rebuild(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            psl_file = os.path.join(tmp, "effective_tld_names.dat")
+            with open(psl_file, "w") as f:
+                f.write("com\nuk\nco.uk\n")
+            built = PublicSuffixList.cached(psl_file)
+            self.assertTrue(os.path.exists(psl_file + ".trie.snapshot"))
+            loaded = PublicSuffixList.cached(psl_file)
+            self.assertEqual(loaded.root, built.root)
+            self.assertEqual(loaded.tlds, built.tlds)
+            self.assertEqual(loaded.get_sld("www.example.co.uk"),
+                             "example.co.uk")
+            # Changing the list invalidates the snapshot
+            with open(psl_file, "a") as f:
+                f.write("example.co.uk\n")
+            rebuilt = PublicSuffixList.cached(psl_file)
+            self.assertEqual(rebuilt.get_sld("www.example.co.uk"),
+                             "www.example.co.uk")
+
+    def test_corrupt_snapshot_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            psl_file = os.path.join(tmp, "effective_tld_names.dat")
+            with open(psl_file, "w") as f:
+                f.write("com\n")
+            with open(psl_file + ".trie.snapshot", "wb") as f:
+                f.write(b"garbage")
+            psl = PublicSuffixList.cached(psl_file)
+            self.assertEqual(psl.get_tld("example.com"), "com")
+
+class TestClassifyMany(unittest.TestCase):
+    """Checks the batch classification of PublicSuffixList"""
+
+    def setUp(self):
+        self.psl = PublicSuffixList(psl_file='effective_tld_names.dat')
+        self.domains = ["www.google.co.uk", "co.uk", "google.co.uk",
+                        "Google.CO.UK.", "primary.c2om", "", "com",
+                        "a.city.kawasaki.jp", "city.kawasaki.jp",
+                        "x.s3.amazonaws.com", "www.google.co.uk"]
+
+    def test_columns_match_lookup(self):
+        for strict in (True, False):
+            for wildcard in (True, False):
+                columns = self.psl.classify_many(self.domains, wildcard,
+                                                 strict)
+                self.assertEqual(columns["domain"], self.domains)
+                expected = [self.psl.lookup(domain.lower().strip("."),
+                                            wildcard, strict)
+                            for domain in self.domains]
+                self.assertEqual(columns["suffix"],
+                                 [tld for tld, _, _ in expected])
+                self.assertEqual(columns["etld_plus1"],
+                                 [sld for _, sld, _ in expected])
+
+    def test_is_etld_plus1(self):
+        columns = self.psl.classify_many(self.domains, strict=True)
+        self.assertEqual(columns["is_etld_plus1"],
+                         [False, False, True, True, False, False, False,
+                          False, True, True, False])
+
+    def test_process_pool_matches_serial(self):
+        serial = self.psl.classify_many(self.domains, strict=True)
+        pooled = self.psl.classify_many(self.domains, strict=True,
+                                        processes=2, chunksize=3)
+        self.assertEqual(pooled, serial)
+
+class TestOrigin(unittest.TestCase):
+    """Checks the parsing and interning of Origin"""
+
+    def setUp(self):
+        self.psl = PublicSuffixList(psl_file='effective_tld_names.dat')
+
+    def test_fields(self):
+        origin = Origin.parse("https://www.Example.co.uk", self.psl)
+        self.assertEqual(origin.scheme, "https")
+        self.assertEqual(origin.host, "www.Example.co.uk")
+        self.assertEqual(origin.punycode_host, "www.example.co.uk")
+        self.assertEqual(origin.etld, "co.uk")
+        self.assertEqual(origin.etld_plus1, "example.co.uk")
+        self.assertEqual(origin.esld, "example")
+        self.assertEqual(origin.tld, "uk")
+        self.assertFalse(origin.is_eTLD_Plus1())
+
+    def test_without_public_suffix_list(self):
+        origin = Origin.parse("https://example.co.uk")
+        self.assertIsNone(origin.etld)
+        self.assertIsNone(origin.etld_plus1)
+        self.assertEqual(origin.esld, "example")
+        self.assertEqual(origin.tld, "uk")
+
+    def test_interned(self):
+        self.assertIs(Origin.parse("https://example.com", self.psl),
+                      Origin.parse("https://example.com", self.psl))
+
+    def test_mixed_case_host_is_not_etld_plus1(self):
+        origin = Origin.parse("https://Example.com", self.psl)
+        self.assertEqual(origin.etld_plus1, "example.com")
+        self.assertFalse(origin.is_eTLD_Plus1())
+
+    def test_idna_host(self):
+        origin = Origin.parse("https://b\u00fccher.de", self.psl)
+        self.assertEqual(origin.punycode_host, "xn--bcher-kva.de")
+        self.assertTrue(origin.is_eTLD_Plus1())
+
+    def test_immutable(self):
+        origin = Origin.parse("https://example.com")
+        with self.assertRaises(AttributeError):
+            origin.host = "example.org"
+
+class TestPslDiff(unittest.TestCase):
+    """Checks the incremental re-evaluation of eTLD+1 verdicts"""
+
+    def setUp(self):
+        self.fps_sites = {"sets": [{
+            "primary": "https://example.co.uk",
+            "associatedSites": ["https://a.blogspot.com",
+                                "https://blogspot.com",
+                                "https://example.org"]}]}
+        self.old_psl = PublicSuffixList(["com", "org", "uk", "co.uk"])
+
+    def test_changed_suffixes(self):
+        new_psl = PublicSuffixList(["com", "org", "uk", "*.co.uk",
+                                    "!www.co.uk", "blogspot.com"])
+        self.assertEqual(changed_suffixes(self.old_psl, new_psl),
+                         {"co.uk", "www.co.uk", "blogspot.com"})
+
+    def test_affected_sites(self):
+        checker = FpsCheck(self.fps_sites, None, set())
+        index = SuffixIndex(checker.load_sets())
+        self.assertEqual(index.affected_by("blogspot.com"),
+                         {"https://a.blogspot.com", "https://blogspot.com"})
+        self.assertEqual(index.affected_by("x.example.org"),
+                         {"https://example.org"})
+
+    def test_added_rule(self):
+        new_psl = PublicSuffixList(["com", "org", "uk", "co.uk",
+                                    "blogspot.com"])
+        self.assertEqual(
+            diff_verdicts(self.fps_sites, self.old_psl, new_psl),
+            (["https://a.blogspot.com"], ["https://blogspot.com"]))
+
+    def test_rule_under_new_parent_node(self):
+        fps_sites = {"sets": [{"primary": "https://x.b.com"}]}
+        old_psl = PublicSuffixList(["com"])
+        new_psl = PublicSuffixList(["com", "a.b.com"])
+        self.assertFalse(FpsCheck(fps_sites, old_psl, set())
+                         .is_eTLD_Plus1("https://x.b.com"))
+        self.assertEqual(diff_verdicts(fps_sites, old_psl, new_psl),
+                         (["https://x.b.com"], []))
+
+    def test_removed_rule(self):
+        new_psl = PublicSuffixList(["com", "org", "uk"])
+        self.assertEqual(
+            diff_verdicts(self.fps_sites, self.old_psl, new_psl),
+            ([], ["https://example.co.uk"]))
+
+    def test_unchanged(self):
+        self.assertEqual(
+            diff_verdicts(self.fps_sites, self.old_psl, self.old_psl),
+            ([], []))
+
+class TestCompactBackend(unittest.TestCase):
+    """Checks that the compact backend answers like the trie"""
+
+    def setUp(self):
+        self.trie = PublicSuffixList(psl_file='effective_tld_names.dat')
+        self.compact = PublicSuffixList(psl_file='effective_tld_names.dat',
+                                        backend='compact')
+
+    def test_same_answers(self):
+        self.assertIsNone(self.compact.root)
+        for domain in ["www.google.co.uk", "co.uk", "7.bg", "com", "",
+                       "primary.c2om", "a.city.kawasaki.jp",
+                       "city.kawasaki.jp", "foo.bar.kawasaki.jp",
+                       "x.s3.amazonaws.com", "*.ck", "www.ck"]:
+            for strict in (True, False):
+                for wildcard in (True, False):
+                    self.assertEqual(
+                        self.compact.lookup(domain, wildcard, strict),
+                        self.trie.lookup(domain, wildcard, strict))
+
+    def test_classify_many(self):
+        domains = ["www.google.co.uk", "co.uk", "", "city.kawasaki.jp"]
+        self.assertEqual(self.compact.classify_many(domains, strict=True),
+                         self.trie.classify_many(domains, strict=True))
+
+    def test_tlds_kept_as_one_string(self):
+        self.assertIsInstance(self.compact._tlds, str)
+        self.assertEqual(self.compact.tlds, self.trie.tlds)
+        self.assertEqual(PublicSuffixList([], backend='compact').tlds, [])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            PublicSuffixList(["com"], backend="dawg")
+
+    def test_snapshot_keyed_by_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            psl_file = os.path.join(tmp, "effective_tld_names.dat")
+            with open(psl_file, "w") as f:
+                f.write("com\nuk\nco.uk\n")
+            PublicSuffixList.cached(psl_file)
+            compact = PublicSuffixList.cached(psl_file, backend='compact')
+            self.assertEqual(compact.backend, 'compact')
+            loaded = PublicSuffixList.cached(psl_file, backend='compact')
+            self.assertEqual(loaded.table.blob, compact.table.blob)
+            self.assertEqual(loaded.get_sld("www.example.co.uk"),
+                             "example.co.uk")
+
+    def test_backends_keep_separate_snapshots(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            psl_file = os.path.join(tmp, "effective_tld_names.dat")
+            with open(psl_file, "w") as f:
+                f.write("com\nuk\nco.uk\n")
+            PublicSuffixList.cached(psl_file)
+            PublicSuffixList.cached(psl_file, backend='compact')
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ["effective_tld_names.dat",
+                              "effective_tld_names.dat.compact.snapshot",
+                              "effective_tld_names.dat.trie.snapshot"])
+            # Alternating backends loads each snapshot rather than
+            # rewriting the other's
+            with mock.patch.object(PublicSuffixList,
+                                   "write_snapshot") as write_snapshot:
+                for backend in ['trie', 'compact', 'trie']:
+                    PublicSuffixList.cached(psl_file, backend=backend)
+            write_snapshot.assert_not_called()
+
+TEST_PSL = """// ===BEGIN ICANN DOMAINS===
+com
+uk
+co.uk
+de
+*.ck
+!www.ck
+// ===END ICANN DOMAINS===
+// ===BEGIN PRIVATE DOMAINS===
+blogspot.com
+// ===END PRIVATE DOMAINS===
+"""
+
+
+class PslHandler(http.server.BaseHTTPRequestHandler):
+    """Serves TEST_PSL with an ETag, answering 304 when it matches"""
+    body = TEST_PSL.encode()
+    etag = '"v1"'
+    requests_seen = []
+
+    def do_GET(self):
+        PslHandler.requests_seen.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == PslHandler.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", PslHandler.etag)
+        self.send_header("Content-Length", str(len(PslHandler.body)))
+        self.end_headers()
+        self.wfile.write(PslHandler.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPslRefresh(unittest.TestCase):
+    """Checks the conditional refresh of the public suffix list"""
+
+    def setUp(self):
+        PslHandler.body = TEST_PSL.encode()
+        PslHandler.etag = '"v1"'
+        PslHandler.requests_seen = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), PslHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        self.url = "http://127.0.0.1:%d/list.dat" % self.server.server_port
+        self.tmp = tempfile.TemporaryDirectory()
+        self.refresher = PslRefresher(self.url, self.tmp.name, min_rules=3)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_icann_cctlds(self):
+        self.assertEqual(icann_cctlds(TEST_PSL.splitlines()),
+                         {"uk", "de", "ck"})
+
+    def test_refresh_writes_files(self):
+        self.assertTrue(self.refresher.refresh())
+        with open(self.refresher.psl_file) as f:
+            self.assertEqual(f.read(), TEST_PSL)
+        with open(self.refresher.icann_file) as f:
+            self.assertEqual(f.read().split(), ["ck", "de", "uk"])
+        for backend in ["trie", "compact"]:
+            self.assertTrue(os.path.exists(
+                self.refresher.cache_files[backend]))
+        with mock.patch.object(PublicSuffixList,
+                               "write_snapshot") as write_snapshot:
+            for backend in ["trie", "compact"]:
+                psl = PublicSuffixList.cached(self.refresher.psl_file,
+                                              backend=backend)
+                self.assertEqual(psl.get_sld("www.example.co.uk"),
+                                 "example.co.uk")
+        write_snapshot.assert_not_called()
+
+    def test_existing_icann_domains_kept(self):
+        with open(self.refresher.icann_file, "w") as f:
+            f.write("an\nde\nuk\n")
+        self.assertTrue(self.refresher.refresh())
+        self.assertEqual(self.refresher.icann_changes, (["ck"], ["an"]))
+        with open(self.refresher.icann_file) as f:
+            self.assertEqual(f.read().split(), ["an", "de", "uk"])
+        self.refresher.update_icann = True
+        self.assertTrue(self.refresher.refresh(force=True))
+        with open(self.refresher.icann_file) as f:
+            self.assertEqual(f.read().split(), ["ck", "de", "uk"])
+
+    def test_conditional_fetch(self):
+        self.assertTrue(self.refresher.refresh())
+        self.assertFalse(self.refresher.refresh())
+        self.assertEqual(PslHandler.requests_seen[-1].get("If-None-Match"),
+                         '"v1"')
+        PslHandler.body = (TEST_PSL + "net\n").encode()
+        PslHandler.etag = '"v2"'
+        self.assertTrue(self.refresher.refresh())
+        self.assertEqual(self.refresher.load_state()["etag"], '"v2"')
+
+    def test_invalid_list_is_not_written(self):
+        PslHandler.body = b"<html>Service unavailable</html>"
+        with self.assertRaises(InvalidListError):
+            self.refresher.refresh()
+        self.assertFalse(os.path.exists(self.refresher.psl_file))
+
+    def test_handle_swaps_on_change_and_signal(self):
+        self.refresher.refresh()
+        handle = PslHandle(self.tmp.name, poll_interval=0)
+        etlds, icanns = handle.current()
+        self.assertEqual(etlds.get_sld("a.b.blogspot.com"), "b.blogspot.com")
+        self.assertNotIn("fr", icanns)
+        PslHandler.body = TEST_PSL.replace("de\n", "de\nfr\n").encode()
+        PslHandler.etag = '"v2"'
+        self.refresher.update_icann = True
+        self.refresher.refresh()
+        # make the change visible even on filesystems with coarse mtimes
+        os.utime(self.refresher.psl_file, ns=(0, 0))
+        self.assertIn("fr", handle.current()[1])
+        self.assertEqual(handle.reloads, 2)
+        handle.request_reload()
+        handle.current()
+        self.assertEqual(handle.reloads, 3)
+
+class TestVerdictMatrix(unittest.TestCase):
+    """Checks the evaluation of a list under several public suffix lists"""
+
+    def setUp(self):
+        self.fps_sites = {"sets": [{
+            "primary": "https://example.co.uk",
+            "associatedSites": ["https://a.blogspot.com",
+                                "https://blogspot.com"],
+            "ccTLDs": {"https://example.co.uk": ["https://example.de",
+                                                 "https://example.com",
+                                                 "https://other.de"]}}]}
+        self.psls = [PublicSuffixList(["com", "uk", "co.uk", "de"]),
+                     PublicSuffixList(["com", "uk", "de", "blogspot.com"])]
+
+    def test_eTLD_Plus1_verdicts(self):
+        checker = FpsCheck(self.fps_sites, None, set())
+        verdicts = checker.eTLD_Plus1_verdicts(checker.load_sets(),
+                                               self.psls)
+        self.assertEqual(verdicts["https://example.co.uk"], (True, False))
+        self.assertEqual(verdicts["https://a.blogspot.com"], (False, True))
+        for i, psl in enumerate(self.psls):
+            single = FpsCheck(self.fps_sites, psl, set())
+            for site, row in verdicts.items():
+                self.assertEqual(row[i], single.is_eTLD_Plus1(site))
+
+    def test_eTLD_Plus1_verdicts_mixed_case(self):
+        self.fps_sites["sets"][0]["associatedSites"].append(
+            "https://Other.co.uk")
+        checker = FpsCheck(self.fps_sites, None, set())
+        verdicts = checker.eTLD_Plus1_verdicts(checker.load_sets(),
+                                               self.psls)
+        self.assertEqual(verdicts["https://Other.co.uk"], (False, False))
+        for psl in self.psls:
+            single = FpsCheck(self.fps_sites, psl, set())
+            self.assertFalse(single.is_eTLD_Plus1("https://Other.co.uk"))
+
+    def test_alias_verdicts(self):
+        checker = FpsCheck(self.fps_sites, None, {"uk", "de"})
+        verdicts = checker.alias_verdicts(checker.load_sets(), self.psls)
+        aliased = "https://example.co.uk"
+        self.assertEqual(verdicts[(aliased, "https://example.de")],
+                         (True, False))
+        self.assertEqual(verdicts[(aliased, "https://example.com")],
+                         (True, False))
+        self.assertEqual(verdicts[(aliased, "https://other.de")],
+                         (False, False))
+        for i, psl in enumerate(self.psls):
+            single = FpsCheck(self.fps_sites, psl, {"uk", "de"})
+            single.find_invalid_alias_eSLDs(single.load_sets())
+            failing = {site for (_, site), row in verdicts.items()
+                       if not row[i]}
+            self.assertEqual(
+                failing, {site for site in ["https://example.de",
+                                            "https://example.com",
+                                            "https://other.de"]
+                          if any(error.endswith(site)
+                                 for error in single.error_list)})
+
+class TestIcannLookup(unittest.TestCase):
+    """Checks the precomputed ICANN lookups of the alias check"""
+
+    def setUp(self):
+        self.checker = FpsCheck(
+            {"sets": []}, PublicSuffixList(["com", "uk", "co.uk", "de"]),
+            {"uk", "de"})
+
+    def test_allowed_sets_are_shared(self):
+        self.assertIs(self.checker.allowed_alias_tlds("https://example.co.uk"),
+                      self.checker.icann_cctlds_or_com)
+        self.assertIs(self.checker.allowed_alias_tlds("https://example.com"),
+                      self.checker.icann_cctlds)
+
+    def test_cctld_memoized_by_suffix(self):
+        self.assertEqual(self.checker.icann_cctld("https://example.co.uk"),
+                         "uk")
+        self.assertIsNone(self.checker.icann_cctld("https://example.com"))
+        self.assertEqual(self.checker.cctld_by_suffix,
+                         {"co.uk": "uk", "com": None})
+
+    def test_multi_label_cctld_alias(self):
+        check_sets = {"https://example.co.uk": FpsSet(
+            ccTLDs={"https://example.co.uk": ["https://example.de",
+                                              "https://example.com",
+                                              "https://example.co.de"]},
+            primary="https://example.co.uk")}
+        self.checker.find_invalid_alias_eSLDs(check_sets)
+        self.assertEqual(self.checker.error_list, [
+            "The following top level domain must match: "
+            "https://example.co.uk, but is instead: https://example.co.de"])
+
+class TestFpsArtifact(unittest.TestCase):
+    """Checks the compiled membership artifact"""
+
+    def setUp(self):
+        self.check_sets = FpsCheck({"sets": [
+            {"primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com",
+                                 "https://b\u00fccher.de"],
+             "serviceSites": ["https://service1.com"],
+             "ccTLDs": {"https://primary1.com": ["https://primary1.co.uk"]}},
+            {"primary": "https://primary2.com",
+             "associatedSites": ["https://associated2.com"]}]},
+            None, set()).load_sets()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "fps.artifact")
+        write_artifact(self.check_sets, self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lookup(self):
+        with FpsArtifact(self.path) as artifact:
+            self.assertEqual(len(artifact), 7)
+            self.assertEqual(artifact.num_sets, 2)
+            self.assertEqual(artifact.lookup("https://primary1.com"),
+                             ("https://primary1.com", "primary"))
+            self.assertEqual(artifact.lookup("https://b\u00fccher.de"),
+                             ("https://primary1.com", "associated"))
+            self.assertEqual(artifact.lookup("https://service1.com"),
+                             ("https://primary1.com", "service"))
+            self.assertEqual(artifact.lookup("https://primary1.co.uk"),
+                             ("https://primary1.com", "ccTLD"))
+            self.assertEqual(artifact.lookup("https://associated2.com"),
+                             ("https://primary2.com", "associated"))
+            self.assertIsNone(artifact.lookup("https://unknown.com"))
+            self.assertNotIn("https://primary3.com", artifact)
+
+    def test_every_member_found(self):
+        with FpsArtifact(self.path) as artifact:
+            for primary, fps in self.check_sets.items():
+                for site, role in fps.members():
+                    self.assertEqual(artifact.lookup(site), (primary, role))
+
+    def test_replaced_while_open(self):
+        with FpsArtifact(self.path) as artifact:
+            write_artifact({}, self.path)
+            self.assertEqual(artifact.lookup("https://primary2.com"),
+                             ("https://primary2.com", "primary"))
+            with FpsArtifact(self.path) as replaced:
+                self.assertEqual(len(replaced), 0)
+                self.assertIsNone(replaced.lookup("https://primary2.com"))
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not an artifact, just some bytes")
+        with self.assertRaises(ValueError):
+            FpsArtifact(self.path)
+
+class TestSetIndex(unittest.TestCase):
+    """Checks the same-set queries of SetIndex"""
+
+    def setUp(self):
+        self.check_sets = FpsCheck({"sets": [
+            {"primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com"],
+             "ccTLDs": {"https://primary1.com": ["https://primary1.co.uk"]}},
+            {"primary": "https://primary2.com",
+             "serviceSites": ["https://service2.com"]}]},
+            None, set()).load_sets()
+        self.index = SetIndex(self.check_sets)
+
+    def test_queries(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.set_id("https://primary1.co.uk"), 0)
+        self.assertEqual(self.index.set_id("https://service2.com"), 1)
+        self.assertEqual(self.index.set_id("https://unknown.com"), -1)
+        self.assertEqual(self.index.set_of("https://associated1.com"),
+                         "https://primary1.com")
+        self.assertIsNone(self.index.set_of("https://unknown.com"))
+        self.assertEqual(self.index.role_of("https://primary1.co.uk"),
+                         "ccTLD")
+        self.assertTrue(self.index.same_set("https://primary1.co.uk",
+                                            "https://associated1.com"))
+        self.assertFalse(self.index.same_set("https://primary1.com",
+                                             "https://primary2.com"))
+        self.assertFalse(self.index.same_set("https://unknown.com",
+                                             "https://unknown.com"))
+
+    def test_batched(self):
+        self.assertEqual(list(self.index.set_ids_of(
+            ["https://primary2.com", "https://unknown.com"])), [1, -1])
+        self.assertEqual(self.index.same_set_many(
+            ["https://primary1.com", "https://primary1.com",
+             "https://unknown.com"],
+            ["https://associated1.com", "https://service2.com",
+             "https://unknown.com"]), [True, False, False])
+        with self.assertRaises(ValueError):
+            self.index.same_set_many(["https://primary1.com"], [])
+
+    def test_overlapping_sets_are_merged(self):
+        self.check_sets["https://primary3.com"] = FpsSet(
+            None, "https://primary3.com", ["https://service2.com"])
+        self.check_sets["https://primary4.com"] = FpsSet(
+            None, "https://primary4.com", ["https://primary3.com"])
+        index = SetIndex(self.check_sets)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.same_set("https://primary4.com",
+                                       "https://primary2.com"))
+        self.assertEqual(index.set_of("https://primary4.com"),
+                         "https://primary2.com")
+        self.assertEqual(index.role_of("https://service2.com"), "service")
+
+    def test_merged_set_keeps_first_primary(self):
+        check_sets = FpsCheck({"sets": [
+            {"primary": "https://p0.com", "associatedSites": ["https://x.com"]},
+            {"primary": "https://p1.com", "associatedSites": ["https://y.com"]},
+            {"primary": "https://p2.com",
+             "associatedSites": ["https://x.com", "https://y.com"]}]},
+            None, set()).load_sets()
+        index = SetIndex(check_sets)
+        self.assertEqual(index.primaries, ["https://p0.com"])
+        self.assertEqual(index.set_of("https://y.com"), "https://p0.com")
+
+class TestClassifyHosts(unittest.TestCase):
+    """Checks the streaming hostname classifier"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.list_file = os.path.join(self.tmp.name, "sets.JSON")
+        with open(self.list_file, "w") as f:
+            json.dump({"sets": [{
+                "primary": "https://primary1.com",
+                "associatedSites": ["https://associated1.co.uk"],
+                "serviceSites": ["https://service1.com"]}]}, f)
+        self.lines = ["https://www.primary1.com/index.html\n",
+                      "cdn.associated1.co.uk:443\n",
+                      "\n",
+                      "https://www.unlisted.com\n",
+                      "not a host\n",
+                      "SERVICE1.com\n"]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_host_of(self):
+        self.assertEqual(host_of("https://WWW.Example.com:8080/a?b"),
+                         "www.example.com")
+        self.assertEqual(host_of("b\u00fccher.de/path"), "xn--bcher-kva.de")
+        self.assertIsNone(host_of("  "))
+
+    def test_classify_stream(self):
+        etlds = PublicSuffixList(psl_file='effective_tld_names.dat')
+        with open(self.list_file) as f:
+            sets = SetIndex(FpsCheck(json.load(f), etlds, set()).load_sets())
+        classifier = HostClassifier(etlds, sets, cache_size=2)
+        rows = [row.split("\t") for row in classify_stream(
+            self.lines, classifier, "tsv")]
+        self.assertEqual(rows[0], [
+            "https://www.primary1.com/index.html", "www.primary1.com",
+            "primary1.com", "https://primary1.com", "primary"])
+        self.assertEqual(rows[1][2:], ["associated1.co.uk",
+                                       "https://primary1.com", "associated"])
+        self.assertEqual(rows[2], ["", "", "", "", ""])
+        self.assertEqual(rows[3][2:], ["unlisted.com", "", ""])
+        self.assertEqual(rows[5][3:], ["https://primary1.com", "service"])
+        record = json.loads(next(classify_stream(self.lines, classifier,
+                                                 "jsonl")))
+        self.assertEqual(record["role"], "primary")
+
+    def test_public_suffix_host(self):
+        etlds = PublicSuffixList(psl_file='effective_tld_names.dat')
+        classifier = HostClassifier(etlds, SetIndex({}))
+        for host in ["com", "co.uk", "github.io"]:
+            self.assertEqual(classifier.classify(host),
+                             (host, None, None, None))
+        self.assertEqual(classifier.classify("user.github.io"),
+                         ("user.github.io", "user.github.io", None, None))
+
+    def test_sharded_output_keeps_order(self):
+        options = {"input_prefix": "", "list_file": self.list_file,
+                   "output_format": "jsonl"}
+        lines = self.lines * 5
+        output = "".join(classify_sharded(
+            lines, 2, load_classifier(**options), options, batch_size=4))
+        records = [json.loads(row) for row in output.splitlines()]
+        self.assertEqual([record["input"] for record in records],
+                         [line.rstrip("\n") for line in lines])
+        self.assertEqual(records[-1]["role"], "service")
+
+    def test_load_error_exits(self):
+        argv = ["classify_hosts.py", "--jobs=2", "-i",
+                os.path.join(self.tmp.name, "missing.JSON")]
+        stderr = io.StringIO()
+        with mock.patch("sys.argv", argv), \
+                mock.patch("sys.stdin", io.StringIO("example.com\n")), \
+                mock.patch("multiprocessing.pool.Pool") as pool, \
+                contextlib.redirect_stderr(stderr), \
+                self.assertRaises(SystemExit) as exit:
+            classify_hosts.main()
+        self.assertEqual(exit.exception.code, 1)
+        self.assertIn("missing.JSON", stderr.getvalue())
+        pool.assert_not_called()
+
+class TestFpsServer(unittest.TestCase):
+    """Checks the lookup daemon and its reloading"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.list_file = os.path.join(self.tmp.name, "sets.JSON")
+        self.write_list(["https://associated1.com"])
+        self.holder = IndexHolder(self.list_file, PslHandle())
+        self.servers = []
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.holder.stop()
+        self.tmp.cleanup()
+
+    def write_list(self, associated_sites):
+        with open(self.list_file, "w") as f:
+            json.dump({"sets": [{"primary": "https://primary1.com",
+                                 "associatedSites": associated_sites}]}, f)
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.start()
+        self.servers.append((server, thread))
+        return server
+
+    def get(self, conn, path):
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_queries_share_a_connection(self):
+        server = self.serve(LookupServer(("127.0.0.1", 0), self.holder))
+        conn = http.client.HTTPConnection("127.0.0.1",
+                                          server.server_address[1])
+        self.assertEqual(
+            self.get(conn, "/lookup?site=https://associated1.com"),
+            (200, {"site": "https://associated1.com",
+                   "primary": "https://primary1.com", "role": "associated"}))
+        status, result = self.get(
+            conn, "/same_set?a=https://primary1.com&b=https://associated1.com")
+        self.assertTrue(result["same_set"])
+        status, result = self.get(conn, "/etld_plus1?host=www.primary1.com")
+        self.assertEqual((result["etld_plus1"], result["is_etld_plus1"],
+                          result["role"]), ("primary1.com", False, "primary"))
+        status, result = self.get(conn, "/lookup")
+        self.assertEqual(status, 400)
+        conn.request("POST", "/batch", json.dumps([
+            {"op": "lookup", "site": "https://unlisted.com"},
+            {"op": "same_set", "a": "https://primary1.com",
+             "b": "https://unlisted.com"},
+            {"op": "nope"}]))
+        results = json.loads(conn.getresponse().read())["results"]
+        self.assertIsNone(results[0]["role"])
+        self.assertFalse(results[1]["same_set"])
+        self.assertIn("error", results[2])
+        conn.close()
+
+    def test_public_suffix_is_not_etld_plus1(self):
+        index = self.holder.current
+        for host in ["com", "co.uk", "github.io"]:
+            result = index.answer({"op": "etld_plus1", "host": host})
+            self.assertIsNone(result["etld_plus1"])
+            self.assertIsNone(result["primary"])
+            self.assertFalse(result["is_etld_plus1"])
+        result = index.answer({"op": "etld_plus1", "host": "primary1.com"})
+        self.assertTrue(result["is_etld_plus1"])
+
+    def test_reload_swaps_index(self):
+        old_index = self.holder.current
+        self.assertFalse(self.holder.check())
+        self.write_list(["https://associated2.com"])
+        os.utime(self.list_file, ns=(0, 1))
+        self.assertTrue(self.holder.check())
+        self.assertIsNone(old_index.sets.lookup("https://associated2.com"))
+        self.assertEqual(self.holder.current.generation, 1)
+        self.assertEqual(self.holder.current.sets.role_of(
+            "https://associated2.com"), "associated")
+        # A list that fails to parse leaves the current index in place
+        with open(self.list_file, "w") as f:
+            f.write("{")
+        with mock.patch("sys.stderr"):
+            self.assertFalse(self.holder.check())
+        self.assertEqual(self.holder.current.generation, 1)
+
+    def test_reload_on_psl_change(self):
+        psl_file = os.path.join(self.tmp.name, "effective_tld_names.dat")
+        with open(os.path.join(self.tmp.name, "ICANN_domains"), "w") as f:
+            f.write("uk\n")
+        with open(psl_file, "w") as f:
+            f.write("com\n")
+        psl = PslHandle(self.tmp.name, poll_interval=0)
+        holder = IndexHolder(self.list_file, psl)
+        query = {"op": "etld_plus1", "host": "www.primary1.com"}
+        self.assertEqual(holder.current.answer(query)["etld_plus1"],
+                         "primary1.com")
+        with open(psl_file, "w") as f:
+            f.write("com\nprimary1.com\n")
+        os.utime(psl_file, ns=(0, 0))
+        self.assertTrue(holder.check())
+        self.assertEqual(holder.current.answer(query)["etld_plus1"],
+                         "www.primary1.com")
+        # SIGHUP reloads the public suffix list even if it looks unchanged
+        self.assertTrue(holder.check(force=True))
+        self.assertEqual(psl.reloads, 3)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp.name, "fps.sock")
+        self.serve(UnixLookupServer(path, self.holder))
+        conn = http.client.HTTPConnection("localhost")
+        conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.sock.connect(path)
+        status, result = self.get(conn, "/health")
+        self.assertEqual((status, result["sets"], result["sites"]),
+                         (200, 1, 2))
+        conn.close()
+
+class WellKnownTransport:
+    """Serves the same well-known file for every site, counting fetches"""
+
+    def __init__(self, well_known):
+        self.well_known = json.dumps(well_known).encode()
+        self.fetches = 0
+
+    def urlopen(self, url, headers=None):
+        self.fetches += 1
+        if "unreachable" in url:
+            raise OSError("unreachable")
+        return Response(url, 200, {}, self.well_known)
+
+    def get(self, url, **kwargs):
+        self.fetches += 1
+        return Response(url, 404, {}, b"")
+
+class TestValidationServer(unittest.TestCase):
+    """Checks the validation server, its job queue and its warm caches"""
+
+    def setUp(self):
+        self.submission = {"sets": [{
+            "contact": "owner@primary1.com",
+            "primary": "https://primary1.com",
+            "associatedSites": ["https://associated1.com"],
+            "rationaleBySite": {"https://associated1.com": "Affiliated"}}]}
+        self.inner = WellKnownTransport(
+            {"primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com"]})
+        self.validator = Validator(
+            transport=CachingTransport(self.inner, max_age=60))
+
+    def test_caching_transport(self):
+        transport = CachingTransport(self.inner, max_age=60)
+        for _ in range(2):
+            self.assertEqual(transport.urlopen("https://a.com").status_code,
+                             200)
+            with self.assertRaises(OSError):
+                transport.urlopen("https://unreachable.com")
+        self.assertEqual((self.inner.fetches, transport.hits,
+                          transport.misses), (2, 2, 2))
+        transport.max_age = 0
+        time.sleep(0.001)
+        transport.urlopen("https://a.com")
+        self.assertEqual(self.inner.fetches, 3)
+
+    def test_validations_share_fetches(self):
+        self.assertEqual(self.validator.validate(self.submission), [])
+        self.assertEqual(self.validator.validate(self.submission), [])
+        self.assertEqual(self.inner.fetches, 2)
+        del self.submission["sets"][0]["contact"]
+        errors = self.validator.validate(self.submission)
+        self.assertIn("'contact' is a required property", errors[0])
+
+    def test_streamed_events(self):
+        queue = JobQueue(self.validator, workers=2)
+        server = ValidationServer(("127.0.0.1", 0), queue)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.start()
+        try:
+            self.submission["sets"][0]["rationaleBySite"] = {
+                "https://primary1.com": "Not needed"}
+            conn = http.client.HTTPConnection("127.0.0.1",
+                                              server.server_address[1])
+            conn.request("POST", "/jobs?stream=1",
+                         json.dumps(self.submission))
+            response = conn.getresponse()
+            events = [json.loads(line)
+                      for line in response.read().splitlines()]
+            self.assertEqual(events[0]["event"], "started")
+            stages = {event["stage"]: event["errors"]
+                      for event in events if event["event"] == "stage"}
+            self.assertEqual(stages["find_invalid_well_known"], [])
+            self.assertEqual(len(stages["has_all_rationales"]), 1)
+            self.assertFalse(events[-1]["success"])
+            self.assertEqual(events[-1]["errors"],
+                             stages["has_all_rationales"])
+            conn.request("GET", "/jobs/" + events[0]["id"])
+            summary = json.loads(conn.getresponse().read())
+            self.assertEqual((summary["status"], summary["success"]),
+                             ("done", False))
+            conn.request("GET", "/jobs/nope")
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.status, 404)
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            queue.shutdown()
+
+class TestBatch(unittest.TestCase):
+    """Checks validating a batch of submissions in one pass"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.candidate = {
+            "contact": "owner@primary1.com",
+            "primary": "https://primary1.com",
+            "associatedSites": ["https://associated1.com"],
+            "rationaleBySite": {"https://associated1.com": "Affiliated"}}
+        self.transport = WellKnownTransport(
+            {"primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com"]})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_batch_submission(self):
+        current = {"sets": [{"primary": "https://primary1.com"},
+                            {"primary": "https://primary2.com"}]}
+        fps_sites = batch_submission({"id": 7, "set": self.candidate},
+                                     current)
+        self.assertEqual([fpset["primary"] for fpset in fps_sites["sets"]],
+                         ["https://primary2.com", "https://primary1.com"])
+        self.assertEqual(batch_submission({"sets": []}, current),
+                         {"sets": []})
+        with self.assertRaises(ValueError):
+            batch_submission({"contact": "x"}, current)
+
+    def test_run_batch(self):
+        batch_file = os.path.join(self.tmp.name, "pending.jsonl")
+        invalid = dict(self.candidate, rationaleBySite={})
+        with open(batch_file, "w") as f:
+            for line in [{"id": "a", "set": self.candidate},
+                         self.candidate, "not json",
+                         {"id": "b", "set": invalid}]:
+                f.write((line if isinstance(line, str)
+                         else json.dumps(line)) + "\n")
+            f.write("\n")
+        output = io.StringIO()
+        failed = run_batch(batch_file, "", self.transport, [], output)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(failed, 2)
+        self.assertEqual([(record["line"], record.get("id"),
+                           record["success"]) for record in records],
+                         [(1, "a", True), (2, None, True), (3, None, False),
+                          (4, "b", False)])
+        self.assertEqual(records[3]["errors"], [
+            "There is no provided rationale for https://associated1.com"])
+        # Each URL of the shared plan is fetched once for all submissions
+        self.assertEqual(self.transport.fetches, 2)
+
+    def test_run_batch_prometheus_series_unique(self):
+        batch_file = os.path.join(self.tmp.name, "pending.jsonl")
+        with open(batch_file, "w") as f:
+            for i in range(3):
+                f.write(json.dumps({"id": i, "set": self.candidate}) + "\n")
+        metrics = RunMetrics()
+        run_batch(batch_file, "", ObservedTransport(self.transport,
+                                                    [metrics]),
+                  [metrics], io.StringIO())
+        prom_file = os.path.join(self.tmp.name, "fps.prom")
+        metrics.write_prometheus(prom_file)
+        with open(prom_file) as f:
+            series = [line.rsplit(" ", 1)[0] for line in f
+                      if not line.startswith("#")]
+        self.assertIn('fps_stage_sites{stage="has_all_rationales"}', series)
+        self.assertEqual(len(series), len(set(series)))
+
+class TestSubmissionConflicts(unittest.TestCase):
+    """Checks the detection of conflicts between pending submissions"""
+
+    def setUp(self):
+        self.old_sets = {
+            "https://primary1.com": FpsSet(
+                None, "https://primary1.com", ["https://associated1.com"]),
+            "https://primary2.com": FpsSet(
+                None, "https://primary2.com", ["https://associated2.com"])}
+
+    def submission(self, *changed_sets):
+        new_sets = dict(self.old_sets)
+        for fps in changed_sets:
+            new_sets[fps.primary] = fps
+        return new_sets
+
+    def test_no_conflicts(self):
+        submissions = [
+            ("a", self.submission(FpsSet(None, "https://primary3.com",
+                                         ["https://associated3.com"]))),
+            ("b", self.submission(FpsSet(None, "https://primary4.com",
+                                         ["https://associated4.com"])))]
+        self.assertEqual(
+            find_submission_conflicts(self.old_sets, submissions), [])
+
+    def test_same_site_claimed_twice(self):
+        submissions = [
+            ("a", self.submission(FpsSet(None, "https://primary3.com",
+                                         ["https://shared.com"]))),
+            ("b", self.submission(FpsSet(None, "https://primary4.com", None,
+                                         ["https://shared.com"])))]
+        self.assertEqual(
+            find_submission_conflicts(self.old_sets, submissions),
+            ["https://shared.com is claimed by https://primary3.com "
+             "(associated) in submission a and by https://primary4.com "
+             "(service) in submission b"])
+
+    def test_conflicts_with_current_list(self):
+        # a moves associated1.com out of the set of primary1.com, b takes it
+        # while leaving that set as it is
+        moved = FpsSet(None, "https://primary1.com", [])
+        submissions = [
+            ("a", self.submission(moved, FpsSet(
+                None, "https://primary3.com", ["https://associated1.com"]))),
+            ("b", self.submission(FpsSet(
+                None, "https://primary4.com", ["https://associated1.com"]))),
+            ("c", self.submission(FpsSet(
+                None, "https://primary2.com", ["https://associated5.com"])))]
+        conflicts = find_submission_conflicts(self.old_sets, submissions)
+        self.assertEqual(sorted(conflicts), [
+            "https://associated1.com is claimed by https://primary3.com "
+            "(associated) in submission a and by https://primary4.com "
+            "(associated) in submission b",
+            "https://associated1.com is claimed by https://primary4.com "
+            "(associated) in submission b and by https://primary1.com "
+            "(associated) in the current list"])
+        submissions.append(("d", self.submission(moved)))
+        self.assertIn(
+            "The set of https://primary1.com is changed by submissions a, d",
+            find_submission_conflicts(self.old_sets, submissions))
+
+class TestResultCache(unittest.TestCase):
+    """Checks reusing the results of unchanged sets across runs"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmp.name, "results.sqlite")
+        self.now = 1000.0
+        self.fps_sites = {"sets": [
+            {"contact": "owner@primary1.com",
+             "primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com"],
+             "rationaleBySite": {"https://associated1.com": "Affiliated"}},
+            {"contact": "owner@primary2.com",
+             "primary": "https://primary2.com",
+             "associatedSites": ["https://associated2.com"],
+             "rationaleBySite": {}}]}
+        self.transport = WellKnownTransport(
+            {"primary": "https://primary1.com",
+             "associatedSites": ["https://associated1.com"]})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_cached(self, psl_file="effective_tld_names.dat"):
+        fp = FpsCheck(self.fps_sites,
+                      PublicSuffixList(psl_file='effective_tld_names.dat'),
+                      set(), self.transport)
+        error_texts = []
+        with ResultCache(self.db, psl_file, "ICANN_domains", "SCHEMA.json",
+                         max_age=60, clock=lambda: self.now) as cache:
+            check_list(fp, lambda name, sites=0: contextlib.nullcontext(),
+                       None, error_texts, result_cache=cache)
+        return check_errors(fp, error_texts), cache
+
+    def test_set_fingerprint(self):
+        self.assertEqual(set_fingerprint({"a": 1, "b": [2]}),
+                         set_fingerprint({"b": [2], "a": 1}))
+        self.assertNotEqual(set_fingerprint({"a": 1}),
+                            set_fingerprint({"a": 2}))
+
+    def test_reuses_unchanged_sets(self):
+        errors, cache = self.run_cached()
+        self.assertEqual(cache.hits, 0)
+        fetches = self.transport.fetches
+        errors_again, cache = self.run_cached()
+        self.assertEqual(errors_again, errors)
+        self.assertEqual((cache.hits, cache.misses), (16, 0))
+        self.assertEqual(self.transport.fetches, fetches)
+        self.assertIn(
+            "There is no provided rationale for https://associated2.com",
+            errors)
+        # Only the changed set is checked again
+        self.fps_sites["sets"][1]["rationaleBySite"] = {
+            "https://associated2.com": "Affiliated"}
+        errors, cache = self.run_cached()
+        self.assertEqual((cache.hits, cache.misses), (8, 8))
+        self.assertNotIn(
+            "There is no provided rationale for https://associated2.com",
+            errors)
+
+    def test_expiry_and_inputs(self):
+        self.run_cached()
+        fetches = self.transport.fetches
+        # Network results expire after max_age, the others do not
+        self.now += 61
+        _, cache = self.run_cached()
+        self.assertEqual((cache.hits, cache.misses), (8, 8))
+        self.assertEqual(self.transport.fetches, 2 * fetches)
+        # A different public suffix list invalidates every result
+        psl_file = os.path.join(self.tmp.name, "other.dat")
+        with open(psl_file, "w") as f:
+            f.write("com\n")
+        _, cache = self.run_cached(psl_file)
+        self.assertEqual(cache.hits, 0)
+
+class TestRollingScheduler(unittest.TestCase):
+    """Checks how the rolling revalidation spreads sets over runs"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp.name, "schedule.json")
+        self.now = 100 * DAY
+        self.fingerprints = {"https://primary%d.com" % i: "hash%d" % i
+                             for i in range(7)}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def scheduler(self, **kwargs):
+        return RollingScheduler(self.state_file, clock=lambda: self.now,
+                                **kwargs)
+
+    def run_day(self, failing=(), budget=None):
+        scheduler = self.scheduler(period_days=3, budget=budget)
+        chosen = scheduler.select(self.fingerprints)
+        scheduler.record(self.fingerprints, {
+            primary: ["error"] if primary in failing else []
+            for primary in chosen})
+        scheduler.save()
+        self.now += DAY
+        return [int(primary[len("https://primary"):-len(".com")])
+                for primary in chosen]
+
+    def test_covers_list_within_period(self):
+        days = [self.run_day() for _ in range(3)]
+        self.assertEqual(days, [[0, 1, 2], [3, 4, 5], [0, 1, 6]])
+        # Sets checked a period ago come first, then the least recently
+        # checked
+        self.assertEqual(self.run_day(), [2, 3, 4])
+
+    def test_changed_and_failed_sets_first(self):
+        self.run_day(failing={"https://primary1.com"}, budget=7)
+        self.fingerprints["https://primary5.com"] = "changed"
+        self.assertEqual(self.run_day(failing={"https://primary1.com"},
+                                      budget=2), [1, 5])
+        self.assertEqual(
+            self.scheduler().state["https://primary1.com"]["failures"], 2)
+
+    def test_check_list_checks_slice(self):
+        fps_sites = {"sets": [
+            {"contact": "owner@primary%d.com" % i,
+             "primary": "https://primary%d.com" % i,
+             "associatedSites": ["https://associated%d.com" % i],
+             "rationaleBySite": {}} for i in range(2)]}
+        fp = FpsCheck(fps_sites,
+                      PublicSuffixList(psl_file='effective_tld_names.dat'),
+                      set(), WellKnownTransport({}))
+        scheduler = self.scheduler(budget=1)
+        check_list(fp, lambda name, sites=0: contextlib.nullcontext(),
+                   scheduler=scheduler)
+        self.assertIn(
+            "There is no provided rationale for https://associated0.com",
+            fp.error_list)
+        self.assertNotIn(
+            "There is no provided rationale for https://associated1.com",
+            fp.error_list)
+        self.assertEqual(list(scheduler.state), ["https://primary0.com"])
+        self.assertEqual(scheduler.state["https://primary0.com"]["failures"],
+                         1)
+
+    def test_budget_and_forgotten_sets(self):
+        scheduler = self.scheduler(budget=2)
+        self.assertEqual(len(scheduler.select(self.fingerprints)), 2)
+        scheduler.record(self.fingerprints, {"https://primary0.com": []})
+        del self.fingerprints["https://primary0.com"]
+        scheduler.record(self.fingerprints, {})
+        self.assertEqual(scheduler.state, {})
+
+class TestShards(unittest.TestCase):
+    """Checks that merged shard reports match a run over the whole list"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.list_file = os.path.join(self.tmp.name, "sets.JSON")
+        sets = [{"contact": "owner@primary%d.com" % i,
+                 "primary": "https://primary%d.com" % i,
+                 "associatedSites": ["https://associated%d.com" % i],
+                 "rationaleBySite": {} if i % 3 else
+                 {"https://associated%d.com" % i: "Affiliated"}}
+                for i in range(8)]
+        sets[5]["associatedSites"].append("http://insecure5.com")
+        sets[6]["associatedSites"] = ["https://associated2.com"]
+        with open(self.list_file, "w") as f:
+            json.dump({"sets": sets}, f)
+        self.transport = WellKnownTransport(
+            {"primary": "https://primary0.com",
+             "associatedSites": ["https://associated0.com"]})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_report(self, shard=None):
+        report_file = os.path.join(self.tmp.name, "report-%s.json" % (
+            shard[0] if shard else "all"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_checks(self.list_file, "", False, self.transport, [],
+                       shard=shard, report_file=report_file)
+        with open(report_file) as f:
+            return json.load(f)
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of("https://primary0.com", 4),
+                         shard_of("https://primary0.com", 4))
+        self.assertEqual({shard_of("https://primary%d.com" % i, 3)
+                          for i in range(100)}, {0, 1, 2})
+        self.assertEqual(parse_shard("1/3"), (1, 3))
+        with self.assertRaises(ValueError):
+            parse_shard("3/3")
+
+    def test_merge_matches_single_run(self):
+        single = self.run_report()
+        self.assertFalse(single["success"])
+        reports = [self.run_report((i, 3)) for i in (2, 0, 1)]
+        self.assertEqual(merge_reports(reports), single)
+        # Only shard 0 checks exclusivity
+        self.assertEqual(len(reports[1]["global_errors"]), 1)
+        self.assertEqual(reports[0]["global_errors"], [])
+        with self.assertRaises(ValueError):
+            merge_reports(reports[:2])
+
+    def test_merge_matches_single_run_when_a_check_raises(self):
+        def flaky_check(checker, check_sets):
+            for primary in check_sets:
+                if primary in ("https://primary3.com", "https://primary6.com"):
+                    raise ValueError("Could not check " + primary)
+                checker.error_list.append("Flagged " + primary)
+
+        with mock.patch.object(FpsCheck, "find_robots_txt", flaky_check):
+            single = self.run_report()
+            reports = [self.run_report((i, 3)) for i in range(3)]
+        self.assertIn("Could not check https://primary3.com", single["errors"])
+        self.assertNotIn("Flagged https://primary4.com", single["errors"])
+        self.assertEqual(merge_reports(reports), single)
+
+    def test_jobs_with_shard_rejected(self):
+        argv = ["check_sites.py", "-i", self.list_file, "--jobs=2",
+                "--shard=0/2"]
+        with mock.patch("sys.argv", argv), \
+                contextlib.redirect_stdout(io.StringIO()) as out, \
+                self.assertRaises(SystemExit) as exit:
+            check_sites.main()
+        self.assertEqual(exit.exception.code, 2)
+        self.assertIn("--jobs cannot be combined", out.getvalue())
+
+class TestCheckPool(unittest.TestCase):
+    """Checks that the offline checks report the same errors on a pool"""
+
+    def setUp(self):
+        sets = []
+        for i in range(30):
+            fpset = {"primary": "https://primary%d.com" % i,
+                     "associatedSites": ["https://associated%d.com" % i]}
+            if i % 4 == 1:
+                fpset["associatedSites"].append("http://insecure%d.com" % i)
+            if i % 5 == 2:
+                fpset["associatedSites"].append("https://www.sub%d.com" % i)
+            if i % 3 == 0:
+                fpset["rationaleBySite"] = {}
+            if i % 7 == 3:
+                fpset["ccTLDs"] = {"https://primary%d.com" % i: [
+                    "https://primary%d.co.uk" % i, "https://other%d.xyz" % i]}
+            sets.append(fpset)
+        self.fps_sites = {"sets": sets}
+        self.etlds = PublicSuffixList(psl_file='effective_tld_names.dat')
+        self.icanns = {"uk", "de"}
+
+    def checker(self):
+        return FpsCheck(self.fps_sites, self.etlds, self.icanns)
+
+    def test_same_errors_in_same_order(self):
+        serial = self.checker()
+        check_sets = serial.load_sets()
+        for name in sorted(OFFLINE_CHECKS):
+            getattr(serial, name)(check_sets)
+        parallel = self.checker()
+        with CheckPool(parallel, parallel.load_sets(), 3) as pool:
+            for name in sorted(OFFLINE_CHECKS):
+                pool.run(name)
+        self.assertGreater(len(serial.error_list), 20)
+        self.assertEqual(parallel.error_list, serial.error_list)
+
+    def test_exception_stops_check(self):
+        self.fps_sites["sets"][20]["associatedSites"] = [20]
+        serial = self.checker()
+        check_sets = serial.load_sets()
+        with self.assertRaises(Exception) as raised:
+            serial.find_non_https_urls(check_sets)
+        parallel = self.checker()
+        with CheckPool(parallel, parallel.load_sets(), 4) as pool:
+            with self.assertRaises(WorkerError) as worker_raised:
+                pool.run("find_non_https_urls")
+        self.assertEqual(str(worker_raised.exception), str(raised.exception))
+        self.assertEqual(parallel.error_list, serial.error_list)
+
 if __name__ == '__main__':
     unittest.main()
@@ -42,9 +42,17 @@ Public Suffix List module for Python.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+from array import array
 import codecs
+import hashlib
+import multiprocessing
+import os
 from os import path
+import pickle
+import struct
+import tempfile
 import warnings
+import zlib
 
 try:
     from urllib.request import urlopen, Request
@@ -58,11 +66,22 @@ BASE_DIR = path.dirname(__file__)
 PSL_FILE = path.join(BASE_DIR, 'public_suffix_list.dat')
 ABOUT_PSL_FILE = path.join(BASE_DIR, 'public_suffix_list.ABOUT')
 
+# Compiled snapshots start with this magic and format version, followed by
+# the idna flag, the backend and the SHA-256 of the source list they were
+# compiled from. Bump SNAPSHOT_VERSION whenever the layout of the pickled
+# state changes.
+SNAPSHOT_MAGIC = b'PSL2SNAP'
+SNAPSHOT_VERSION = 3
+_SNAPSHOT_HEADER = struct.Struct('>8sHBB32s')
+
+# The ways the rules can be stored, see PublicSuffixList.__init__
+BACKENDS = ('trie', 'compact')
+
 
 
 class PublicSuffixList(object):
 
-    def __init__(self, psl_file=None, idna=True):
+    def __init__(self, psl_file=None, idna=True, backend='trie'):
         """
         Read and parse a public suffix list. `psl_file` is either a file
         location string, or a file-like object, or an iterable of lines from a
@@ -78,9 +97,20 @@ class PublicSuffixList(object):
 
         The file format is described at http://publicsuffix.org/
 
+        With backend='trie' the rules are kept as a Trie of nested tuples and
+        dicts. With backend='compact' they are kept in a CompactSuffixTable,
+        a flat hash table over a single string, and the lines of `tlds` are
+        joined into one string as well. A compact list takes about a quarter of
+        the memory of a trie one and, being only a handful of objects, stays
+        shared copy-on-write across forked workers; its lookups are about
+        twice as slow. Both backends give the same answers.
+
         :param psl_file: string or None
         :param idna: boolean, whether to convert file to IDNA-encoded strings
+        :param backend: string, 'trie' or 'compact'
         """
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: %r' % (backend,))
         # Note: we test for None as we accept empty lists as inputs
         if psl_file is None or isinstance(psl_file, str):
             with codecs.open(psl_file or PSL_FILE, 'r', encoding='utf8') as psl:
@@ -90,9 +120,102 @@ class PublicSuffixList(object):
             psl = psl_file
 
         # a list of eTLDs with their modifiers, e.g., *
-        self.tlds = []
+        self._tlds = []
         root = self._build_structure(psl, idna)
-        self.root = self._simplify(root)
+        self.backend = backend
+        if backend == 'compact':
+            self.root = None
+            self.table = CompactSuffixTable(self._simplify(root))
+            # one string instead of a str object per line
+            self._tlds = '\n'.join(self._tlds)
+        else:
+            self.root = self._simplify(root)
+            self.table = None
+
+    @property
+    def tlds(self):
+        """
+        The lines of the public suffix list, with their modifiers such as
+        wildcards. The compact backend stores them as a single string and
+        splits it on each access.
+        """
+        if isinstance(self._tlds, str):
+            return self._tlds.split('\n') if self._tlds else []
+        return self._tlds
+
+    @classmethod
+    def cached(cls, psl_file=None, idna=True, cache_file=None,
+               backend='trie'):
+        """
+        Return a PublicSuffixList for the list at the `psl_file` path, loading
+        the compiled Trie from a snapshot when one exists for the same list.
+
+        The snapshot is keyed by the SHA-256 of the list's content, the idna
+        flag, the backend and the snapshot format version. Each backend has
+        its own default snapshot path, see snapshot_path(), so processes using
+        different backends do not rewrite each other's. When any of them differ, or
+        the snapshot is missing or unreadable, the list is parsed as usual and
+        the snapshot is rewritten atomically. Failing to write the snapshot,
+        e.g. in a read-only directory, is not an error.
+
+        :param psl_file: string path or None for the vendored list
+        :param idna: boolean, whether to convert file to IDNA-encoded strings
+        :param cache_file: string path of the snapshot, defaults to
+            snapshot_path(psl_file, backend)
+        :param backend: string, 'trie' or 'compact'
+        :return: PublicSuffixList
+        """
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend: %r' % (backend,))
+        psl_file = psl_file or PSL_FILE
+        cache_file = cache_file or snapshot_path(psl_file, backend)
+        with open(psl_file, 'rb') as f:
+            source = f.read()
+        header = snapshot_header(source, idna, backend)
+
+        try:
+            with open(cache_file, 'rb') as f:
+                snapshot = f.read()
+            if snapshot[:_SNAPSHOT_HEADER.size] == header:
+                psl = cls.__new__(cls)
+                psl.__dict__.update(
+                    pickle.loads(snapshot[_SNAPSHOT_HEADER.size:]))
+                return psl
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+
+        psl = cls(source.decode('utf8').splitlines(), idna=idna,
+                  backend=backend)
+        psl.write_snapshot(cache_file, header)
+        return psl
+
+    def write_snapshot(self, cache_file, header):
+        """
+        Atomically write the compiled state of this list to `cache_file`,
+        preceded by `header`. Returns True if the snapshot was written.
+
+        :param cache_file: string path of the snapshot
+        :param header: bytes, the snapshot header identifying the source list
+        :return: boolean
+        """
+        directory = path.dirname(path.abspath(cache_file))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.psl-')
+        except OSError:
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_file)
+            return True
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
 
     def _find_node(self, parent, parts):
         """
@@ -184,7 +307,7 @@ class PublicSuffixList(object):
         """
         root = [0]
 
-        tlds = self.tlds
+        tlds = self._tlds
 
         for line in fp:
             line = line.strip()
@@ -198,46 +321,90 @@ class PublicSuffixList(object):
 
         return root
 
-    def _lookup_node(self, matches, depth, parent, parts, wildcard):
+    def _lookup_labels(self, parts, wildcard):
         """
-        Traverses the Trie recursively to find the parts. By default, the
-        traverse follows wildcards, as appropriate for the public suffix list,
-        but if wildcard is set to False, it will stop at wildcard leaves. This
-        can be useful for summarizing complex wildcard domains like those under
-        amazonaws.com.
-
-        The lookup is tracked via a list, initially set to all None, that marks
-        the negation flags of nodes it matches. each match will be marked for
-        later composition of the eTLD.
-
-        :param matches: list, parts long, None (initial), 0, or 1
-        :param depth: int, how far in the Trie this run is
-        :param parent: Tuple, the current subTrie
-        :param parts: list of domain parts, strings
+        Walks the Trie once, iteratively, over the labels of a domain from
+        right to left, and returns the index in `parts` where the public
+        suffix starts, or None if there is none.
+
+        Every rule that can match is followed at once: the frontier holds the
+        nodes reached at the current depth, in the order a depth-first
+        traversal would visit them, and both the wildcard child '*' and the
+        child named after the label are followed from each. When several
+        nodes match at the same depth, the last one in that order sets the
+        negation flag of the depth. By default the traversal follows
+        wildcards, as appropriate for the public suffix list, but if wildcard
+        is set to False, it will stop at wildcard leaves.
+
+        The public suffix is made of the labels down to the deepest depth
+        whose flag is 0 (not negated). If no rules match, the prevailing rule
+        is "*" and the suffix is the last label. See: Algorithm 2 at
+        https://publicsuffix.org/list/
+
+        :param parts: list of domain labels, strings
         :param wildcard: boolean, whether to process wildcard nodes
-        :return: None, recursive call
+        :return: int or None
         """
-        if wildcard and depth == 1:
-            # if no rules match, the prevailing rule is "*"
-            # See: Algorithm 2 at https://publicsuffix.org/list/
-            matches[-depth] = 0
+        if self.table is not None:
+            return self.table.suffix_start(parts, wildcard)
+        num_parts = len(parts)
+        suffix_start = None
+        frontier = (self.root,)
+        for depth in range(1, num_parts + 1):
+            label = parts[-depth]
+            negate = 0 if (wildcard and depth == 1) else None
+            matched = []
+            for node in frontier:
+                if node in (0, 1):
+                    continue
+                children = node[1]
+                for name in ('*', label):
+                    child = children.get(name, None)
+                    if child is not None and (wildcard or name != '*'):
+                        negate = child if child in (0, 1) else child[0]
+                        matched.append(child)
+            if negate == 0:
+                suffix_start = num_parts - depth
+            if not matched:
+                break
+            frontier = matched
+        return suffix_start
+
+    def lookup(self, domain, wildcard=True, strict=False):
+        """
+        Return the public suffix (TLD), the registrable domain (SLD) and
+        whether the domain is itself a public suffix, from a single traversal
+        of the Trie.
 
-        if parent in (0, 1):
-            return
+        The TLD and SLD are those get_tld() and get_sld() return for the same
+        arguments, and both of those are built on this method, so callers that
+        need both should call lookup() once instead.
 
-        children = parent[1]
+        :param domain: string, needs to match the encoding of the PSL (idna or UTF8)
+        :param wildcard: boolean, follow wildcard patterns
+        :param strict: boolean, check the TLD is valid, return None if not
+        :return: Tuple (tld string or None, sld string or None, boolean)
+        """
+        if not domain:
+            return None, None, False
+        parts = domain.lower().strip('.').split('.')
+        return self.lookup_labels(parts, wildcard, strict)
+
+    def lookup_labels(self, parts, wildcard=True, strict=False):
+        """
+        Same as lookup(), for a domain that has already been lowercased,
+        stripped of leading and trailing dots and split into its labels.
 
-        if depth <= len(parts) and children:
-            for name in ('*', parts[-depth]):
-                child = children.get(name, None)
-                if child is not None:
-                    if wildcard or name != '*':
-                        if child in (0, 1):
-                            negate = child
-                        else:
-                            negate = child[0]
-                        matches[-depth] = negate
-                        self._lookup_node(matches, depth + 1, child, parts, wildcard)
+        :param parts: list of domain labels, strings
+        :param wildcard: boolean, follow wildcard patterns
+        :param strict: boolean, check the TLD is valid, return None if not
+        :return: Tuple (tld string or None, sld string or None, boolean)
+        """
+        suffix_start = self._lookup_labels(parts, wildcard)
+        tld, sld = self._tld_and_sld(parts, suffix_start, strict)
+        # the domain is a suffix when the strict TLD spans all of its labels
+        is_suffix = suffix_start == 0 and self._is_known_tld(parts[-1])
+        return tld, sld, is_suffix
 
     def get_sld(self, domain, wildcard=True, strict=False):
         """
@@ -258,21 +425,7 @@ class PublicSuffixList(object):
         :param strict: boolean, check the TLD is valid, return None if not
         :return: string, the SLD for the domain
         """
-        if not domain:
-            return None
-
-        # for compatibility, set strict True not to allow invalid TLDs
-        tld = self.get_tld(domain, wildcard, True)
-        if strict and tld is None:
-            return None
-
-        parts = domain.lower().strip('.').split('.')
-        num_of_tld_parts = 0 if tld is None else tld.count('.') + 1
-
-        if len(parts) <= num_of_tld_parts:
-            return tld
-        else:
-            return '.'.join(parts[-(num_of_tld_parts + 1):])
+        return self.lookup(domain, wildcard, strict)[1]
 
     def get_public_suffix(self, domain, wildcard=True, strict=False):
         """
@@ -297,20 +450,292 @@ class PublicSuffixList(object):
         :param strict: boolean, check that top TLD is valid in Trie
         :return: string, the TLD for the domain
         """
-        if not domain:
-            return None
-        parts = domain.lower().strip('.').split('.')
-        hits = [None] * len(parts)
-        if strict and (
-            self.root in (0, 1) or parts[-1] not in self.root[1].keys()
-        ):
-            return None
+        return self.lookup(domain, wildcard, strict)[0]
+
+    def classify_many(self, domains, wildcard=True, strict=False,
+                      processes=None, chunksize=100000):
+        """
+        Classify many domains at once, and return the results as columns.
+
+        Domains are lowercased and stripped of leading and trailing dots, and
+        duplicates are classified once. The distinct domains are sorted by
+        their reversed labels, which groups them by TLD and then by suffix,
+        and the traversal of the Trie for the labels a domain shares with the
+        previous one is reused rather than repeated.
+
+        With processes greater than 1, the distinct domains are split into
+        chunks of `chunksize` and classified by a process pool. Where fork is
+        available the workers share this list copy-on-write.
+
+        :param domains: iterable of domain strings, e.g. a list or array
+        :param wildcard: boolean, follow wildcard patterns
+        :param strict: boolean, check the TLD is valid, None results if not
+        :param processes: int or None, the size of the process pool
+        :param chunksize: int, the number of distinct domains per task
+        :return: dict of equally long lists, 'domain' (the inputs),
+            'suffix' (the public suffix or None), 'etld_plus1' (the
+            registrable domain or None) and 'is_etld_plus1' (True when the
+            normalized domain is a registrable domain and not a suffix)
+        """
+        domains = list(domains)
+        keys = [(domain or '').lower().strip('.') for domain in domains]
+        unique = list(dict.fromkeys(keys))
+
+        if processes and processes > 1 and len(unique) > chunksize:
+            chunks = [unique[i:i + chunksize]
+                      for i in range(0, len(unique), chunksize)]
+            try:
+                context = multiprocessing.get_context('fork')
+                init_args = (None, wildcard, strict)
+                _set_classify_worker(self, wildcard, strict)
+            except ValueError:
+                context = multiprocessing.get_context()
+                init_args = (self, wildcard, strict)
+            with context.Pool(processes, _set_classify_worker,
+                              init_args) as pool:
+                results = {}
+                for partial in pool.imap(_classify_chunk, chunks):
+                    results.update(partial)
+        else:
+            results = self._classify(unique, wildcard, strict)
+
+        pairs = [results[key] for key in keys]
+        return {
+            'domain': domains,
+            'suffix': [tld for tld, _sld in pairs],
+            'etld_plus1': [sld for _tld, sld in pairs],
+            'is_etld_plus1': [bool(key) and sld == key and tld != key
+                              for key, (tld, sld) in zip(keys, pairs)],
+        }
+
+    def _classify(self, keys, wildcard, strict):
+        """
+        Return a dict of distinct normalized domain -> (tld, sld) for `keys`.
+
+        Domains are visited in the order of their reversed labels, so that
+        those under the same TLD, and then the same suffix, are adjacent. The
+        state of the walk after each label is kept on a stack, and the next
+        domain resumes the walk after the labels it shares with the previous
+        one instead of starting again from the root.
+        """
+        if self.table is not None:
+            # the table has no per-node state to resume from
+            results = {}
+            for key in keys:
+                parts = key.split('.')
+                results[key] = self._tld_and_sld(
+                    parts, self._lookup_labels(parts, wildcard), strict)
+            return results
+
+        # sorting on the reversed strings is much cheaper than on the label
+        # lists, and still keeps domains that share a suffix together
+        ordered = sorted((key for key in keys if key),
+                         key=lambda key: key[::-1])
+        tlds = []
+        slds = []
+
+        previous = []
+        # states[depth] is (frontier, deepest depth whose flag is 0) after
+        # walking that many labels of the previous domain
+        states = [((self.root,), None)]
+        for key in ordered:
+            parts = key.split('.')
+            labels = parts[::-1]
+            shared = 0
+            limit = min(len(labels), len(previous), len(states) - 1)
+            while shared < limit and labels[shared] == previous[shared]:
+                shared += 1
+            del states[shared + 1:]
+            frontier, zero_depth = states[shared]
+            depth = shared
+            while frontier and depth < len(labels):
+                label = labels[depth]
+                depth += 1
+                negate = 0 if (wildcard and depth == 1) else None
+                matched = []
+                for node in frontier:
+                    if node in (0, 1):
+                        continue
+                    children = node[1]
+                    for name in ('*', label):
+                        child = children.get(name, None)
+                        if child is not None and (wildcard or name != '*'):
+                            negate = child if child in (0, 1) else child[0]
+                            matched.append(child)
+                if negate == 0:
+                    zero_depth = depth
+                frontier = matched
+                states.append((frontier, zero_depth))
+            previous = labels
+
+            suffix_start = None if zero_depth is None else len(parts) - zero_depth
+            tld, sld = self._tld_and_sld(parts, suffix_start, strict)
+            tlds.append(tld)
+            slds.append(sld)
+
+        results = dict(zip(ordered, zip(tlds, slds)))
+        if '' in keys:
+            results[''] = (None, None)
+        return results
+
+    def _is_known_tld(self, label):
+        """
+        Return True if `label` is the last label of any rule.
+        """
+        if self.table is not None:
+            return self.table.flag(label) is not None
+        return self.root not in (0, 1) and label in self.root[1]
+
+    def _tld_and_sld(self, parts, suffix_start, strict):
+        """
+        Return the (tld, sld) of lookup_labels() given where the public suffix
+        of `parts` starts.
+        """
+        tld = None if suffix_start is None else '.'.join(parts[suffix_start:])
+        known_tld = self._is_known_tld(parts[-1])
+        strict_tld = tld if known_tld else None
+        if strict and strict_tld is None:
+            return None, None
+        num_of_tld_parts = 0 if strict_tld is None else len(parts) - suffix_start
+        if len(parts) <= num_of_tld_parts:
+            sld = strict_tld
+        else:
+            sld = '.'.join(parts[-(num_of_tld_parts + 1):])
+        return (strict_tld if strict else tld), sld
+
+
+class CompactSuffixTable(object):
+    """
+    Every node of a simplified Trie, stored in a flat hash table.
+
+    A node is named by the path of labels leading to it, from the TLD down,
+    joined with dots, e.g. 'uk.co' for the rule 'co.uk'. Nodes that are only
+    on the way to a rule are included with flag 0, as in the Trie. The paths
+    are concatenated into `blob`, each followed by its flag character, '0' or
+    '1', and `offsets` holds where each one starts. `slots` is an open
+    addressing table of indexes into `offsets`, keyed by the CRC-32 of the
+    path, which is stable across processes unlike hash(). The walk over a
+    domain is the same as PublicSuffixList._lookup_labels(), with paths in
+    place of Trie nodes.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: the simplified Trie, as built by PublicSuffixList
+        """
+        entries = []
+        self._collect(root, '', entries)
+        self.blob = ''.join(node + str(flag) for node, flag in entries)
+        self.offsets = array('I', [0])
+        for node, _flag in entries:
+            self.offsets.append(self.offsets[-1] + len(node) + 1)
+        # keep the table at most half full so that probe runs stay short
+        capacity = 8
+        while capacity < 2 * len(entries):
+            capacity *= 2
+        self.mask = capacity - 1
+        self.slots = array('i', [-1]) * capacity
+        for index, (node, _flag) in enumerate(entries):
+            slot = zlib.crc32(node.encode('utf8')) & self.mask
+            while self.slots[slot] >= 0:
+                slot = (slot + 1) & self.mask
+            self.slots[slot] = index
+
+    def _collect(self, node, node_path, entries):
+        if node in (0, 1):
+            return
+        for name, child in node[1].items():
+            child_path = node_path + '.' + name if node_path else name
+            entries.append((child_path, child if child in (0, 1) else child[0]))
+            self._collect(child, child_path, entries)
+
+    def flag(self, node_path):
+        """
+        Return the flag of the node at `node_path`, or None if there is none.
+        """
+        blob, offsets, slots, mask = (self.blob, self.offsets, self.slots,
+                                      self.mask)
+        slot = zlib.crc32(node_path.encode('utf8')) & mask
+        while True:
+            index = slots[slot]
+            if index < 0:
+                return None
+            end = offsets[index + 1] - 1
+            if blob[offsets[index]:end] == node_path:
+                return 1 if blob[end] == '1' else 0
+            slot = (slot + 1) & mask
+
+    def suffix_start(self, parts, wildcard):
+        """
+        Return the index in `parts` where the public suffix starts, or None.
+        See PublicSuffixList._lookup_labels().
+        """
+        num_parts = len(parts)
+        suffix_start = None
+        frontier = ('',)
+        for depth in range(1, num_parts + 1):
+            label = parts[-depth]
+            negate = 0 if (wildcard and depth == 1) else None
+            matched = []
+            for node_path in frontier:
+                for name in ('*', label):
+                    if name == '*' and not wildcard:
+                        continue
+                    child_path = node_path + '.' + name if node_path else name
+                    flag = self.flag(child_path)
+                    if flag is not None:
+                        negate = flag
+                        matched.append(child_path)
+            if negate == 0:
+                suffix_start = num_parts - depth
+            if not matched:
+                break
+            frontier = matched
+        return suffix_start
+
+
+def snapshot_path(psl_file, backend='trie'):
+    """
+    Return the default path of the snapshot of the list at `psl_file` compiled
+    with `backend`: the list's path with a '.<backend>.snapshot' suffix.
+
+    :param psl_file: string path of the list
+    :param backend: string, 'trie' or 'compact'
+    :return: string
+    """
+    return '%s.%s.snapshot' % (psl_file, backend)
+
+
+def snapshot_header(source, idna=True, backend='trie'):
+    """
+    Return the header of the snapshot compiled from the list `source`, the
+    bytes of a public suffix list file, with the given options.
+
+    :param source: bytes, the content of the list
+    :param idna: boolean, whether the list is converted to IDNA
+    :param backend: string, 'trie' or 'compact'
+    :return: bytes
+    """
+    return _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                 int(bool(idna)), BACKENDS.index(backend),
+                                 hashlib.sha256(source).digest())
+
+
+# The list and options used by the workers of classify_many()
+_CLASSIFY_WORKER = None
+
+
+def _set_classify_worker(psl, wildcard, strict):
+    global _CLASSIFY_WORKER
+    if psl is None:
+        # forked: the parent set the worker state before starting the pool
+        return
+    _CLASSIFY_WORKER = (psl, wildcard, strict)
 
-        self._lookup_node(hits, 1, self.root, parts, wildcard)
 
-        for i, what in enumerate(hits):
-            if what is not None and what == 0:
-                return '.'.join(parts[i:])
+def _classify_chunk(keys):
+    psl, wildcard, strict = _CLASSIFY_WORKER
+    return psl._classify(keys, wildcard, strict)
 
 
 _PSL = None
@@ -0,0 +1,396 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import FpsVendored  # noqa: F401 (must come first)
+from check_sites import check_errors, check_list
+from FpsCheck import FpsCheck, compiled_schema
+from FpsTransport import CachingTransport, PooledTransport
+from psl_refresh import PslHandle
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import getopt
+import http.server
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+# How long fetched responses are reused across submissions, in seconds
+MAX_AGE = 300.0
+# The number of finished jobs whose results are kept
+MAX_JOBS = 1000
+
+
+def _no_stage(name, sites=0):
+    return contextlib.nullcontext()
+
+
+class Validator:
+    """Validates submitted lists against reference files loaded once
+
+    The public suffix list, the ICANN domains and the compiled schema are
+    loaded when the Validator is created, and the network checks of every
+    submission share one transport, pooling connections and reusing the
+    responses fetched within max_age seconds. A validation only does the work
+    that depends on the submitted list. The public suffix list and the ICANN
+    domains are held by a PslHandle, so a validation started after
+    psl_refresh rewrites them uses the new ones.
+
+  Attributes:
+    input_prefix: the directory holding the reference files
+    psl: the PslHandle holding the public suffix list and the ICANN domains
+    schema_file: the path of SCHEMA.json
+    transport: the transport the network checks fetch through
+  """
+    def __init__(self, input_prefix='', psl_cache=None, transport=None,
+                 max_age=MAX_AGE):
+        self.input_prefix = input_prefix
+        self.psl = PslHandle(input_prefix, psl_cache, 'compact')
+        self.schema_file = os.path.join(input_prefix, 'SCHEMA.json')
+        compiled_schema(self.schema_file)
+        self.transport = transport or CachingTransport(PooledTransport(),
+                                                       max_age)
+        self._list_file = os.path.join(input_prefix, 'first_party_sets.JSON')
+        self._current = (None, None)
+        self._lock = threading.Lock()
+
+    def current_sites(self):
+        """Returns the list in input_prefix, read again only when the file
+        changes"""
+        stat = os.stat(self._list_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if self._current[0] != stamp:
+                with open(self._list_file) as f:
+                    self._current = (stamp, json.load(f))
+            return self._current[1]
+
+    def validate(self, fps_sites, with_diff=False, progress=None):
+        """Runs every check on a submitted list
+
+        Args:
+            fps_sites: the submitted list, in the format of
+            first_party_sets.JSON
+            with_diff: whether to only check the sets that differ from the
+            current list
+            progress: a Job to report each stage to, or None
+        Returns:
+            List[string], the errors in the order check_sites prints them,
+            empty if the list passed
+        """
+        etlds, icanns = self.psl.current()
+        fps_checker = FpsCheck(fps_sites, etlds, icanns, self.transport)
+        error_texts = []
+        stage = _no_stage
+        if progress:
+            progress.watch(fps_checker, error_texts)
+            stage = progress.stage
+        try:
+            with stage('schema', len(fps_sites.get('sets', []))):
+                fps_checker.validate_schema(self.schema_file)
+        except Exception as inst:
+            # If the schema is invalid, we will not run any other checks
+            return [str(inst)]
+        old_sites = self.current_sites() if with_diff else None
+        check_list(fps_checker, stage, old_sites, error_texts)
+        return check_errors(fps_checker, error_texts)
+
+
+class Job:
+    """A submission queued for validation, and the progress of its run
+
+    Every stage of the run adds an event holding the errors the stage found,
+    and a final "done" event holds all of them; follow() streams the events
+    as they happen.
+
+  Attributes:
+    id: the string identifying the job
+    fps_sites: the submitted list
+    with_diff: whether only the sets that differ from the current list are
+    checked
+    status: "queued", "running" or "done"
+    events: the list of events so far
+    errors: the list of errors, once the job is done
+    submitted_at: the time.time() the job was queued
+  """
+    def __init__(self, job_id, fps_sites, with_diff=False):
+        self.id = job_id
+        self.fps_sites = fps_sites
+        self.with_diff = with_diff
+        self.status = "queued"
+        self.events = []
+        self.errors = None
+        self.submitted_at = time.time()
+        self._started = None
+        self._checker = None
+        self._error_texts = []
+        self._changed = threading.Condition()
+
+    def summary(self):
+        """Returns the status of the job, and its result once done"""
+        summary = {"id": self.id, "status": self.status,
+                   "with_diff": self.with_diff}
+        if self.status == "done":
+            summary["success"] = not self.errors
+            summary["errors"] = self.errors
+        return summary
+
+    def _emit(self, event, status=None):
+        with self._changed:
+            self.events.append(event)
+            if status:
+                self.status = status
+            self._changed.notify_all()
+
+    def watch(self, fps_checker, error_texts):
+        """Attributes the errors fps_checker and error_texts collect to the
+        stage in progress"""
+        self._checker = fps_checker
+        self._error_texts = error_texts
+
+    @contextlib.contextmanager
+    def stage(self, name, sites=0):
+        """Reports the errors found by the enclosed block as the stage called
+        name"""
+        checker_before = len(self._checker.error_list)
+        texts_before = len(self._error_texts)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._emit({
+                "event": "stage", "stage": name, "sites": sites,
+                "elapsed_s": round(time.perf_counter() - start, 6),
+                "errors": [
+                    str(error) for error in itertools.chain(
+                        self._checker.error_list[checker_before:],
+                        self._error_texts[texts_before:])]})
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._emit({"event": "started"}, "running")
+
+    def finish(self, errors):
+        self.errors = errors
+        # The submission is not needed once it has been checked
+        self.fps_sites = None
+        self._emit({"event": "done", "success": not errors,
+                    "errors": errors,
+                    "elapsed_s": round(time.perf_counter() - self._started,
+                                       6)}, "done")
+
+    def follow(self):
+        """Yields every event of the job, waiting for new ones until it is
+        done"""
+        seen = 0
+        while True:
+            with self._changed:
+                while seen == len(self.events) and self.status != "done":
+                    self._changed.wait()
+                new_events = self.events[seen:]
+                seen = len(self.events)
+                done = self.status == "done"
+            yield from new_events
+            if done:
+                return
+
+
+class JobQueue:
+    """Runs queued submissions on a pool of worker threads
+
+    The checks spend their time waiting on the network, so threads sharing
+    the Validator's reference data and transport keep every worker busy
+    without copying them.
+
+  Attributes:
+    validator: the Validator the jobs are run with
+    jobs: an ordered dictionary of id->Job, oldest first
+  """
+    def __init__(self, validator, workers=4, max_jobs=MAX_JOBS):
+        self.validator = validator
+        self.jobs = collections.OrderedDict()
+        self._max_jobs = max_jobs
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers)
+
+    def submit(self, fps_sites, with_diff=False):
+        """Queues a submitted list and returns its Job"""
+        with self._lock:
+            job = Job(str(next(self._ids)), fps_sites, with_diff)
+            self.jobs[job.id] = job
+            # Forget the oldest finished jobs beyond max_jobs
+            for old in [old for old in self.jobs.values()
+                        if old.status == "done"][
+                            :max(0, len(self.jobs) - self._max_jobs)]:
+                del self.jobs[old.id]
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.start()
+        try:
+            errors = self.validator.validate(job.fps_sites, job.with_diff,
+                                             job)
+        except Exception as inst:
+            errors = ["Validation failed: " + str(inst)]
+        job.finish(errors)
+
+    def get(self, job_id):
+        """Returns the Job with job_id, or None"""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def counts(self):
+        """Returns the number of jobs by status"""
+        with self._lock:
+            return collections.Counter(job.status
+                                       for job in self.jobs.values())
+
+    def shutdown(self):
+        """Waits for the queued jobs to finish and stops the workers"""
+        self._executor.shutdown()
+
+
+class ValidationHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts submissions and reports their results over HTTP/1.1
+
+    POST /jobs queues the list in the body, only checking the sets that
+    differ from the current list with ?with_diff=1, and answers with the job
+    id; with ?stream=1 it instead streams the job's events as JSON lines until
+    it is done. GET /jobs/<id> returns the status and result of a job,
+    GET /jobs/<id>/events streams its events and GET /health reports the
+    queue and the fetch cache.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if parts.path != "/jobs":
+            self._send(404, {"error": "Unknown path: " + self.path})
+            return
+        params = dict(parse_qsl(parts.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            fps_sites = json.loads(self.rfile.read(length))
+            if not isinstance(fps_sites, dict):
+                raise ValueError("Expected a list of sets")
+        except ValueError as inst:
+            self._send(400, {"error": "Invalid submission: " + str(inst)})
+            return
+        job = self.server.queue.submit(fps_sites,
+                                       params.get("with_diff") == "1")
+        if params.get("stream") == "1":
+            self._stream(job)
+        else:
+            self._send(202, job.summary())
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.strip("/").split("/")
+        if path == ["health"]:
+            transport = self.server.queue.validator.transport
+            self._send(200, {
+                "jobs": dict(self.server.queue.counts()),
+                "cache_hits": getattr(transport, "hits", None),
+                "cache_misses": getattr(transport, "misses", None)})
+            return
+        job = None
+        if len(path) in (2, 3) and path[0] == "jobs":
+            job = self.server.queue.get(path[1])
+        if job is None or (len(path) == 3 and path[2] != "events"):
+            self._send(404, {"error": "Unknown job or path: " + self.path})
+        elif len(path) == 3:
+            self._stream(job)
+        else:
+            self._send(200, job.summary())
+
+    def _send(self, status, result):
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in job.follow():
+            line = (json.dumps(dict(event, id=job.id)) + "\n").encode(
+                "utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class ValidationServer(http.server.ThreadingHTTPServer):
+    """Serves ValidationHandler for a JobQueue"""
+    daemon_threads = True
+
+    def __init__(self, address, queue):
+        super().__init__(address, ValidationHandler)
+        self.queue = queue
+
+
+def main():
+    args = sys.argv[1:]
+    input_prefix = ''
+    psl_cache = None
+    host = '127.0.0.1'
+    port = 8054
+    workers = 4
+    max_age = MAX_AGE
+    opts, _ = getopt.getopt(args, "", ["data_directory=", "psl_cache=",
+                                       "host=", "port=", "workers=",
+                                       "max_age="])
+    for opt, arg in opts:
+        if opt == '--data_directory':
+            input_prefix = arg
+        if opt == '--psl_cache':
+            psl_cache = arg
+        if opt == '--host':
+            host = arg
+        if opt == '--port':
+            port = int(arg)
+        if opt == '--workers':
+            workers = int(arg)
+        if opt == '--max_age':
+            max_age = float(arg)
+
+    validator = Validator(input_prefix, psl_cache, max_age=max_age)
+    # psl_refresh --notify_pid sends SIGHUP after writing a new list
+    validator.psl.install_signal_handler()
+    queue = JobQueue(validator, workers)
+    server = ValidationServer((host, port), queue)
+    print("Serving on http://%s:%d" % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import contextlib
+import json
+import random
+import socket
+import threading
+
+WELL_KNOWN = "/.well-known/first-party-set.json"
+REASONS = {200: "OK", 301: "Moved Permanently", 302: "Found",
+           404: "Not Found", 500: "Internal Server Error"}
+
+
+class HostProfile:
+    """Describes how a single synthetic host of the WebFarm answers requests
+
+  Attributes:
+    well_known: the JSON object served at /.well-known/first-party-set.json,
+    or None for a 404
+    x_robots_tag: the value of the X-Robots-Tag header, or None to omit it
+    robots_txt: the body served at /robots.txt, or None for a 404
+    ads_txt: whether /ads.txt exists on the host
+    redirect_to: a URL that / redirects to, or None to serve / directly
+    status: the status code returned for / when it is not a redirect
+    latency: a tuple describing the delay before each response in
+    milliseconds, one of ("fixed", ms), ("uniform", low, high) or
+    ("lognormal", median, sigma)
+    failure: None, or the failure mode of the host; "reset" closes the
+    connection without answering, "hang" holds the connection open for
+    hang_seconds and "error" returns a 500 for every path
+    failure_rate: the probability that any single request fails with the
+    host's failure mode
+  """
+    def __init__(self, well_known=None, x_robots_tag=None, robots_txt=None,
+                 ads_txt=False, redirect_to=None, status=200,
+                 latency=("fixed", 0), failure=None, failure_rate=1.0):
+        self.well_known = well_known
+        self.x_robots_tag = x_robots_tag
+        self.robots_txt = robots_txt
+        self.ads_txt = ads_txt
+        self.redirect_to = redirect_to
+        self.status = status
+        self.latency = latency
+        self.failure = failure
+        self.failure_rate = failure_rate
+
+    def sample_latency(self, rng):
+        """Draws a response delay in seconds from the latency distribution"""
+        kind, *params = self.latency
+        if kind == "fixed":
+            millis = params[0]
+        elif kind == "uniform":
+            millis = rng.uniform(params[0], params[1])
+        elif kind == "lognormal":
+            # params are (median, sigma); the median of a lognormal is e^mu
+            median, sigma = params
+            millis = rng.lognormvariate(0, sigma) * median
+        else:
+            raise ValueError("Unknown latency distribution: " + kind)
+        return max(millis, 0) / 1000.0
+
+
+class WebFarm:
+    """A local asyncio HTTP(S) server answering for many virtual hosts
+
+    Requests are routed to a HostProfile by their Host header. The farm runs
+    its own event loop on a background thread so that the (blocking) checks
+    in FpsCheck can be driven against it from the calling thread. Use
+    resolver_override() to make the synthetic hostnames resolve to the farm.
+
+  Attributes:
+    profiles: a dictionary of hostname->HostProfile
+    default_profile: the HostProfile used for unknown hosts
+    ssl_context: an ssl.SSLContext to serve HTTPS with, or None for HTTP
+    hang_seconds: how long a host with the "hang" failure mode stalls
+    request_count: the number of requests answered so far
+  """
+    def __init__(self, profiles, ssl_context=None, host="127.0.0.1", port=0,
+                 default_profile=None, hang_seconds=2.0, seed=0):
+        self.profiles = profiles
+        self.ssl_context = ssl_context
+        self.host = host
+        self.port = port
+        self.default_profile = default_profile or HostProfile(status=404)
+        self.hang_seconds = hang_seconds
+        self.request_count = 0
+        self._rng = random.Random(seed)
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts serving on a background thread and returns the bound port"""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(asyncio.start_server(
+                self._handle, self.host, self.port, ssl=self.ssl_context,
+                backlog=1024))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        """Stops the event loop and waits for the serving thread to exit"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @contextlib.contextmanager
+    def resolver_override(self):
+        """Resolves every host known to the farm to the farm's address
+
+        Patches socket.getaddrinfo, which both urllib and requests go through,
+        so that connections to any hostname in profiles land on the farm's
+        listening port, whatever port the URL names.
+        """
+        original = socket.getaddrinfo
+
+        def getaddrinfo(host, port, *args, **kwargs):
+            if host in self.profiles:
+                return original(self.host, self.port, *args, **kwargs)
+            return original(host, port, *args, **kwargs)
+
+        socket.getaddrinfo = getaddrinfo
+        try:
+            yield
+        finally:
+            socket.getaddrinfo = original
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                path, headers = request
+                hostname = headers.get("host", "").split(":")[0]
+                profile = self.profiles.get(hostname, self.default_profile)
+                self.request_count += 1
+                await asyncio.sleep(profile.sample_latency(self._rng))
+                failure = None
+                if profile.failure and (
+                        self._rng.random() < profile.failure_rate):
+                    failure = profile.failure
+                if failure == "reset":
+                    break
+                if failure == "hang":
+                    await asyncio.sleep(self.hang_seconds)
+                    break
+                if failure == "error":
+                    response = (500, {}, b"")
+                else:
+                    response = self._respond(profile, path)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(self._serialize(*response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length:
+            await reader.readexactly(length)
+        return parts[1].split("?")[0], headers
+
+    def _respond(self, profile, path):
+        headers = {}
+        if profile.x_robots_tag is not None:
+            headers["X-Robots-Tag"] = profile.x_robots_tag
+        if path == WELL_KNOWN:
+            if profile.well_known is None:
+                return 404, headers, b""
+            headers["Content-Type"] = "application/json"
+            return 200, headers, json.dumps(profile.well_known).encode()
+        if path == "/robots.txt":
+            if profile.robots_txt is None:
+                return 404, headers, b""
+            return 200, headers, profile.robots_txt.encode()
+        if path == "/ads.txt":
+            if not profile.ads_txt:
+                return 404, headers, b""
+            return 200, headers, b"example.com, pub-0000, DIRECT\n"
+        if path == "/" and profile.redirect_to:
+            headers["Location"] = profile.redirect_to
+            return 301, headers, b""
+        if path == "/":
+            return profile.status, headers, b"<html></html>"
+        return 404, headers, b""
+
+    def _serialize(self, status, headers, body, keep_alive):
+        lines = ["HTTP/1.1 %d %s" % (status, REASONS.get(status, "Unknown"))]
+        headers["Content-Length"] = str(len(body))
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        lines += [name + ": " + value for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+def synthetic_sets(num_sets, associated_per_set=2, service_per_set=1,
+                   domain="fps-bench.test", scheme="https",
+                   latency=("fixed", 0), failure=None, failure_rate=0.0,
+                   misconfig_rate=0.0, seed=0):
+    """Builds a synthetic First-Party Sets list and the farm profiles for it
+
+    Every primary and associated site serves a matching well-known file and
+    every service site carries a noindex X-Robots-Tag, has no ads.txt and
+    redirects away from its root, so a clean run produces no errors. Hosts are
+    then made to misbehave at random: misconfig_rate of the hosts serve
+    content that fails the checks, and failure_rate of the hosts get the
+    given failure mode.
+
+    Args:
+        num_sets: the number of sets to generate
+        associated_per_set: the number of associated sites in each set
+        service_per_set: the number of service sites in each set
+        domain: the parent domain of every synthetic hostname
+        scheme: "https" or "http", matching how the farm is served
+        latency: the latency distribution of every host
+        failure: the failure mode given to failing hosts
+        failure_rate: the fraction of hosts that fail
+        misconfig_rate: the fraction of hosts that serve bad content
+        seed: the seed for the random choices
+    Returns:
+        Tuple[Dict, Dict[string, HostProfile]], the list in the format of
+        first_party_sets.JSON and the profiles keyed by hostname
+    """
+    rng = random.Random(seed)
+    sets = []
+    profiles = {}
+
+    def site(name):
+        return scheme + "://" + name + "." + domain
+
+    def profile(**kwargs):
+        kwargs["latency"] = latency
+        if rng.random() < failure_rate:
+            kwargs["failure"] = failure
+        return HostProfile(**kwargs)
+
+    for n in range(num_sets):
+        primary = site("p%d" % n)
+        associated = [site("a%d-%d" % (n, i))
+                      for i in range(associated_per_set)]
+        service = [site("s%d-%d" % (n, i)) for i in range(service_per_set)]
+        fps = {"primary": primary, "contact": "owner@" + domain}
+        if associated:
+            fps["associatedSites"] = associated
+        if service:
+            fps["serviceSites"] = service
+        fps["rationaleBySite"] = {member: "synthetic"
+                                  for member in associated + service}
+        sets.append(fps)
+        well_known = {field: fps[field]
+                      for field in ("primary", "associatedSites",
+                                    "serviceSites")
+                      if field in fps}
+        for member in [primary] + associated + service:
+            misconfigured = rng.random() < misconfig_rate
+            hostname = member.split("://", 1)[1]
+            if member in service:
+                profiles[hostname] = profile(
+                    x_robots_tag=None if misconfigured else "noindex",
+                    ads_txt=misconfigured,
+                    redirect_to=None if misconfigured else member + "/landing",
+                    well_known={"primary": primary})
+            elif member == primary:
+                profiles[hostname] = profile(
+                    well_known=None if misconfigured else well_known)
+            else:
+                profiles[hostname] = profile(well_known={
+                    "primary": site("wrong") if misconfigured else primary})
+    return {"sets": sets}, profiles